@@ -0,0 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import atexit
+import io
+import os
+import threading
+
+ARTIFACT_KINDS = ('grayscale', 'hazards', 'route', 'animation')
+
+# The modes of the still images the program saves (the 16-bit grayscale, the hazards and the route plots), and the mode each one is 
+# converted to when the image format cannot hold it
+IMAGE_MODES = ('I;16', 'RGB', 'RGBA')
+FALLBACK_MODES = {'I;16': 'L', 'RGBA': 'RGB'}
+
+class ArtifactWriter:
+    '''
+    ArtifactWriter saves the finished output images of the program on a bounded pool of background threads, so processing an image never
+    waits on encoding the previous one. Each kind of artifact (grayscale, hazards, route, animation) can be turned off, and still images
+    can be saved with a different PNG compression level or image format. Pending artifacts are flushed when the writer is closed or when
+    the program exits.
+    '''
+
+    def __init__(self, enabled=None, png_compress_level=6, image_format='png', max_workers=2, max_pending=8):
+        '''
+        Initialize the class with the artifacts to save and how to encode them.
+
+        Parameters:
+            enabled (dict): Maps an artifact kind to whether it is saved. Kinds that are left out are saved.
+            png_compress_level (int): The zlib compression level (0-9) used for PNG artifacts. Lower is faster but larger.
+            image_format (string): The format still images are saved as, by file extension (e.g. 'png', 'tiff' or 'jpg'). The file 
+                extension is changed to match, and images the format cannot hold are converted (e.g. to 8-bit grayscale or RGB for JPEG).
+            max_workers (int): The number of background threads encoding artifacts.
+            max_pending (int): The number of artifacts that can be waiting to be saved before submit blocks.
+        '''
+
+        self.enabled = {kind: True for kind in ARTIFACT_KINDS}
+        if enabled:
+            self.enabled.update(enabled)
+        self.png_compress_level = png_compress_level
+        self.image_format = image_format.lower().lstrip('.')
+        self.save_format = Image.registered_extensions().get('.' + self.image_format)
+        if self.save_format not in Image.SAVE:
+            raise ValueError(f"Cannot save images as {image_format}.")
+        self.save_modes = {mode: self.find_save_mode(mode) for mode in IMAGE_MODES}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='artifact-writer')
+        self.pending = threading.BoundedSemaphore(max_pending)  # Bounds the memory held by queued artifacts
+        self.futures = set()
+        self.errors = []
+        self.lock = threading.Lock()
+        self.closed = False
+        atexit.register(self.close)
+
+    def find_save_mode(self, mode):
+        '''
+        Finds the mode an image is saved in with the configured image format, by saving a single pixel in memory.
+
+        Parameters:
+            mode (string): The mode of the image.
+
+        Returns:
+            string: The mode itself, or the mode it is converted to first.
+        '''
+
+        for save_mode in (mode, FALLBACK_MODES.get(mode)):
+            if save_mode is None:
+                break
+            try:
+                Image.new(save_mode, (1, 1)).save(io.BytesIO(), format=self.save_format)
+                return save_mode
+            except (OSError, ValueError, KeyError):
+                continue
+        raise ValueError(f"Cannot save {mode} images as {self.image_format}.")
+
+    def is_enabled(self, kind):
+        '''
+        Returns whether the given kind of artifact is saved.
+
+        Parameters:
+            kind (string): The kind of artifact.
+
+        Returns:
+            bool: True if the artifact is saved.
+        '''
+
+        return self.enabled.get(kind, False)
+
+    def output_path(self, path):
+        '''
+        Returns the path a still image is saved to, with its extension matching the configured image format.
+
+        Parameters:
+            path (string): The requested path of the artifact.
+
+        Returns:
+            string: The path the artifact is saved to.
+        '''
+
+        basename, extension = os.path.splitext(path)
+        return f'{basename}.{self.image_format}'
+
+    def submit(self, kind, path, image, **save_options):
+        '''
+        Queues a still image to be saved in the background. Blocks only while max_pending artifacts are already waiting.
+
+        Parameters:
+            kind (string): The kind of artifact.
+            path (string): The requested path of the artifact.
+            image (PIL.Image): The image to save. It must not be modified after it is submitted.
+            save_options: Extra options passed to PIL.Image.save (e.g. dpi).
+
+        Returns:
+            Future: The pending save, or None if the artifact kind is turned off.
+        '''
+
+        if not self.is_enabled(kind):
+            return None
+
+        if self.save_format == 'PNG':
+            save_options.setdefault('compress_level', self.png_compress_level)
+
+        # Images the format cannot hold are converted in the background too
+        save_mode = self.save_modes.get(image.mode, image.mode)
+        if save_mode != image.mode:
+            return self._submit(lambda path, **options: image.convert(save_mode).save(path, **options), self.output_path(path),
+                                format=self.save_format, **save_options)
+        return self._submit(image.save, self.output_path(path), format=self.save_format, **save_options)
+
+    def submit_animation(self, path, frames, duration=500):
+        '''
+        Queues the frames of an animation to be saved in the background as a looping GIF.
+
+        Parameters:
+            path (string): The path of the GIF.
+            frames (list): The PIL images of each frame.
+            duration (int): How long each frame is displayed, in milliseconds.
+
+        Returns:
+            Future: The pending save, or None if animations are turned off or there are no frames.
+        '''
+
+        if not self.is_enabled('animation') or not frames:
+            return None
+
+        return self._submit(frames[0].save, path, format='gif', save_all=True, append_images=frames[1:], duration=duration, loop=0)
+
+    def _submit(self, save, path, **save_options):
+        if self.closed:
+            raise ValueError("ArtifactWriter is closed.")
+
+        self.pending.acquire()
+        future = self.executor.submit(save, path, **save_options)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+        self.pending.release()
+
+    def flush(self):
+        '''
+        Waits until every queued artifact has been saved. Raises the first error a save ran into since the last flush.
+        '''
+
+        while True:
+            with self.lock:
+                futures = list(self.futures)
+            if not futures:
+                break
+            for future in futures:
+                future.exception()  # Waits without raising, errors are collected by _done
+
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        '''
+        Flushes the queued artifacts and stops the background threads. Closing twice has no effect.
+        '''
+
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
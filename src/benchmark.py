@@ -0,0 +1,279 @@
+from main import process_image_file, check_directory_exists, DRONE_CAPACITY
+from artifact_writer import ArtifactWriter, ARTIFACT_KINDS
+from pipeline import PipelinedExecutor, STAGES, peak_rss_bytes
+from PIL import Image
+import argparse
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import queue
+import shutil
+import sys
+import tempfile
+import time
+
+def generate_corpus(folder, count, resolution, seed=0):
+    '''
+    Generates synthetic drone images: smooth ground with light noise and a few patches of strong texture where hazards are found. The
+    same seed, resolution and index always give the same image, and images that are already in the folder are kept.
+
+    Parameters:
+        folder (string): The folder the images are saved to.
+        count (int): The number of images.
+        resolution (tuple): (width, height) of the images in pixels.
+        seed (int): The seed of the random images.
+
+    Returns:
+        list: The filenames of the images.
+    '''
+
+    os.makedirs(folder, exist_ok=True)
+    width, height = resolution
+    filenames = []
+    for index in range(count):
+        filename = f'{index:05d}.png'
+        filenames.append(filename)
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            continue
+
+        rng = np.random.default_rng((seed, width, height, index))
+        ground = rng.integers(60, 200, size=(max(2, height // 64), max(2, width // 64), 3), dtype=np.uint8)
+        pixels = np.array(Image.fromarray(ground).resize((width, height), Image.BILINEAR))
+        pixels += rng.integers(0, 8, size=pixels.shape, dtype=np.uint8)
+
+        for _ in range(rng.integers(5, 15)):
+            patch_width = int(rng.integers(max(1, width // 40), max(2, width // 10)))
+            patch_height = int(rng.integers(max(1, height // 40), max(2, height // 10)))
+            left = int(rng.integers(0, width - patch_width + 1))
+            top = int(rng.integers(0, height - patch_height + 1))
+            pixels[top:top + patch_height, left:left + patch_width] = rng.integers(0, 256, size=(patch_height, patch_width, 3), dtype=np.uint8)
+
+        Image.fromarray(pixels).save(path, compress_level=1)
+
+    return filenames
+
+def link_corpus(source_folder, folder, filenames):
+    '''Fills a folder with a subset of a corpus, hard linking the images when possible.'''
+
+    os.makedirs(folder, exist_ok=True)
+    for filename in filenames:
+        target = os.path.join(folder, filename)
+        if not os.path.exists(target):
+            try:
+                os.link(os.path.join(source_folder, filename), target)
+            except OSError:
+                shutil.copyfile(os.path.join(source_folder, filename), target)
+
+def run_configuration(image_folder, output_folder, grids, workers, artifacts, drone_capacity, start_method, frame_workers, sample_stride, results):
+    '''
+    Runs one configuration of the benchmark and puts its measurements on the results queue. It runs in its own process, so its memory
+    and caches are its own. Every configuration runs the same PipelinedExecutor, only the number of workers per stage changes.
+
+    The first image is processed once in this process before the timing starts, so the modules are imported and the caches of the grid 
+    size (adjacency tables, overlay templates) are built. With the 'fork' start method the workers start from this warm process 
+    instead of importing everything again.
+
+    Parameters:
+        image_folder (string): The folder of the corpus.
+        output_folder (string): The folder the outputs are saved to.
+        grids (int): The size of the grid (an x by x grid).
+        workers (int): The number of worker processes per pipeline stage.
+        artifacts (list): The kinds of artifacts that are saved.
+        drone_capacity (float): The number of red grids a single drone can cover.
+        start_method (string): The multiprocessing start method of the workers.
+        frame_workers (int): The number of threads each detect worker splits a frame across.
+        sample_stride (int): When set, the hazards of each frame are estimated from a sample of its pixels.
+        results (Queue): Receives the measurements.
+    '''
+
+    # The progress of every image is printed, which is not part of the measurement
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    sys.stdout = open(os.devnull, 'w')
+
+    writer_options = {'enabled': {kind: kind in artifacts for kind in ARTIFACT_KINDS}}
+
+    warmup_folders = [os.path.join(output_folder, 'warmup', name) for name in ('grayscale', 'potential_hazards', 'grid_coords', 'drone_paths')]
+    for folder in warmup_folders:
+        check_directory_exists(folder)
+    with ArtifactWriter(**writer_options) as writer:
+        process_image_file(sorted(os.listdir(image_folder))[0], image_folder, *warmup_folders, grids, writer, drone_capacity,
+                           workers=frame_workers, sample_stride=sample_stride)
+
+    folders = [os.path.join(output_folder, name) for name in ('grayscale', 'potential_hazards', 'grid_coords', 'drone_paths')]
+    executor = PipelinedExecutor(workers={stage: workers for stage in STAGES}, writer_options=writer_options, start_method=start_method,
+                                 frame_workers=frame_workers, sample_stride=sample_stride)
+
+    started = time.time()
+    images = executor.run(image_folder, *folders, grids, drone_capacity=drone_capacity)
+    elapsed = time.time() - started
+
+    # Each worker reports its own peak, the sum bounds the memory of the whole pipeline (pages shared after a fork count once per worker)
+    worker_rss = sum(stats['peak_rss_bytes'] for stats in executor.worker_stats)
+    results.put({
+        'seconds': elapsed,
+        'images': len(images),
+        'processes': sum(executor.workers.values()),
+        'errors': [image['error'] for image in images if image['error']],
+        'latencies': [image['finished'] - image['started'] for image in images],
+        'peak_parent_rss_bytes': peak_rss_bytes(),
+        'peak_worker_rss_bytes': worker_rss,
+        'peak_rss_bytes': peak_rss_bytes() + worker_rss,
+    })
+
+def default_start_method():
+    '''Returns 'fork' where it is available, so the workers start from the warm benchmark process, and 'spawn' elsewhere.'''
+
+    return 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def benchmark(counts, resolutions, grid_sizes, worker_counts, repeats=1, seed=0, artifacts=ARTIFACT_KINDS, drone_capacity=DRONE_CAPACITY, work_folder=None, start_method=None, frame_workers=None, sample_stride=None):
+    '''
+    Runs the whole program on generated corpora for every combination of image count, resolution, grid size and worker count. It 
+    measures the PipelinedExecutor (see pipeline.py), not main.process_image_files: every configuration, the baseline with 1 worker 
+    per stage included, runs the same pipeline, so only the number of workers per stage changes between them.
+
+    Parameters:
+        counts (list): The numbers of images.
+        resolutions (list): The (width, height) of the images.
+        grid_sizes (list): The sizes of the grid (an x by x grid).
+        worker_counts (list): The numbers of workers per pipeline stage.
+        repeats (int): The number of times each configuration is run.
+        seed (int): The seed of the generated images.
+        artifacts (list): The kinds of artifacts that are saved.
+        drone_capacity (float): The number of red grids a single drone can cover.
+        work_folder (string): The folder the corpora and outputs are kept in. Defaults to a temporary folder that is removed afterwards.
+        start_method (string): The multiprocessing start method ('fork', 'spawn' or 'forkserver'). Defaults to default_start_method().
+        frame_workers (int): The number of threads each detect worker splits a frame across (see main.detect_hazards).
+        sample_stride (int): When set, the hazards of each frame are estimated from a sample of its pixels (see main.detect_hazards).
+
+    Returns:
+        dict: The report, with the environment and one result per configuration: images per second (the median of the repeats),
+            p50 and p95 latency of an image in seconds (from the decode stage taking it to the render stage handing it to the writer),
+            peak memory in bytes (the benchmark process plus the sum of its workers), and the speedup and scaling efficiency against 
+            the baseline. The efficiency divides the speedup by the growth in cores the workers can use (the number of worker 
+            processes, at most the number of CPUs), so 1.0 is perfect scaling.
+    '''
+
+    owns_folder = work_folder is None
+    work_folder = work_folder or tempfile.mkdtemp(prefix='benchmark-')
+    start_method = start_method or default_start_method()
+    context = multiprocessing.get_context(start_method)
+    worker_counts = sorted(set(worker_counts) | {1})
+    configurations = []
+
+    try:
+        for resolution in resolutions:
+            corpus_folder = os.path.join(work_folder, f'corpus_{resolution[0]}x{resolution[1]}')
+            filenames = generate_corpus(corpus_folder, max(counts), resolution, seed)
+
+            for count, grids, workers in itertools.product(counts, grid_sizes, worker_counts):
+                image_folder = os.path.join(work_folder, f'images_{resolution[0]}x{resolution[1]}_{count}')
+                link_corpus(corpus_folder, image_folder, filenames[:count])
+
+                runs = []
+                for repeat in range(repeats):
+                    output_folder = os.path.join(work_folder, 'outputs')
+                    results = context.Queue()
+                    process = context.Process(target=run_configuration,
+                                              args=(image_folder, output_folder, grids, workers, list(artifacts), drone_capacity,
+                                                    start_method, frame_workers, sample_stride, results))
+                    process.start()
+                    while True:
+                        try:
+                            runs.append(results.get(timeout=1))
+                            break
+                        except queue.Empty:
+                            if not process.is_alive():
+                                raise RuntimeError(f"The benchmark of {image_folder} with {workers} workers exited with code {process.exitcode}.")
+                    process.join()
+                    shutil.rmtree(output_folder, ignore_errors=True)
+
+                latencies = np.concatenate([run['latencies'] for run in runs])
+                configurations.append({
+                    'count': count,
+                    'resolution': list(resolution),
+                    'grids': grids,
+                    'workers': workers,
+                    'processes': runs[0]['processes'],
+                    'images_per_second': float(np.median([run['images'] / run['seconds'] for run in runs])),
+                    'seconds': [run['seconds'] for run in runs],
+                    'p50_latency': float(np.percentile(latencies, 50)) if latencies.size else None,
+                    'p95_latency': float(np.percentile(latencies, 95)) if latencies.size else None,
+                    'peak_rss_bytes': max(run['peak_rss_bytes'] for run in runs),
+                    'peak_parent_rss_bytes': max(run['peak_parent_rss_bytes'] for run in runs),
+                    'peak_worker_rss_bytes': max(run['peak_worker_rss_bytes'] for run in runs),
+                    'errors': sum(len(run['errors']) for run in runs),
+                })
+    finally:
+        if owns_folder:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    # Scaling efficiency against the baseline of the same count, resolution and grid size
+    cpu_count = os.cpu_count() or 1
+    for configuration in configurations:
+        baseline = next(
+            other for other in configurations
+            if (other['count'], other['resolution'], other['grids'], other['workers']) == (configuration['count'], configuration['resolution'], configuration['grids'], 1)
+        )
+        speedup = configuration['images_per_second'] / baseline['images_per_second']
+        cores = min(configuration['processes'], cpu_count) / min(baseline['processes'], cpu_count)
+        configuration['speedup'] = speedup
+        configuration['scaling_efficiency'] = speedup / cores
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': cpu_count,
+            'start_method': start_method,
+            'frame_workers': frame_workers,
+            'sample_stride': sample_stride,
+            'seed': seed,
+            'repeats': repeats,
+            'artifacts': list(artifacts),
+        },
+        'configurations': configurations,
+    }
+
+def parse_resolution(value):
+    '''Parses a resolution given as WIDTHxHEIGHT.'''
+
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a resolution like 1920x1080.")
+    return width, height
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of the whole program on generated drone images.')
+    parser.add_argument('--counts', type=int, nargs='+', default=[4, 8], help='The numbers of images.')
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+', default=[(1920, 1080)], help='The resolutions, as WIDTHxHEIGHT.')
+    parser.add_argument('--grids', type=int, nargs='+', default=[30], help='The sizes of the grid (an x by x grid).')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2], help='The numbers of workers per pipeline stage (1 is always run as the baseline).')
+    parser.add_argument('--frame-workers', type=int, help='The number of threads each detect worker splits a frame across.')
+    parser.add_argument('--sample-stride', type=int, help='Estimate the hazards of each frame from every Nth pixel.')
+    parser.add_argument('--start-method', choices=multiprocessing.get_all_start_methods(), help='The multiprocessing start method of the workers.')
+    parser.add_argument('--repeats', type=int, default=1, help='The number of times each configuration is run.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the generated images.')
+    parser.add_argument('--artifacts', nargs='*', choices=ARTIFACT_KINDS, default=list(ARTIFACT_KINDS), help='The artifacts that are saved.')
+    parser.add_argument('--work-folder', help='Keep the corpora and outputs in this folder instead of a temporary one.')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of printing it.')
+    args = parser.parse_args()
+
+    report = benchmark(args.counts, args.resolutions, args.grids, args.workers, args.repeats, args.seed, args.artifacts,
+                       work_folder=args.work_folder, start_method=args.start_method, frame_workers=args.frame_workers,
+                       sample_stride=args.sample_stride)
+
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
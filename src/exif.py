@@ -0,0 +1,68 @@
+from PIL import Image
+
+GPS_IFD = 0x8825
+EXIF_IFD = 0x8769
+DATE_TIME_ORIGINAL = 0x9003
+DATE_TIME = 0x0132
+
+def read_gps_position(image_path):
+    '''
+    Reads the GPS position a drone image was taken at from its EXIF data, without decoding the image.
+
+    Parameters:
+        image_path (string): The path to the image.
+
+    Returns:
+        tuple: (latitude, longitude, altitude) in degrees and meters, or None if the image has no GPS position.
+    '''
+
+    with Image.open(image_path) as image:
+        return gps_position(read_exif(image))
+
+def read_exif(image):
+    '''
+    Reads the EXIF data of an open image without decoding its pixels. PNG.getexif decodes the whole image when the eXIf chunk is not
+    in the header, so for PNG only the eXIf chunk read with the header is used. The other formats keep their EXIF in the header.
+
+    Parameters:
+        image (PIL.Image): The open image.
+
+    Returns:
+        PIL.Image.Exif: The EXIF data, empty when there is none.
+    '''
+
+    if image.format != 'PNG':
+        return image.getexif()
+
+    exif = Image.Exif()
+    if image.info.get('exif'):
+        exif.load(image.info['exif'])
+    return exif
+
+def gps_position(exif):
+    '''
+    Reads the GPS position from the EXIF data of an image that is already open.
+
+    Parameters:
+        exif (PIL.Image.Exif): The EXIF data of the image.
+
+    Returns:
+        tuple: (latitude, longitude, altitude) in degrees and meters, or None if the image has no GPS position.
+    '''
+
+    gps = exif.get_ifd(GPS_IFD)
+    if 2 not in gps or 4 not in gps:
+        return None
+
+    def degrees(value, reference, negative):
+        degrees, minutes, seconds = (float(part) for part in value)
+        result = degrees + minutes / 60 + seconds / 3600
+        return -result if reference == negative else result
+
+    latitude = degrees(gps[2], gps.get(1, 'N'), 'S')
+    longitude = degrees(gps[4], gps.get(3, 'E'), 'W')
+    altitude = float(gps.get(6, 0.0))
+    if gps.get(5) in (1, b'\x01'):  # Below sea level
+        altitude = -altitude
+
+    return latitude, longitude, altitude
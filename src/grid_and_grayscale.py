@@ -1,4 +1,6 @@
-from PIL import Image, ImageDraw
+from grid_overlay import grid_overlay
+from PIL import Image
+import numpy as np
 
 class DefineGrayScale:
     '''
@@ -39,7 +41,10 @@ class DefineGrayScale:
     def process_image(self):
         '''
         Processes an image first into an 8-bit grayscale image, displays the grid directly on the image, and saves the final image into a 
-        16-bit grayscale to the specified file path.
+        16-bit grayscale to the specified file path. Nothing is saved when grayscale_path is None.
+
+        Returns:
+            PIL.Image: The 16-bit grayscale image.
         '''
         
         # Open the image directly as an 8-bit grayscale (L) image for easier manipulation
@@ -49,25 +54,15 @@ class DefineGrayScale:
         """
         # Open the image and convert to 8-bit grayscale ('L')
         image = Image.open(self.image_path).convert('L')
-        width, height = image.size
-
-        # Calculate cell dimensions
-        cell_width = width // self.grid_size[1]
-        cell_height = height // self.grid_size[0]
-
-        # Draw grid lines on the image
-        draw = ImageDraw.Draw(image)
 
-        # Draw horizontal grid lines
-        for i in range(1, self.grid_size[0]):
-            y = i * cell_height
-            draw.line([(0, y), (width, y)], fill=0)
-
-        # Draw vertical grid lines
-        for i in range(1, self.grid_size[1]):
-            x = i * cell_width
-            draw.line([(x, 0), (x, height)], fill=0)
+        # Draw the grid lines from the cached overlay of this image size
+        grayscale_array = np.array(image)
+        grid_overlay(image.size, self.grid_size).apply_grid_lines(grayscale_array)
+        image = Image.fromarray(grayscale_array)
 
         # Convert to 16-bit grayscale ('I;16') and save the output
         final_image = image.convert('I;16')
-        final_image.save(self.grayscale_path)
+        if self.grayscale_path:
+            final_image.save(self.grayscale_path)
+
+        return final_image
@@ -0,0 +1,247 @@
+from PIL import Image, ImageDraw
+import numpy as np
+import threading
+
+def blend(values, color, alpha):
+    '''
+    Blends 8-bit values with a color the way ImageDraw blends a translucent fill, rounding to the nearest value.
+
+    Parameters:
+        values (numpy array): The 8-bit values drawn over.
+        color (int): The 8-bit color drawn.
+        alpha (numpy array): The opacity of the color, from 0 to 255.
+
+    Returns:
+        numpy array: The blended 8-bit values.
+    '''
+
+    blended = values.astype(np.int32) * (255 - alpha) + color * alpha + 128
+    return ((blended + (blended >> 8)) >> 8).astype(np.uint8)
+
+# Blending a gray value with red at alpha 30, the same as drawing a (255, 0, 0, 30) rectangle
+TINT_RED = blend(np.arange(256), 255, 30)
+TINT_GREEN_BLUE = blend(np.arange(256), 0, 30)
+
+class GridOverlay:
+    '''
+    GridOverlay holds the parts of a grid annotation that are the same for every image of a given size and grid size: the grid lines,
+    the grid labels and the outlines of the smaller sub-grids. They are drawn once and kept as pixel indices, so annotating an image is
+    a few vectorized array operations whatever the number of grids. Use grid_overlay to get the cached overlay of a size.
+    '''
+
+    def __init__(self, image_size, grid_size):
+        '''
+        Initialize the class with the image size and grid size. The labels and outlines are drawn the first time they are needed.
+
+        Parameters:
+            image_size (tuple): (width, height) of the images in pixels.
+            grid_size (tuple): Number of grid cells (rows, columns).
+        '''
+
+        self.image_size = image_size
+        self.grid_size = grid_size
+        width, height = image_size
+        rows, cols = grid_size
+        self.cell_width = width // cols
+        self.cell_height = height // rows
+
+        # Grid lines of DefineGrayScale, every line spans the whole image
+        self.line_rows = np.arange(1, rows) * self.cell_height
+        self.line_cols = np.arange(1, cols) * self.cell_width
+
+        # The labels and outlines are only drawn once an image is annotated
+        self.outline_template = None
+        self.edge_pixels = None
+        self.edge_cells = None
+        self.edge_outlines = None
+        self.label_pixels = None
+        self.label_alpha = None
+        self.labels_inside = None
+        self.lock = threading.Lock()
+
+    def draw_layers(self):
+        '''
+        Draws the sub-grid outlines and the grid labels of every grid, if they have not been drawn yet.
+        '''
+
+        with self.lock:
+            if self.outline_template is not None:
+                return
+
+            width, height = self.image_size
+            rows, cols = self.grid_size
+            cell_height = self.cell_height
+            cell_width = self.cell_width
+
+            # Sub-grid outlines of one grid, relative to its top-left corner. A grid's rectangles include their right and bottom
+            # edges, so the template is one pixel larger than the grid
+            small_cell_height = cell_height // 4
+            small_cell_width = cell_width // 4
+            dy = np.arange(cell_height + 1)[:, None]
+            dx = np.arange(cell_width + 1)[None, :]
+            template = ((dy <= 4 * small_cell_height) & (dx <= 4 * small_cell_width)
+                        & ((dy % max(small_cell_height, 1) == 0) | (dx % max(small_cell_width, 1) == 0)))
+
+            # Pixels on the edges between grids are drawn over by up to four grids (the grids above-left, above, left and the
+            # pixel's own grid, in drawing order). They are kept with the grid and outline of each of those four draws
+            edge_height = min(height, rows * cell_height + 1)
+            edge_width = min(width, cols * cell_width + 1)
+            edge_rows = np.arange(0, edge_height, cell_height)
+            edge_cols = np.arange(0, edge_width, cell_width)
+            inner_rows = np.setdiff1d(np.arange(edge_height), edge_rows)
+            ys = np.concatenate([np.repeat(edge_rows, edge_width), np.repeat(inner_rows, len(edge_cols))])
+            xs = np.concatenate([np.tile(np.arange(edge_width), len(edge_rows)), np.tile(edge_cols, len(inner_rows))])
+            self.edge_pixels = ys * width + xs
+            self.edge_cells = np.full((4, len(xs)), -1, dtype=np.int64)
+            self.edge_outlines = np.zeros((4, len(xs)), dtype=bool)
+            row = ys // cell_height
+            col = xs // cell_width
+            for slot, (row_step, col_step) in enumerate(((1, 1), (1, 0), (0, 1), (0, 0))):
+                cell_row = row - row_step
+                cell_col = col - col_step
+                top = cell_row * cell_height
+                left = cell_col * cell_width
+                drawn = ((cell_row >= 0) & (cell_row < rows) & (cell_col >= 0) & (cell_col < cols)
+                         & (ys - top <= cell_height) & (xs - left <= cell_width))
+                self.edge_cells[slot, drawn] = cell_row[drawn] * cols + cell_col[drawn]
+                self.edge_outlines[slot, drawn] = template[ys[drawn] - top[drawn], xs[drawn] - left[drawn]]
+            self.outline_template = template
+
+            # Grid labels in the top-left corner of every grid, kept as the coverage of each pixel the text touches
+            labels = Image.new('L', self.image_size, 0)
+            draw = ImageDraw.Draw(labels)
+            label = 1
+            self.labels_inside = True
+            for row in range(rows):
+                for col in range(cols):
+                    left = col * cell_width + 5
+                    top = row * cell_height + 5
+                    draw.text((left, top), str(label), fill=255)
+                    # A label spilling out of its grid is drawn over by the next grids, which only drawing in order reproduces
+                    box = draw.textbbox((left, top), str(label))
+                    self.labels_inside &= box[2] < (col + 1) * cell_width and box[3] < (row + 1) * cell_height
+                    label += 1
+            labels = np.asarray(labels).ravel()
+            self.label_pixels = np.flatnonzero(labels)
+            self.label_alpha = labels[self.label_pixels].astype(np.int32)
+
+    def apply_grid_lines(self, grayscale_array):
+        '''
+        Draws the black grid lines on an 8-bit grayscale image in place.
+
+        Parameters:
+            grayscale_array (numpy array): The (height, width) grayscale pixels.
+        '''
+
+        grayscale_array[self.line_rows, :] = 0
+        grayscale_array[:, self.line_cols] = 0
+
+    def annotate(self, gray_image, red_mask):
+        '''
+        Annotates an image: the red grids get a red tint and their sub-grid outlines, and every grid gets its label.
+
+        Parameters:
+            gray_image (PIL.Image): The grayscale image, of the overlay's image size.
+            red_mask (numpy array): The (rows, columns) boolean mask of the red grids.
+
+        Returns:
+            PIL.Image: The annotated RGB image.
+        '''
+
+        gray = np.asarray(gray_image.convert('L'))
+        rows, cols = self.grid_size
+        red_mask = np.asarray(red_mask, dtype=bool)
+        self.draw_layers()
+        if not self.labels_inside:
+            return self.draw_in_order(gray_image, red_mask)
+
+        # Red tint (alpha 30) and sub-grid outlines over the pixels inside the red grids, each drawn by its own grid only
+        red = gray.copy()
+        green_blue = gray.copy()
+        red_rows, red_cols = np.nonzero(red_mask)
+        outlines = self.outline_template[:self.cell_height, :self.cell_width]
+        for channel, lookup in ((red, TINT_RED), (green_blue, TINT_GREEN_BLUE)):
+            cells = channel[:rows * self.cell_height, :cols * self.cell_width].reshape(rows, self.cell_height, cols, self.cell_width)
+            blocks = lookup[cells[red_rows, :, red_cols, :]]
+            blocks[:, outlines] = 0
+            cells[red_rows, :, red_cols, :] = blocks
+
+        # The edges between grids are drawn again by every grid whose rectangle includes them, in the order the grids are drawn
+        edge_red = gray.reshape(-1)[self.edge_pixels]
+        edge_green_blue = edge_red.copy()
+        for cells, outlined in zip(self.edge_cells, self.edge_outlines):
+            tinted = red_mask.ravel()[cells] & (cells >= 0)
+            edge_red[tinted] = TINT_RED[edge_red[tinted]]
+            edge_green_blue[tinted] = TINT_GREEN_BLUE[edge_green_blue[tinted]]
+            edge_red[tinted & outlined] = 0
+            edge_green_blue[tinted & outlined] = 0
+        red.reshape(-1)[self.edge_pixels] = edge_red
+        green_blue.reshape(-1)[self.edge_pixels] = edge_green_blue
+
+        # White labels blended by their coverage
+        for channel in (red, green_blue):
+            pixels = channel.reshape(-1)
+            pixels[self.label_pixels] = blend(pixels[self.label_pixels], 255, self.label_alpha)
+
+        # Green and blue stay equal, so the image is merged from two channels
+        green_blue = Image.fromarray(green_blue)
+        return Image.merge('RGB', (Image.fromarray(red), green_blue, green_blue))
+
+    def draw_in_order(self, gray_image, red_mask):
+        '''
+        Annotates an image by drawing every grid in turn, for grids too small to hold their labels.
+
+        Parameters:
+            gray_image (PIL.Image): The grayscale image, of the overlay's image size.
+            red_mask (numpy array): The (rows, columns) boolean mask of the red grids.
+
+        Returns:
+            PIL.Image: The annotated RGB image.
+        '''
+
+        rgb_image = gray_image.convert('RGB')
+        draw = ImageDraw.Draw(rgb_image, 'RGBA')
+        small_cell_height = self.cell_height // 4
+        small_cell_width = self.cell_width // 4
+        label = 1
+        for row in range(self.grid_size[0]):
+            for col in range(self.grid_size[1]):
+                top = row * self.cell_height
+                left = col * self.cell_width
+                if red_mask[row, col]:
+                    draw.rectangle([left, top, left + self.cell_width, top + self.cell_height], fill=(255, 0, 0, 30))
+                    for i in range(4):
+                        for j in range(4):
+                            small_top = top + i * small_cell_height
+                            small_left = left + j * small_cell_width
+                            draw.rectangle([small_left, small_top, small_left + small_cell_width, small_top + small_cell_height],
+                                           outline="black")
+                draw.text((left + 5, top + 5), str(label), fill="white")
+                label += 1
+        return rgb_image
+
+overlays = {}  # Cached overlays keyed by (image size, grid size)
+overlays_lock = threading.Lock()
+
+def grid_overlay(image_size, grid_size, max_cached=8):
+    '''
+    Returns the overlay of the given image size and grid size, drawing it the first time it is needed.
+
+    Parameters:
+        image_size (tuple): (width, height) of the images in pixels.
+        grid_size (tuple): Number of grid cells (rows, columns).
+        max_cached (int): The number of overlays kept, the oldest one is dropped when there are more.
+
+    Returns:
+        GridOverlay: The cached overlay.
+    '''
+
+    key = (tuple(image_size), tuple(grid_size))
+    with overlays_lock:
+        overlay = overlays.get(key)
+        if overlay is None:
+            overlay = GridOverlay(*key)
+            if len(overlays) >= max_cached:
+                overlays.pop(next(iter(overlays)))
+            overlays[key] = overlay
+    return overlay
@@ -0,0 +1,257 @@
+from red_hazards import IdentifyHazards
+import numpy as np
+import os
+import struct
+
+MAGIC = b'HZM1'
+HEADER = struct.Struct('<4sHHIIII')  # Magic, rows, columns, cell width, cell height, image width, image height
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def pack_hazard_mask(mask):
+    '''
+    Packs a boolean grid mask into bits, row by row.
+
+    Parameters:
+        mask (numpy array): The (rows, columns) mask of the red grids.
+
+    Returns:
+        numpy array: The packed bits as uint8, 1 byte per 8 grids.
+    '''
+
+    return np.packbits(np.asarray(mask, dtype=bool).ravel())
+
+def unpack_hazard_mask(packed, grid_size):
+    '''
+    Unpacks the bits of a grid mask.
+
+    Parameters:
+        packed (numpy array): The packed bits, or a stack of them along the first axes.
+        grid_size (tuple): Number of grid cells (rows, columns).
+
+    Returns:
+        numpy array: The boolean mask shaped (..., rows, columns).
+    '''
+
+    packed = np.asarray(packed, dtype=np.uint8)
+    count = grid_size[0] * grid_size[1]
+    bits = np.unpackbits(packed, axis=-1, count=count)
+    return bits.astype(bool).reshape(packed.shape[:-1] + tuple(grid_size))
+
+def save_hazard_mask(path, potential_hazards, image_size):
+    '''
+    Saves the red grids of an image as a bit-packed mask with its grid metadata, a 30 x 30 grid takes 137 bytes.
+
+    Parameters:
+        path (string): The path of the mask file (.hzm).
+        potential_hazards (IdentifyHazards): The identified potential hazards.
+        image_size (tuple): (width, height) of the image in pixels.
+    '''
+
+    rows, cols = potential_hazards.grid_size
+    mask = np.zeros(rows * cols, dtype=bool)
+    mask[np.asarray(potential_hazards.red_grids_list(), dtype=np.intp) - 1] = True
+
+    header = HEADER.pack(MAGIC, rows, cols, potential_hazards.cell_width, potential_hazards.cell_height, *image_size)
+    with open(path, 'wb') as mask_file:
+        mask_file.write(header + pack_hazard_mask(mask).tobytes())
+
+def load_hazard_mask(path):
+    '''
+    Loads a mask saved by save_hazard_mask.
+
+    Parameters:
+        path (string): The path of the mask file.
+
+    Returns:
+        dict: The grid_size, cell_size, image_size and packed bits of the mask.
+    '''
+
+    with open(path, 'rb') as mask_file:
+        data = mask_file.read()
+
+    magic, rows, cols, cell_width, cell_height, width, height = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a hazard mask.")
+
+    return {
+        'grid_size': (rows, cols),
+        'cell_size': (cell_width, cell_height),
+        'image_size': (width, height),
+        'packed': np.frombuffer(data, dtype=np.uint8, offset=HEADER.size),
+    }
+
+def hazards_from_mask(mask, grid_size, cell_size):
+    '''
+    Builds an IdentifyHazards holding the red grids of a mask, so the mask can be planned like a processed image.
+
+    Parameters:
+        mask (numpy array): The (rows, columns) mask of the red grids.
+        grid_size (tuple): Number of grid cells (rows, columns).
+        cell_size (tuple): (width, height) of a grid cell in pixels.
+
+    Returns:
+        IdentifyHazards: The red grids of the mask.
+    '''
+
+    potential_hazards = IdentifyHazards(None, None, grid_size=grid_size)
+    potential_hazards.cell_width, potential_hazards.cell_height = cell_size
+    rows, cols = np.nonzero(mask)
+    potential_hazards.red_grids = (rows * grid_size[1] + cols + 1).tolist()
+    potential_hazards.red_grids_coords = [
+        {"label": label, "center": ((2 * col + 1) * cell_size[0] // 2, (2 * row + 1) * cell_size[1] // 2)}
+        for label, row, col in zip(potential_hazards.red_grids, rows.tolist(), cols.tolist())
+    ]
+    potential_hazards.red_grid_count = len(potential_hazards.red_grids)
+    return potential_hazards
+
+class SurveyArchive:
+    '''
+    SurveyArchive holds the hazard masks of the same frames over many surveys of a site, stacked as packed bits per frame. Finding the
+    new, resolved and persistent red grids between surveys is a bitwise operation on the packed bytes, for all surveys at once.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize an empty archive.
+        '''
+
+        self.surveys = []  # Survey ids, in the order they were added
+        self.frames = {}  # Frame name -> its grid metadata and its packed masks, one row per survey
+
+    def add_survey(self, survey_id, folder):
+        '''
+        Adds the masks of a survey, one .hzm file per frame. A frame missing from a survey has no red grids in it.
+
+        Parameters:
+            survey_id (string): The id of the survey (e.g. its date).
+            folder (string): The folder holding the survey's masks.
+        '''
+
+        masks = {}
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith('.hzm'):
+                masks[os.path.splitext(filename)[0]] = load_hazard_mask(os.path.join(folder, filename))
+        self.add_masks(survey_id, masks)
+
+    def add_masks(self, survey_id, masks):
+        '''
+        Adds the masks of a survey that are already loaded. A frame's masks must have the same grid and cell size in every survey.
+
+        Parameters:
+            survey_id (string): The id of the survey.
+            masks (dict): Maps each frame name to a mask loaded by load_hazard_mask.
+        '''
+
+        # Every mask is checked before any is added, so a bad survey leaves the archive unchanged
+        for name, mask in masks.items():
+            rows, cols = mask['grid_size']
+            if mask['packed'].size != -(-rows * cols // 8):
+                raise ValueError(f"{name} has {mask['packed'].size} bytes of mask in {survey_id}, its {mask['grid_size']} grid needs "
+                                 f"{-(-rows * cols // 8)}.")
+            frame = self.frames.get(name)
+            if frame is None:
+                continue
+            if frame['grid_size'] != mask['grid_size']:
+                raise ValueError(f"{name} has a {mask['grid_size']} grid in {survey_id} instead of {frame['grid_size']}.")
+            if frame['cell_size'] != mask['cell_size']:
+                raise ValueError(f"{name} has {mask['cell_size']} cells in {survey_id} instead of {frame['cell_size']}.")
+
+        index = len(self.surveys)
+        self.surveys.append(survey_id)
+
+        for name, mask in masks.items():
+            frame = self.frames.get(name)
+            if frame is None:
+                frame = self.frames[name] = {
+                    'grid_size': mask['grid_size'],
+                    'cell_size': mask['cell_size'],
+                    'image_size': mask['image_size'],
+                    'packed': np.zeros((index, mask['packed'].size), dtype=np.uint8),
+                }
+            frame['packed'] = np.vstack((frame['packed'], mask['packed'][None, :]))
+
+        # Frames missing from this survey get an empty mask
+        for frame in self.frames.values():
+            if frame['packed'].shape[0] == index:
+                frame['packed'] = np.vstack((frame['packed'], np.zeros((1, frame['packed'].shape[1]), dtype=np.uint8)))
+
+    def changes(self, frame_name, before, after):
+        '''
+        Compares the red grids of a frame between two surveys.
+
+        Parameters:
+            frame_name (string): The name of the frame.
+            before (string): The id of the earlier survey.
+            after (string): The id of the later survey.
+
+        Returns:
+            dict: The (rows, columns) masks of the new, resolved and persistent red grids.
+        '''
+
+        frame = self.frames[frame_name]
+        old = frame['packed'][self.surveys.index(before)]
+        new = frame['packed'][self.surveys.index(after)]
+        return {
+            'new': unpack_hazard_mask(new & ~old, frame['grid_size']),
+            'resolved': unpack_hazard_mask(old & ~new, frame['grid_size']),
+            'persistent': unpack_hazard_mask(old & new, frame['grid_size']),
+        }
+
+    def change_counts(self, frame_name):
+        '''
+        Counts the new, resolved and persistent red grids of a frame between every pair of consecutive surveys at once.
+
+        Parameters:
+            frame_name (string): The name of the frame.
+
+        Returns:
+            dict: Arrays with one count per pair of consecutive surveys.
+        '''
+
+        packed = self.frames[frame_name]['packed']
+        old, new = packed[:-1], packed[1:]
+        return {
+            'new': POPCOUNT[new & ~old].sum(axis=-1, dtype=np.int64),
+            'resolved': POPCOUNT[old & ~new].sum(axis=-1, dtype=np.int64),
+            'persistent': POPCOUNT[old & new].sum(axis=-1, dtype=np.int64),
+        }
+
+    def persistence(self, frame_name):
+        '''
+        Returns how many surveys flagged each grid of a frame.
+
+        Parameters:
+            frame_name (string): The name of the frame.
+
+        Returns:
+            numpy array: The (rows, columns) number of surveys.
+        '''
+
+        frame = self.frames[frame_name]
+        return unpack_hazard_mask(frame['packed'], frame['grid_size']).sum(axis=0)
+
+    def replan(self, frame_name, before, after, drone_capacity=None):
+        '''
+        Plans drone paths over the red grids of a frame that are new since an earlier survey only. The frame's grid must be square, 
+        like every grid plan_drone_paths plans.
+
+        Parameters:
+            frame_name (string): The name of the frame.
+            before (string): The id of the earlier survey.
+            after (string): The id of the later survey.
+            drone_capacity (float): The number of red grids a single drone can cover. Defaults to main.DRONE_CAPACITY.
+
+        Returns:
+            ClusterPathPlanner: The planned paths, or None if nothing is new.
+        '''
+
+        # main saves the masks through this module, so it is imported here
+        from main import plan_drone_paths, DRONE_CAPACITY
+
+        frame = self.frames[frame_name]
+        rows, cols = frame['grid_size']
+        if rows != cols:
+            raise ValueError(f"{frame_name} has a {rows} x {cols} grid, only square grids can be planned.")
+        new = self.changes(frame_name, before, after)['new']
+        potential_hazards = hazards_from_mask(new, frame['grid_size'], frame['cell_size'])
+        return plan_drone_paths(potential_hazards, frame['grid_size'][0], drone_capacity or DRONE_CAPACITY)
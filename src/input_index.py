@@ -0,0 +1,130 @@
+from exif import gps_position, read_exif, EXIF_IFD, DATE_TIME_ORIGINAL, DATE_TIME
+from PIL import Image, UnidentifiedImageError
+from datetime import datetime
+import heapq
+import os
+
+class InputIndex:
+    '''
+    InputIndex scans an input folder by reading only the header and EXIF data of each image (its dimensions, timestamp and GPS position)
+    and the file size, without decoding any pixels. Files that are not readable images are skipped up front. The runtime of an image
+    grows with its number of pixels, so the index can order the work longest first and estimate how long the batch will take.
+    '''
+
+    def __init__(self, image_folder, extensions=('.png',), seconds_per_image=0.5, seconds_per_megapixel=0.5):
+        '''
+        Initialize the class with the folder to index and the cost model of an image.
+
+        Parameters:
+            image_folder (string): The path to the folder where the raw drone images are contained.
+            extensions (tuple): The file extensions to index, in lower case.
+            seconds_per_image (float): The fixed time spent on every image.
+            seconds_per_megapixel (float): The time spent per million pixels of an image.
+        '''
+
+        self.image_folder = image_folder
+        self.extensions = extensions
+        self.seconds_per_image = seconds_per_image
+        self.seconds_per_megapixel = seconds_per_megapixel
+        self.entries = []  # One entry per readable image
+        self.skipped = {}  # Filename -> why it was skipped
+
+    def scan(self):
+        '''
+        Reads the metadata of every image in the folder.
+
+        Returns:
+            list: The entries of the readable images, each a dict with the filename, path, width, height, file_size, timestamp (a
+                datetime, from EXIF or the file's modification time) and gps ((latitude, longitude, altitude) or None).
+        '''
+
+        self.entries = []
+        self.skipped = {}
+        with os.scandir(self.image_folder) as directory:
+            for item in sorted(directory, key=lambda item: item.name):
+                if not item.is_file() or not item.name.lower().endswith(self.extensions):
+                    continue
+
+                try:
+                    entry = self.read_entry(item)
+                except (UnidentifiedImageError, OSError, ValueError) as error:
+                    self.skipped[item.name] = str(error)
+                    continue
+                self.entries.append(entry)
+
+        return self.entries
+
+    def read_entry(self, item):
+        '''
+        Reads the metadata of one image. Only the header is parsed (see read_exif), the pixels are never decoded.
+
+        Parameters:
+            item (os.DirEntry): The file of the image.
+
+        Returns:
+            dict: The entry of the image.
+        '''
+
+        stat = item.stat()
+        with Image.open(item.path) as image:
+            width, height = image.size
+            exif = read_exif(image)
+            gps = gps_position(exif)
+            taken = exif.get_ifd(EXIF_IFD).get(DATE_TIME_ORIGINAL) or exif.get(DATE_TIME)
+
+        timestamp = datetime.fromtimestamp(stat.st_mtime)
+        if taken:
+            try:
+                timestamp = datetime.strptime(str(taken).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+            except ValueError:
+                pass
+
+        return {
+            'filename': item.name,
+            'path': item.path,
+            'width': width,
+            'height': height,
+            'file_size': stat.st_size,
+            'timestamp': timestamp,
+            'gps': gps,
+        }
+
+    def estimated_seconds(self, entry):
+        '''
+        Estimates the time spent processing an image from its number of pixels.
+
+        Parameters:
+            entry (dict): The entry of the image.
+
+        Returns:
+            float: The estimated seconds.
+        '''
+
+        return self.seconds_per_image + self.seconds_per_megapixel * entry['width'] * entry['height'] / 1e6
+
+    def schedule(self):
+        '''
+        Orders the images longest first, so that with several workers the largest images start early and no straggler is left for
+        the end of the batch.
+
+        Returns:
+            list: The entries, longest first.
+        '''
+
+        return sorted(self.entries, key=self.estimated_seconds, reverse=True)
+
+    def estimate_makespan(self, workers=1):
+        '''
+        Estimates how long the batch takes by handing the images, longest first, to whichever worker is free first.
+
+        Parameters:
+            workers (int): The number of images processed at the same time.
+
+        Returns:
+            float: The estimated seconds until the last image is done.
+        '''
+
+        finish_times = [0.0] * max(1, workers)
+        for entry in self.schedule():
+            heapq.heappush(finish_times, heapq.heappop(finish_times) + self.estimated_seconds(entry))
+        return max(finish_times)
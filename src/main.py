@@ -1,18 +1,23 @@
 from grid_and_grayscale import DefineGrayScale
-from red_hazards import IdentifyHazards
-from neighbors import IdentifyNeighbors
+from red_hazards import IdentifyHazards, reduce_bands
+from neighbors import IdentifyNeighbors, flag_mask
 from path_planning import ClusterPathPlanner
+from artifact_writer import ArtifactWriter
+from hazard_masks import save_hazard_mask
+from input_index import InputIndex
 from PIL import Image
 import numpy as np
 import os
-import math
+
+# The workload (in red grids) a single drone covers in one flight, 75% of its 40 grid budget
+DRONE_CAPACITY = 0.75 * 40
 
 def check_directory_exists(directory):
     '''Ensure the directory exists, create it if it doesn't.'''
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-def process_image_files(image_folder, grayscale_folder, potential_hazards_folder, grid_coords_folder, drone_paths_folder, row_and_column_grids):
+def process_image_files(image_folder, grayscale_folder, potential_hazards_folder, grid_coords_folder, drone_paths_folder, row_and_column_grids, writer=None, drone_capacity=DRONE_CAPACITY, site_map=None, workers=None, sample_stride=None):
     '''
     Calls each method to process an image, identify hazards, and generate a path plan for each drone.
     
@@ -24,6 +29,12 @@ def process_image_files(image_folder, grayscale_folder, potential_hazards_folder
         drone_paths_folder (string): The path to the folder where the drone's path is saved to.
         row_and_column_grids (int): The size of the grid (an x by x grid).
         number_of_groups (int): The number of groups an image contains.
+        writer (ArtifactWriter): Saves the output images in the background. A default writer is created (and flushed before returning) 
+            when it is None.
+        drone_capacity (float): The number of red grids a single drone can cover. The number of drones is derived from it.
+        site_map (SiteHazardMap): The site-wide map the red grids of every image are merged into, if any.
+        workers (int): The number of threads the hazards of a single image are detected with (see detect_hazards).
+        sample_stride (int): When set, the hazards of every image are estimated from a sample of its pixels (see detect_hazards).
     '''
     
     # Check if output directories exist
@@ -32,97 +43,203 @@ def process_image_files(image_folder, grayscale_folder, potential_hazards_folder
     check_directory_exists(grid_coords_folder)
     check_directory_exists(drone_paths_folder)
 
-    for filename in os.listdir(image_folder):
-        if filename.lower().endswith('.png'):
-            image_path = os.path.join(image_folder, filename)
-            grayscale_path = os.path.join(grayscale_folder, filename)
-            potential_hazards_path = os.path.join(potential_hazards_folder, filename)
-            basename, extension = os.path.splitext(filename)
-            txt_file = f'{basename}.txt'
-            gif_file = f'{basename}.gif'
-            grid_coords_path = os.path.join(grid_coords_folder, txt_file)
-            drone_paths = os.path.join(drone_paths_folder, filename)
-            drone_path_gifs = os.path.join(drone_paths_folder, gif_file)
-
-            # Process grayscale
-            grayscale = DefineGrayScale(image_path, grayscale_path, grid_size=(row_and_column_grids, row_and_column_grids))
-            grayscale.process_image()  # Ensure DefineGrayScale does the grayscale conversion
-
-            # Calculate dynamic thresholds
-            min_threshold, max_threshold = calculate_dynamic_thresholds(grayscale_path)
-
-            # Identify hazards with the dynamically calculated thresholds
-            potential_hazards = IdentifyHazards(
-                grayscale_path,
-                potential_hazards_path,
-                grid_size=(row_and_column_grids, row_and_column_grids),
-                min_threshold=min_threshold,
-                max_threshold=max_threshold
-            )
-
-            potential_hazards.highlight_grids()
-            num_red_grids = potential_hazards.count_red_grids()  
-            print(f"{filename}: Number of red grids: {num_red_grids}")  
-            grid_coords = potential_hazards.grid_info()
-            grid_coords_dictionary = {item['label']: item['center'] for item in grid_coords}
-
-            with open(grid_coords_path, "w") as text_file:
-                for key, value in grid_coords_dictionary.items():
-                    text_file.write(f"{key}: {value}\n")
-            
-            red_grids = potential_hazards.red_grids_list()
-
-            neighbors = IdentifyNeighbors((row_and_column_grids, row_and_column_grids), red_grids)
-
-            # Convert red grids to a set for quick filtering
-            valid_numbers = set(red_grids)
-            processed = set()  # Track visited numbers and avoid duplicate sets
-            connected_sets = {}  # Store connected sets
-            label_counter = 1  # Start from 1
-
-            for number in red_grids:
-                if number not in processed:
-                    connected_set = neighbors.compute_connected_set(number, row_and_column_grids, valid_numbers)
-                    
-                    label = label_counter
-                    connected_sets[label] = connected_set
-                    
-                    label_counter += 1
-                    
-                    processed.update(connected_set)
-
-            # Output results
-            list_of_clusters = []
-            for label, connected_set in connected_sets.items():
-                list_of_clusters.append(connected_set)  # Add the entire connected set to the list
-
-            cluster_centers = {}
-            key = 1
-
-            for set_ in list_of_clusters:
-                # Get the first element from the set (in this case the smallest element)
-                first_element = min(set_)
-                
-                # If the element exists in the input_dict, add it to the new dictionary
-                if first_element in grid_coords_dictionary:
-                    cluster_centers[key] = grid_coords_dictionary[first_element]
-                    key += 1 
-
-            number_of_groups = math.ceil(num_red_grids/(0.75*40))
-            print(cluster_centers)
-            if len(cluster_centers) < number_of_groups:
-                number_of_groups = len(cluster_centers)
-            path_planner = ClusterPathPlanner(cluster_centers, number_of_groups)
-            path_planner.split_clusters()
-            path_planner.plan_paths()
-            path_planner.print_paths()
-            defined_paths = path_planner.plot_paths(f'{potential_hazards_folder}/{filename}', f'{drone_paths_folder}/{filename}')
-            path_planner.animate_paths(save_to=drone_path_gifs)
-
-
-            # Ensure the drone_paths folder exists before saving the plot
-            check_directory_exists(drone_paths_folder)
-            # defined_paths.savefig(drone_paths)
+    owns_writer = writer is None
+    if owns_writer:
+        writer = ArtifactWriter()
+
+    # Only the image headers are read up front, the largest images go first
+    index = InputIndex(image_folder)
+    index.scan()
+    for filename, reason in index.skipped.items():
+        print(f"Skipping {filename}: {reason}")
+    print(f"{len(index.entries)} images, estimated {index.estimate_makespan():.0f} seconds")
+
+    try:
+        for entry in index.schedule():
+            process_image_file(entry['filename'], image_folder, grayscale_folder, potential_hazards_folder, grid_coords_folder,
+                               drone_paths_folder, row_and_column_grids, writer, drone_capacity, site_map, workers, sample_stride)
+    finally:
+        if owns_writer:
+            writer.close()
+
+def process_image_file(filename, image_folder, grayscale_folder, potential_hazards_folder, grid_coords_folder, drone_paths_folder, row_and_column_grids, writer, drone_capacity=DRONE_CAPACITY, site_map=None, workers=None, sample_stride=None):
+    '''
+    Processes a single image from the image folder, identifies its hazards, and generates a path plan for each drone. The output images 
+    are handed to the writer instead of being saved here. Each step is its own function so they can also run as separate pipeline 
+    stages (see pipeline.py).
+
+    Parameters:
+        filename (string): The name of the image in the image folder.
+        writer (ArtifactWriter): Saves the output images in the background.
+        The other parameters are the same as process_image_files.
+    '''
+
+    image_path = os.path.join(image_folder, filename)
+
+    grayscale_image = decode_image(image_path, row_and_column_grids)
+    potential_hazards = detect_hazards(grayscale_image, row_and_column_grids, sample_stride, workers)
+    print(f"{filename}: Number of red grids: {potential_hazards.count_red_grids()}")
+    if site_map is not None:
+        site_map.add_frame(image_path, potential_hazards, grayscale_image.size)
+    path_planner = plan_drone_paths(potential_hazards, row_and_column_grids, drone_capacity)
+    if path_planner is None:
+        print(f"{filename}: No clusters to plan paths for")
+    render_outputs(filename, grayscale_folder, potential_hazards_folder, grid_coords_folder, drone_paths_folder,
+                   grayscale_image, potential_hazards, path_planner, writer)
+
+def decode_image(image_path, row_and_column_grids):
+    '''
+    Decodes a raw drone image into the 16-bit grayscale image with grid lines used by the rest of the program.
+
+    Parameters:
+        image_path (string): The path to the raw drone image.
+        row_and_column_grids (int): The size of the grid (an x by x grid).
+
+    Returns:
+        PIL.Image: The 16-bit grayscale image.
+    '''
+
+    grayscale = DefineGrayScale(image_path, None, grid_size=(row_and_column_grids, row_and_column_grids))
+    return grayscale.process_image()  # Ensure DefineGrayScale does the grayscale conversion
+
+def detect_hazards(grayscale_image, row_and_column_grids, sample_stride=None, workers=None):
+    '''
+    Identifies the red grids of a grayscale image with dynamically calculated thresholds. Nothing is drawn or saved.
+
+    Parameters:
+        grayscale_image (PIL.Image): The 16-bit grayscale image.
+        row_and_column_grids (int): The size of the grid (an x by x grid).
+        sample_stride (int): When set, the brightness and the grid statistics are estimated from a sample of the pixels (see 
+            calculate_adjustment_factor and IdentifyHazards.compute_approximate_cell_std) for a faster triage.
+        workers (int): When set, the brightness and the grid statistics of the image are computed by this many threads (see 
+            calculate_adjustment_factor and IdentifyHazards.compute_cell_std), for very large frames.
+
+    Returns:
+        IdentifyHazards: The identified potential hazards.
+    '''
+
+    # Calculate dynamic thresholds
+    min_threshold, max_threshold = calculate_dynamic_thresholds(None, image=grayscale_image, sample_stride=sample_stride, workers=workers)
+
+    # Identify hazards with the dynamically calculated thresholds
+    potential_hazards = IdentifyHazards(
+        None,
+        None,
+        grid_size=(row_and_column_grids, row_and_column_grids),
+        min_threshold=min_threshold,
+        max_threshold=max_threshold,
+        sample_stride=sample_stride,
+        workers=workers
+    )
+    potential_hazards.identify_grids(image=grayscale_image)
+    return potential_hazards
+
+def plan_drone_paths(potential_hazards, row_and_column_grids, drone_capacity=DRONE_CAPACITY):
+    '''
+    Groups the red grids into connected clusters and plans a path through them for each drone.
+
+    Parameters:
+        potential_hazards (IdentifyHazards): The identified potential hazards.
+        row_and_column_grids (int): The size of the grid (an x by x grid).
+        drone_capacity (float): The number of red grids a single drone can cover.
+
+    Returns:
+        ClusterPathPlanner: The planned paths, or None if there are no clusters.
+    '''
+
+    red_grids = potential_hazards.red_grids_list()
+
+    neighbors = IdentifyNeighbors((row_and_column_grids, row_and_column_grids), red_grids)
+
+    # Convert red grids to a set for quick filtering
+    valid_numbers = set(red_grids)
+    valid_mask = flag_mask(valid_numbers, row_and_column_grids * row_and_column_grids)  # Built once for every connected set
+    processed = set()  # Track visited numbers and avoid duplicate sets
+    connected_sets = {}  # Store connected sets
+    label_counter = 1  # Start from 1
+
+    for number in red_grids:
+        if number not in processed:
+            connected_set = neighbors.compute_connected_set(number, row_and_column_grids, valid_mask)
+
+            label = label_counter
+            connected_sets[label] = connected_set
+
+            label_counter += 1
+
+            processed.update(connected_set)
+
+    # Output results
+    list_of_clusters = []
+    for label, connected_set in connected_sets.items():
+        list_of_clusters.append(connected_set)  # Add the entire connected set to the list
+
+    # Compute the statistics of every cluster at once, each cluster's centroid becomes its waypoint
+    labels = neighbors.cluster_labels(list_of_clusters, potential_hazards.grid_size)
+    cluster_statistics = neighbors.cluster_statistics(
+        labels,
+        (potential_hazards.cell_width, potential_hazards.cell_height),
+        potential_hazards.cell_std
+    )
+
+    if len(cluster_statistics['label']) == 0:
+        return None
+
+    # Each drone gets a compact group of clusters whose area fits its capacity, the number of drones follows from it
+    path_planner = ClusterPathPlanner.from_cluster_statistics(cluster_statistics, 0)
+    print(path_planner.centroids)
+    path_planner.split_clusters_balanced(drone_capacity)
+    path_planner.plan_paths()
+    path_planner.print_paths()
+    return path_planner
+
+def render_outputs(filename, grayscale_folder, potential_hazards_folder, grid_coords_folder, drone_paths_folder, grayscale_image, potential_hazards, path_planner, writer):
+    '''
+    Writes the red grid coordinates and renders the output images of a processed image, handing them to the writer.
+
+    Parameters:
+        filename (string): The name of the image in the image folder.
+        grayscale_image (PIL.Image): The 16-bit grayscale image.
+        potential_hazards (IdentifyHazards): The identified potential hazards.
+        path_planner (ClusterPathPlanner): The planned paths, or None if there are no clusters.
+        writer (ArtifactWriter): Saves the output images in the background.
+        The folder parameters are the same as process_image_files.
+    '''
+
+    grayscale_path = os.path.join(grayscale_folder, filename)
+    potential_hazards_path = os.path.join(potential_hazards_folder, filename)
+    basename, extension = os.path.splitext(filename)
+    txt_file = f'{basename}.txt'
+    mask_file = f'{basename}.hzm'
+    gif_file = f'{basename}.gif'
+    grid_coords_path = os.path.join(grid_coords_folder, txt_file)
+    drone_paths = os.path.join(drone_paths_folder, filename)
+    drone_path_gifs = os.path.join(drone_paths_folder, gif_file)
+
+    grid_coords = potential_hazards.grid_info()
+    grid_coords_dictionary = {item['label']: item['center'] for item in grid_coords}
+
+    with open(grid_coords_path, "w") as text_file:
+        for key, value in grid_coords_dictionary.items():
+            text_file.write(f"{key}: {value}\n")
+
+    # The red grids are also kept as a bit-packed mask, for comparing surveys of the same site
+    save_hazard_mask(os.path.join(grid_coords_folder, mask_file), potential_hazards, grayscale_image.size)
+
+    # The images stay in memory and are saved by the writer in the background
+    writer.submit('grayscale', grayscale_path, grayscale_image)
+    hazards_image = None
+    if writer.is_enabled('hazards') or writer.is_enabled('route'):
+        hazards_image = potential_hazards.draw_grids(grayscale_image)
+        writer.submit('hazards', potential_hazards_path, hazards_image)
+
+    if path_planner is None:
+        return
+    if writer.is_enabled('route'):
+        defined_paths = path_planner.plot_paths(hazards_image)
+        writer.submit('route', drone_paths, defined_paths, dpi=(300, 300))
+    if writer.is_enabled('animation'):
+        path_planner.animate_paths(save_to=drone_path_gifs, writer=writer)
 
 def main():
     image_folder = 'drone_images'
@@ -135,16 +252,13 @@ def main():
 
     process_image_files(image_folder, grayscale_folder, potential_hazards_folder, grid_coords_folder, drone_paths_folder, row_and_column_grids)
 
-def calculate_dynamic_thresholds(grayscale_path, base_min=10000, base_max=20000):
-    # Load the grayscale image
-    image = Image.open(grayscale_path).convert('I')  # 'I' for 16-bit grayscale
-    image_array = np.array(image)
-
-    # Calculate the average brightness (scaled to 0-65535 for 16-bit)
-    avg_brightness = np.mean(image_array)
+def calculate_dynamic_thresholds(grayscale_path, base_min=10000, base_max=20000, image=None, sample_stride=None, workers=None):
+    # Load the grayscale image, unless it is already in memory
+    if image is None:
+        image = Image.open(grayscale_path)
 
     # Adjust min and max thresholds based on brightness
-    adjustment_factor = avg_brightness / 65535  # Normalize to 0-1
+    adjustment_factor = calculate_adjustment_factor(image, sample_stride, workers)
 
     # Calculate dynamic min and max thresholds
     min_threshold = int(base_min * (1 - adjustment_factor))
@@ -152,5 +266,61 @@ def calculate_dynamic_thresholds(grayscale_path, base_min=10000, base_max=20000)
 
     return min_threshold, max_threshold
 
+def calculate_adjustment_factor(image, sample_stride=None, workers=None):
+    '''
+    Returns the average brightness of a grayscale image normalized to 0-1, which the dynamic thresholds are lowered by.
+
+    Parameters:
+        image (PIL.Image): The grayscale image.
+        sample_stride (int): When set, the brightness is averaged over every sample_stride-th pixel in both directions instead of 
+            every pixel.
+        workers (int): When set, the rows of the image are split into bands that are summed by a thread each (see 
+            red_hazards.reduce_bands).
+
+    Returns:
+        float: The adjustment factor.
+    '''
+
+    # Grayscale pixels are read in place, other images are converted to 'I' (32-bit) grayscale first
+    if image.mode not in ('I;16', 'I', 'L'):
+        image = image.convert('I')
+    image_array = np.asarray(image)
+    if sample_stride and sample_stride > 1:
+        image_array = image_array[sample_stride // 2::sample_stride, sample_stride // 2::sample_stride]
+
+    # Calculate the average brightness (scaled to 0-65535 for 16-bit)
+    band_sums = reduce_bands(lambda band: image_array[band].sum(dtype=np.float64), image_array.shape[0], workers)
+    avg_brightness = sum(band_sums) / image_array.size
+
+    return avg_brightness / 65535  # Normalize to 0-1
+
+def sweep_dynamic_thresholds(grayscale_image, row_and_column_grids, base_mins, base_maxs):
+    '''
+    Evaluates every pair of base thresholds of calculate_dynamic_thresholds on one grayscale image, to calibrate the thresholds of a 
+    new site. The grid statistics are computed once and every pair is evaluated at once, nothing is drawn or saved.
+
+    Parameters:
+        grayscale_image (PIL.Image): The 16-bit grayscale image (see decode_image).
+        row_and_column_grids (int): The size of the grid (an x by x grid).
+        base_mins (list): The base minimum thresholds to try.
+        base_maxs (list): The base maximum thresholds to try.
+
+    Returns:
+        dict: The sweep of IdentifyHazards.sweep_thresholds on the dynamic thresholds, plus the base_min and base_max of each pair.
+    '''
+
+    adjustment_factor = calculate_adjustment_factor(grayscale_image)
+
+    potential_hazards = IdentifyHazards(None, None, grid_size=(row_and_column_grids, row_and_column_grids))
+    potential_hazards.compute_cell_std(np.asarray(grayscale_image.convert('I;16')))
+
+    # Truncated the same way as calculate_dynamic_thresholds
+    min_thresholds = (np.asarray(base_mins, dtype=np.float64) * (1 - adjustment_factor)).astype(int)
+    max_thresholds = (np.asarray(base_maxs, dtype=np.float64) * (1 - adjustment_factor)).astype(int)
+
+    sweep = potential_hazards.sweep_thresholds(min_thresholds, max_thresholds)
+    sweep['base_min'], sweep['base_max'] = np.meshgrid(np.asarray(base_mins), np.asarray(base_maxs), indexing='ij')
+    return sweep
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,3 +1,89 @@
+import numpy as np
+import threading
+
+# Offsets (row, column) of the neighbors of a grid
+NEIGHBOR_OFFSETS = {
+    4: ((-1, 0), (0, -1), (0, 1), (1, 0)),
+    8: ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)),
+}
+
+adjacency_tables = {}  # Cached tables keyed by (grid size, connectivity)
+adjacency_lock = threading.Lock()
+
+def grid_shape(b):
+    '''Returns the (rows, columns) of a grid given as b (a b x b grid) or as (rows, columns).'''
+
+    if isinstance(b, (tuple, list)):
+        return int(b[0]), int(b[1])
+    return int(b), int(b)
+
+def adjacency_table(grid_size, connectivity=8):
+    '''
+    Returns the neighbors of every grid of a grid size in compressed sparse row form: the neighbors of the grid at index i (its number 
+    minus 1, row by row) are indices[offsets[i]:offsets[i + 1]]. The table is built once per grid size and connectivity.
+
+    Parameters:
+        grid_size (tuple): Number of grid cells (rows, columns).
+        connectivity (int): 8 to include diagonal neighbors, 4 for the direct neighbors only.
+
+    Returns:
+        numpy array: The offsets, one more than the number of grids.
+        numpy array: The neighbor indices.
+    '''
+
+    key = (grid_shape(grid_size), connectivity)
+    with adjacency_lock:
+        table = adjacency_tables.get(key)
+        if table is not None:
+            return table
+
+        if connectivity not in NEIGHBOR_OFFSETS:
+            raise ValueError(f"Connectivity must be 4 or 8, not {connectivity}.")
+        rows, cols = key[0]
+        row_index, col_index = np.divmod(np.arange(rows * cols), cols)
+
+        # One column per direction, marking which grids have a neighbor in that direction
+        neighbor_rows = row_index[:, None] + np.array([dr for dr, dc in NEIGHBOR_OFFSETS[connectivity]])
+        neighbor_cols = col_index[:, None] + np.array([dc for dr, dc in NEIGHBOR_OFFSETS[connectivity]])
+        inside = (neighbor_rows >= 0) & (neighbor_rows < rows) & (neighbor_cols >= 0) & (neighbor_cols < cols)
+
+        offsets = np.zeros(rows * cols + 1, dtype=np.intp)
+        np.cumsum(inside.sum(axis=1), out=offsets[1:])
+        indices = (neighbor_rows * cols + neighbor_cols)[inside]  # Row by row, so grouped by grid
+
+        offsets.flags.writeable = False
+        indices.flags.writeable = False
+        table = adjacency_tables[key] = (offsets, indices)
+        return table
+
+def gather_neighbors(grids, grid_size, connectivity=8):
+    '''
+    Returns the neighbors of a batch of grids from the adjacency table, by indexing only.
+
+    Parameters:
+        grids (numpy array): The grid indices (numbers minus 1).
+        grid_size (tuple): Number of grid cells (rows, columns).
+        connectivity (int): 8 to include diagonal neighbors, 4 for the direct neighbors only.
+
+    Returns:
+        numpy array: The neighbor indices of every grid, concatenated (a neighbor shared by several grids appears once per grid).
+    '''
+
+    offsets, indices = adjacency_table(grid_size, connectivity)
+    starts = offsets[grids]
+    lengths = offsets[grids + 1] - starts
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return indices[positions]
+
+def flag_mask(flagged, size):
+    '''Returns a boolean mask of every grid from a set of flagged grid numbers, or the mask itself when it is already one.'''
+
+    if isinstance(flagged, np.ndarray) and flagged.dtype == bool:
+        return flagged.ravel()
+    mask = np.zeros(size, dtype=bool)
+    mask[np.fromiter(flagged, dtype=np.intp) - 1] = True
+    return mask
+
 class IdentifyNeighbors:
     '''
     IdentifyNeighbors applies the nearest neighbor algorithm to determine a node's nearest neighbor.
@@ -20,75 +106,187 @@ class IdentifyNeighbors:
         self.grid_dimensions = grid_dimensions
         self.grid_numbers = grid_numbers
 
-    def get_adjacent_grids(self, n, b):
+    def get_adjacent_grids(self, n, b, connectivity=8):
         '''
-        Get the grid numbers adjacent to the grid labeled n in a b x b grid.
-        """
-        Get the grid numbers adjacent to the grid labeled `n` in a `b x b` grid,
-        including diagonal neighbors.
+        Get the grid numbers adjacent to the grid labeled n in a b x b grid, including diagonal neighbors. The neighbors are read from 
+        the cached adjacency table of the grid size (see adjacency_table).
 
         Parameters:
             n (int): The grid number (1-indexed).
-            b (int): The size of the grid (b x b).
+            b (int or tuple): The size of the grid (b x b), or its (rows, columns).
+            connectivity (int): 8 to include diagonal neighbors, 4 for the direct neighbors only.
 
         Returns:
             set: A set of adjacent grid numbers.
         '''
 
-        adjacent = set()
+        offsets, indices = adjacency_table(grid_shape(b), connectivity)
+        return set((indices[offsets[n - 1]:offsets[n]] + 1).tolist())
 
-        # Check direct neighbors
-        if n > b:  # Top
-            adjacent.add(n - b)
-        if n <= b * (b - 1):  # Bottom
-            adjacent.add(n + b)
-        if (n - 1) % b != 0:  # Left
-            adjacent.add(n - 1)
-        if n % b != 0:  # Right
-            adjacent.add(n + 1)
+    def compute_connected_set(self, start, b, valid_numbers, connectivity=8):
+        '''
+        Compute the full set of connected grids starting from a specific grid, filtering to include only numbers in `valid_numbers`. The 
+        search grows a whole frontier of grids at a time through the adjacency table.
 
-        # Check diagonal neighbors
-        if n > b and (n - 1) % b != 0:  # Top-left
-            adjacent.add(n - b - 1)
-        if n > b and n % b != 0:  # Top-right
-            adjacent.add(n - b + 1)
-        if n <= b * (b - 1) and (n - 1) % b != 0:  # Bottom-left
-            adjacent.add(n + b - 1)
-        if n <= b * (b - 1) and n % b != 0:  # Bottom-right
-            adjacent.add(n + b + 1)
+        Parameters:
+            start (int): The starting grid number.
+            b (int or tuple): The size of the grid (b x b), or its (rows, columns).
+            valid_numbers (set or numpy array): Set of valid grid numbers to include, or a boolean mask of every grid (row by row). 
+                Pass the mask when connected sets are computed for many starts, so it is not built again on every call.
+            connectivity (int): 8 to connect diagonal neighbors, 4 for the direct neighbors only.
 
-        return adjacent
+        Returns:
+            set: A set of connected grids starting from `start` that are in `valid_numbers`.
+        '''
+
+        rows, cols = grid_shape(b)
+        valid = flag_mask(valid_numbers, rows * cols)
+        visited = np.zeros(rows * cols, dtype=bool)
+        visited[start - 1] = True
+        frontier = np.array([start - 1])
 
-    def compute_connected_set(self, start, b, valid_numbers):
+        while frontier.size:
+            neighbors = gather_neighbors(frontier, (rows, cols), connectivity)
+            neighbors = np.unique(neighbors[valid[neighbors] & ~visited[neighbors]])
+            visited[neighbors] = True
+            frontier = neighbors
+
+        return set((np.flatnonzero(visited) + 1).tolist())
+
+    def flagged_neighbors(self, grids, flagged, b, connectivity=8):
         '''
-        Compute the full set of connected grids starting from a specific grid, filtering to include only numbers in `valid_numbers`.
-        """
-        Compute the set of connected grids starting from a specific grid,
-        including only numbers in `valid_numbers`.
+        Finds all the flagged neighbors of a batch of grids at once.
 
         Parameters:
-            start (int): The starting grid number.
-            b (int): The size of the grid (b x b).
-            valid_numbers (set): Set of valid grid numbers to include.
+            grids (iterable): The grid numbers (1-indexed) whose neighbors are wanted.
+            flagged (set or numpy array): The flagged grid numbers, or a boolean mask of every grid (row by row).
+            b (int or tuple): The size of the grid (b x b), or its (rows, columns).
+            connectivity (int): 8 to include diagonal neighbors, 4 for the direct neighbors only.
 
         Returns:
-            set: A set of connected grids starting from `start` that are in `valid_numbers`.
+            numpy array: The sorted grid numbers of the flagged neighbors, without the grids themselves.
+        '''
+
+        rows, cols = grid_shape(b)
+        grids = np.fromiter(grids, dtype=np.intp) - 1
+        flagged = flag_mask(flagged, rows * cols)
+
+        neighbors = np.unique(gather_neighbors(grids, (rows, cols), connectivity))
+        neighbors = neighbors[flagged[neighbors]]
+        return np.setdiff1d(neighbors, grids) + 1
+
+    def hazard_border(self, flagged, b, connectivity=8):
+        '''
+        Finds the flagged grids on the border of the hazards, the ones with at least one neighbor that is not flagged. A drone can 
+        survey a hazard's extent from these grids alone.
+
+        Parameters:
+            flagged (set or numpy array): The flagged grid numbers, or a boolean mask of every grid (row by row).
+            b (int or tuple): The size of the grid (b x b), or its (rows, columns).
+            connectivity (int): 8 to include diagonal neighbors, 4 for the direct neighbors only.
+
+        Returns:
+            numpy array: The sorted grid numbers of the border grids.
+        '''
+
+        rows, cols = grid_shape(b)
+        flagged = flag_mask(flagged, rows * cols)
+        offsets, indices = adjacency_table((rows, cols), connectivity)
+
+        # Count the flagged neighbors of every grid, a border grid has fewer than it has neighbors
+        degree = np.diff(offsets)
+        owners = np.repeat(np.arange(rows * cols), degree)
+        flagged_count = np.bincount(owners, weights=flagged[indices], minlength=rows * cols)
+        return np.flatnonzero(flagged & (flagged_count < degree)) + 1
+
+    def cluster_labels(self, clusters, shape):
+        '''
+        Builds a label array of the grid cells from clusters of connected grids.
+
+        Parameters:
+            clusters (list[set]): List of sets of grid numbers (1-indexed) representing clusters.
+            shape (tuple): Number of grid cells (rows, columns).
+
+        Returns:
+            numpy array: A (rows, columns) array holding k for the cells of the k-th cluster (starting from 1) and 0 everywhere else.
         '''
 
-        visited = set()  # Track visited grids
-        to_visit = {start}  # Start with the given grid
-        
-        visited = set()
-        to_visit = {start}
+        labels = np.zeros(shape[0] * shape[1], dtype=np.int32)
+        for i, cluster in enumerate(clusters, start=1):
+            labels[np.fromiter(cluster, dtype=np.intp, count=len(cluster)) - 1] = i
 
-        while to_visit:
-            current = to_visit.pop()
-            if current not in visited:
-                visited.add(current)
-                neighbors = self.get_adjacent_grids(current, b)
-                to_visit.update(neighbors & valid_numbers - visited)
+        return labels.reshape(shape)
+
+    def cluster_statistics(self, labels, cell_size, cell_values=None):
+        '''
+        Computes the statistics of every cluster at once from a label array of the grid cells. Every statistic is a bincount-style 
+        reduction over the cells, so the cost does not grow with Python loops over clusters.
 
-        return visited
+        Parameters:
+            labels (numpy array): A (rows, columns) array holding k for the cells of cluster k (starting from 1) and 0 everywhere else.
+            cell_size (tuple): (width, height) of a grid cell in pixels.
+            cell_values (numpy array): A (rows, columns) array of each cell's hazard intensity (e.g. its standard deviation). Every cell 
+                counts as 1 when it is None.
+
+        Returns:
+            dict: Arrays indexed by cluster (label k is at index k - 1):
+                label: The cluster labels.
+                area: The number of cells in each cluster.
+                centroid: The (x, y) pixel centroid of each cluster.
+                bbox: The (left, top, right, bottom) pixel bounding box of each cluster.
+                intensity: The mean cell value of each cluster.
+                orientation: The angle (radians, from the x-axis) of each cluster's major axis.
+        '''
+
+        labels = np.asarray(labels)
+        rows, cols = labels.shape
+        flat = labels.ravel()
+        count = int(flat.max()) if flat.size else 0
+        bins = count + 1
+        cell_width, cell_height = cell_size
+
+        row_index, col_index = np.divmod(np.arange(flat.size), cols)
+        x = (col_index + 0.5) * cell_width
+        y = (row_index + 0.5) * cell_height
+        values = np.ones(flat.size) if cell_values is None else np.asarray(cell_values, dtype=np.float64).ravel()
+
+        area = np.bincount(flat, minlength=bins)[1:]
+        safe_area = np.maximum(area, 1)  # Labels without cells get zeros instead of NaNs
+        mean_x = np.bincount(flat, weights=x, minlength=bins)[1:] / safe_area
+        mean_y = np.bincount(flat, weights=y, minlength=bins)[1:] / safe_area
+
+        # Central second moments give the orientation of each cluster's major axis
+        mu_xx = np.bincount(flat, weights=x * x, minlength=bins)[1:] / safe_area - mean_x ** 2
+        mu_yy = np.bincount(flat, weights=y * y, minlength=bins)[1:] / safe_area - mean_y ** 2
+        mu_xy = np.bincount(flat, weights=x * y, minlength=bins)[1:] / safe_area - mean_x * mean_y
+        orientation = 0.5 * np.arctan2(2 * mu_xy, mu_xx - mu_yy)
+
+        # Bounding boxes in cells, reduced per label and converted to pixels
+        min_col = np.full(bins, cols)
+        min_row = np.full(bins, rows)
+        max_col = np.full(bins, -1)
+        max_row = np.full(bins, -1)
+        np.minimum.at(min_col, flat, col_index)
+        np.minimum.at(min_row, flat, row_index)
+        np.maximum.at(max_col, flat, col_index)
+        np.maximum.at(max_row, flat, row_index)
+        bbox = np.column_stack((
+            min_col[1:] * cell_width,
+            min_row[1:] * cell_height,
+            (max_col[1:] + 1) * cell_width,
+            (max_row[1:] + 1) * cell_height,
+        ))
+
+        intensity = np.bincount(flat, weights=values, minlength=bins)[1:] / safe_area
+
+        return {
+            'label': np.arange(1, bins),
+            'area': area,
+            'centroid': np.column_stack((mean_x, mean_y)),
+            'bbox': bbox,
+            'intensity': intensity,
+            'orientation': orientation,
+        }
 
     def compute_cluster_centers(self, clusters, b):
         '''
@@ -104,25 +302,7 @@ class IdentifyNeighbors:
         '''
 
         grid_width, grid_height = self.grid_dimensions
-        cell_width = grid_width / b
-        cell_height = grid_height / b
-        cluster_centers = {}
+        labels = self.cluster_labels(clusters, (b, b))
+        statistics = self.cluster_statistics(labels, (grid_width / b, grid_height / b))
 
-        for i, cluster in enumerate(clusters, start=1):
-            x_coords = []
-            y_coords = []
-
-            for grid in cluster:
-                row = (grid - 1) // b  # Row index (0-indexed)
-                col = (grid - 1) % b  # Column index (0-indexed)
-                center_x = (col + 0.5) * cell_width
-                center_y = (row + 0.5) * cell_height
-                x_coords.append(center_x)
-                y_coords.append(center_y)
-
-            cluster_centers[i] = (
-                sum(x_coords) / len(x_coords),
-                sum(y_coords) / len(y_coords),
-            )
-
-        return cluster_centers
+        return {int(label): (float(x), float(y)) for label, (x, y) in zip(statistics['label'], statistics['centroid'])}
@@ -3,9 +3,9 @@ from sklearn.cluster import KMeans
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import matplotlib.animation as animation
-import io
 from PIL import Image
 import random
+import math
 
 
 class ClusterPathPlanner:
@@ -32,6 +32,25 @@ class ClusterPathPlanner:
         self.num_groups = num_groups
         self.groups = None
         self.paths = None
+        self.cluster_statistics = None
+
+    @classmethod
+    def from_cluster_statistics(cls, statistics, num_groups):
+        '''
+        Creates a planner whose nodes are the centroids of the clusters computed by IdentifyNeighbors.cluster_statistics.
+
+        Parameters:
+            statistics (dict): The cluster statistics.
+            num_groups (int): The number of groups of drones to deploy.
+
+        Returns:
+            ClusterPathPlanner: The planner, keyed by cluster label.
+        '''
+
+        centroids = {int(label): (float(x), float(y)) for label, (x, y) in zip(statistics['label'], statistics['centroid'])}
+        planner = cls(centroids, num_groups)
+        planner.cluster_statistics = statistics
+        return planner
 
     def split_clusters(self):
         '''
@@ -53,6 +72,96 @@ class ClusterPathPlanner:
         
         return self.groups
 
+    def split_clusters_balanced(self, capacity, workloads=None):
+        '''
+        Splits the clusters into spatially compact groups with balanced workloads, one group per drone. The number of groups is derived 
+        from the capacity of a single drone (the total workload divided by the capacity, rounded up, plus the groups needed to cut the 
+        groups that still exceed it) and replaces num_groups. The clusters are recursively cut across their widest axis at the point that 
+        splits the workload in proportion to the number of groups on each side (see bisect_workloads), so the slowest drone carries as 
+        little extra work as possible.
+
+        Parameters:
+            capacity (float): The workload a single drone can cover (e.g. a waypoint budget or flight time).
+            workloads (dict): Maps each node to its workload, in the same unit as capacity. Defaults to the area of each cluster when the 
+                planner was made from cluster statistics, and to 1 per node otherwise.
+
+        Returns:
+            dict: The groups of nodes, keyed from 1.
+        '''
+
+        nodes = list(self.centroids.keys())
+        coords = np.array([self.centroids[node] for node in nodes], dtype=np.float64).reshape(-1, 2)
+
+        if workloads is None:
+            if self.cluster_statistics is not None:
+                workloads = dict(zip(self.cluster_statistics['label'].tolist(), self.cluster_statistics['area'].tolist()))
+            else:
+                workloads = {node: 1 for node in nodes}
+        weights = np.array([workloads[node] for node in nodes], dtype=np.float64)
+
+        num_groups = min(len(nodes), max(1, math.ceil(weights.sum() / capacity))) if nodes else 0
+        parts = self.bisect_workloads(coords, weights, num_groups)
+
+        # The cuts balance the groups but cannot always keep each one within capacity (two large clusters and a small one do not fit 
+        # two drones), so only the groups over capacity are cut again, into as many groups as their own workload needs. A single 
+        # cluster larger than the capacity gets a drone of its own
+        fitted = []
+        parts.reverse()
+        while parts:
+            part = parts.pop()
+            workload = weights[part].sum()
+            if len(part) == 1 or workload <= capacity * (1 + 1e-9):
+                fitted.append(part)
+                continue
+            groups = min(len(part), max(2, math.ceil(workload / capacity)))
+            parts.extend(part[sub_part] for sub_part in reversed(self.bisect_workloads(coords[part], weights[part], groups)))
+
+        self.num_groups = len(fitted)
+        self.groups = {i + 1: [nodes[j] for j in part] for i, part in enumerate(fitted)}
+        return self.groups
+
+    def bisect_workloads(self, coords, weights, num_groups):
+        '''
+        Recursively cuts the nodes across their widest axis at the point that splits the workload in proportion to the number of groups 
+        on each side.
+
+        Parameters:
+            coords (numpy array): The (x, y) coordinates of the nodes.
+            weights (numpy array): The workload of each node.
+            num_groups (int): The number of groups.
+
+        Returns:
+            list: The node indices of each group.
+        '''
+
+        parts = []
+        to_split = [(np.arange(len(coords)), num_groups)] if len(coords) else []
+        while to_split:
+            index, groups = to_split.pop()
+            if groups == 1:
+                parts.append(index)
+                continue
+
+            # Order the nodes along the widest axis and cut where the workload matches the share of groups on the left
+            points = coords[index]
+            axis = np.argmax(np.ptp(points, axis=0))
+            order = index[np.argsort(points[:, axis], kind='stable')]
+            left_groups = groups // 2
+            cumulative = np.cumsum(weights[order])
+            target = cumulative[-1] * left_groups / groups
+
+            cut = int(np.searchsorted(cumulative, target))
+            below = cumulative[cut - 1] if cut > 0 else 0.0
+            if cut < len(order) and cumulative[cut] - target < target - below:
+                cut += 1
+            # Every group needs at least one node
+            cut = min(max(cut, left_groups), len(order) - (groups - left_groups))
+
+            to_split.append((order[cut:], groups - left_groups))
+            to_split.append((order[:cut], left_groups))
+
+        return parts
+
     def nearest_neighbor_path(self, group):
         '''
         Performs the nearest neighbor algorithm to determine a group of red subgrid's nearest neighbor.
@@ -103,16 +212,26 @@ class ClusterPathPlanner:
         '''
 
     def plot_paths(self, image=None, save_path=None):
+        '''
+        Parameters:
+            image (string or PIL.Image): The path to, or the image of, the potential hazards to draw the paths over.
+            save_path (string): The path the plot is saved to. Nothing is saved when it is None.
+
+        Returns:
+            PIL.Image: The rendered plot.
+        '''
+
         if self.groups is None or self.paths is None:
             raise ValueError("Groups or paths are not available. Ensure both are computed.")
 
         colors = cm.get_cmap("tab10", self.num_groups)
         coords = self.centroids
 
-        fig, ax = plt.subplots(figsize=(10, 10))
+        fig, ax = plt.subplots(figsize=(10, 10), dpi=300)
 
         if image:
-            im = plt.imread(image)
+            # The background can be a path or an image that is already in memory
+            im = plt.imread(image) if isinstance(image, str) else np.asarray(image)
             ax.imshow(im, extent=[0, 3923, 2950, 0])
 
         for group_id, group in self.groups.items():
@@ -133,7 +252,7 @@ class ClusterPathPlanner:
             colors_paths = ['#' + ''.join(f"{random.randint(0, 255):02X}" for _ in range(3)) for _ in range(10) if not all(abs(random.randint(0, 255) - random.randint(0, 255)) < 50 for _ in range(3))]
 
             # Then use it in the plot like this
-            ax.plot(path_x, path_y, color=colors_paths[group_id - 1],linewidth=2)
+            ax.plot(path_x, path_y, color=colors_paths[(group_id - 1) % len(colors_paths)],linewidth=2)
 
             for node, (x, y) in coords.items():
                 ax.text(x, y, str(node), fontsize=9, ha="center", va="center", color="white", 
@@ -148,14 +267,15 @@ class ClusterPathPlanner:
         ax.set_xlim(0, 3923)
         ax.set_ylim(2950, 0)
 
+        # Render once and hand back the pixels, encoding is left to the caller (or save_path)
+        fig.canvas.draw()
+        plot = Image.fromarray(np.array(fig.canvas.buffer_rgba()))
+        plt.close(fig)
+
         if save_path:
-            fig.savefig(save_path, format="png", dpi=300)
+            plot.save(save_path, format="png", dpi=(300, 300))
 
-        buf = io.BytesIO()
-        plt.savefig(buf, format="png", dpi=300)
-        buf.seek(0)
-        plt.close(fig)
-        return Image.open(buf)
+        return plot
 
     def print_paths(self):
         '''
@@ -168,7 +288,19 @@ class ClusterPathPlanner:
         for group_id, path in self.paths.items():
             print(f"Group {group_id} Path: {path}")
 
-    def animate_paths(self, save_to=None):
+    def animate_paths(self, save_to=None, writer=None):
+        '''
+        Animates each group's path. When a writer is given, every frame is rendered here and the GIF is encoded by the writer in the 
+        background instead of through ImageMagick.
+
+        Parameters:
+            save_to (string): The path the GIF is saved to. Nothing is saved when it is None.
+            writer (ArtifactWriter): The writer that saves the GIF in the background.
+
+        Returns:
+            FuncAnimation: The animation.
+        '''
+
         if self.groups is None or self.paths is None:
             raise ValueError("Groups or paths are not available. Ensure both are computed.")
         
@@ -230,7 +362,15 @@ class ClusterPathPlanner:
         plt.gca().invert_yaxis()
         
         # Save animation if required
-        if save_to:
+        if save_to and writer:
+            frames = []
+            for frame in range(max_frames):
+                update(frame)
+                fig.canvas.draw()
+                frames.append(Image.fromarray(np.array(fig.canvas.buffer_rgba())).convert("RGB"))
+            plt.close(fig)
+            writer.submit_animation(save_to, frames, duration=500)
+        elif save_to:
             ani.save(save_to, writer='imagemagick')
         
         # Return the animation object
@@ -0,0 +1,331 @@
+from main import decode_image, detect_hazards, plan_drone_paths, render_outputs, check_directory_exists, DRONE_CAPACITY
+from artifact_writer import ArtifactWriter
+from input_index import InputIndex
+from multiprocessing import shared_memory
+from PIL import Image
+import multiprocessing
+import numpy as np
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+import traceback
+
+STAGES = ('decode', 'detect', 'plan', 'render')
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    '''Returns the peak resident memory of this process (or of its largest finished child, see resource.getrusage) in bytes.'''
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * unit
+
+class SharedFrameRing:
+    '''
+    SharedFrameRing is a fixed number of frame slots in one block of shared memory. A decoded frame is copied into a free slot once and
+    every later stage reads it in place, so only the slot index travels between processes instead of the pickled frame. Acquiring a slot
+    blocks while every slot is in use, which keeps the decode stage from running ahead of the slowest stage.
+    '''
+
+    def __init__(self, slots, slot_bytes, context=None):
+        '''
+        Initialize the class by creating the shared memory and marking every slot as free.
+
+        Parameters:
+            slots (int): The number of frames that can be in flight at once.
+            slot_bytes (int): The size of the largest frame in bytes.
+            context (multiprocessing context): The context the free slot queue is created with.
+        '''
+
+        context = context or multiprocessing.get_context()
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, slots * slot_bytes))
+        self.free_slots = context.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+    def __getstate__(self):
+        # Worker processes attach to the same shared memory by name
+        return {'name': self.memory.name, 'slots': self.slots, 'slot_bytes': self.slot_bytes, 'free_slots': self.free_slots}
+
+    def __setstate__(self, state):
+        self.slots = state['slots']
+        self.slot_bytes = state['slot_bytes']
+        self.free_slots = state['free_slots']
+        self.memory = shared_memory.SharedMemory(name=state['name'])
+
+    def acquire(self):
+        '''
+        Waits for a free slot and takes it.
+
+        Returns:
+            int: The slot index.
+        '''
+
+        return self.free_slots.get()
+
+    def release(self, slot):
+        '''
+        Returns a slot to the free slots once the last stage is done with its frame.
+
+        Parameters:
+            slot (int): The slot index.
+        '''
+
+        self.free_slots.put(slot)
+
+    def frame(self, slot, shape, dtype=np.uint16):
+        '''
+        Returns the frame held in a slot as an array backed by the shared memory (no copy is made).
+
+        Parameters:
+            slot (int): The slot index.
+            shape (tuple): The shape of the frame.
+            dtype (numpy dtype): The data type of the frame.
+
+        Returns:
+            numpy array: The frame.
+        '''
+
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if nbytes > self.slot_bytes:
+            raise ValueError(f"A frame of {nbytes} bytes does not fit in a slot of {self.slot_bytes} bytes.")
+        return np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=slot * self.slot_bytes)
+
+    def close(self, unlink=False):
+        '''
+        Detaches from the shared memory, and frees it when unlink is True (only the process that created it should unlink).
+
+        Parameters:
+            unlink (bool): Whether to free the shared memory.
+        '''
+
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+def decode_stage(item, ring, config, writer):
+    '''Decodes the raw image and copies the grayscale frame into a free slot of the ring.'''
+
+    image_path = os.path.join(config['image_folder'], item['filename'])
+    frame = np.asarray(decode_image(image_path, config['row_and_column_grids']), dtype=np.uint16)
+    item['shape'] = frame.shape
+    item['slot'] = ring.acquire()
+    ring.frame(item['slot'], frame.shape)[...] = frame
+
+def detect_stage(item, ring, config, writer):
+    '''Identifies the red grids on the frame held in the ring.'''
+
+    frame = ring.frame(item['slot'], item['shape'])
+    item['hazards'] = detect_hazards(Image.fromarray(frame), config['row_and_column_grids'], config['sample_stride'],
+                                     config['frame_workers'])
+    print(f"{item['filename']}: Number of red grids: {item['hazards'].count_red_grids()}")
+
+def plan_stage(item, ring, config, writer):
+    '''Plans the drone paths through the red grid clusters.'''
+
+    item['planner'] = plan_drone_paths(item['hazards'], config['row_and_column_grids'], config['drone_capacity'])
+    if item['planner'] is None:
+        print(f"{item['filename']}: No clusters to plan paths for")
+
+def render_stage(item, ring, config, writer):
+    '''Renders the outputs of the frame held in the ring and hands them to the writer.'''
+
+    # The writer saves in the background, so it gets its own copy of the frame before the slot is reused
+    grayscale_image = Image.fromarray(ring.frame(item['slot'], item['shape']).copy())
+    render_outputs(item['filename'], config['grayscale_folder'], config['potential_hazards_folder'], config['grid_coords_folder'],
+                   config['drone_paths_folder'], grayscale_image, item['hazards'], item['planner'], writer)
+
+    # Only a short summary goes back to the parent process
+    item['num_red_grids'] = item.pop('hazards').count_red_grids()
+    planner = item.pop('planner')
+    item['num_groups'] = planner.num_groups if planner is not None else 0
+
+STAGE_FUNCTIONS = {'decode': decode_stage, 'detect': detect_stage, 'plan': plan_stage, 'render': render_stage}
+
+def stage_worker(stage, in_queue, out_queue, ring, config, stats_queue):
+    '''
+    Runs one worker of a stage: takes items from in_queue until it gets None, runs the stage on them and passes them to out_queue. An
+    item that failed in an earlier stage is passed along untouched, and the last stage releases the item's slot. The worker reports 
+    its peak memory on stats_queue when it stops.
+
+    Parameters:
+        stage (string): The name of the stage.
+        in_queue (Queue): The items waiting for this stage.
+        out_queue (Queue): The items waiting for the next stage (or the results).
+        ring (SharedFrameRing): The ring holding the decoded frames.
+        config (dict): The folders and settings of the run.
+        stats_queue (Queue): Receives the stage, process id and peak memory of the worker.
+    '''
+
+    writer = ArtifactWriter(**config['writer_options']) if stage == 'render' else None
+    try:
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+
+            if stage == STAGES[0]:
+                item['started'] = time.time()
+            if item['error'] is None:
+                started = time.time()
+                try:
+                    STAGE_FUNCTIONS[stage](item, ring, config, writer)
+                except Exception:
+                    item['error'] = traceback.format_exc()
+                item['timings'][stage] = time.time() - started
+
+            if stage == STAGES[-1]:
+                if item.get('slot') is not None:
+                    ring.release(item.pop('slot'))
+                item.pop('hazards', None)
+                item.pop('planner', None)
+                item['finished'] = time.time()
+            out_queue.put(item)
+    finally:
+        if writer is not None:
+            writer.close()
+        ring.close()
+        stats_queue.put({'stage': stage, 'pid': os.getpid(), 'peak_rss_bytes': peak_rss_bytes()})
+
+class PipelinedExecutor:
+    '''
+    PipelinedExecutor runs the program's stages (decode, detect, plan, render) as separate pools of worker processes connected by
+    bounded queues, so the CPU-heavy and I/O-heavy stages of different images overlap. Decoded frames are handed from stage to stage
+    through a SharedFrameRing instead of being pickled, and the throughput approaches that of the slowest stage.
+    '''
+
+    def __init__(self, workers=None, queue_size=4, ring_slots=None, writer_options=None, start_method=None, frame_workers=None, sample_stride=None):
+        '''
+        Initialize the class with the size of each stage.
+
+        Parameters:
+            workers (dict): Maps a stage to its number of worker processes. Stages that are left out get 1 worker.
+            queue_size (int): The number of items that can wait between two stages.
+            ring_slots (int): The number of decoded frames that can be in flight. Defaults to one per worker plus 2.
+            writer_options (dict): The options of the ArtifactWriter each render worker saves its outputs with.
+            start_method (string): The multiprocessing start method ('fork', 'spawn' or 'forkserver').
+            frame_workers (int): The number of threads each detect worker splits the hazards of a single frame across (see 
+                main.detect_hazards).
+            sample_stride (int): When set, the detect workers estimate the hazards of each frame from a sample of its pixels (see 
+                main.detect_hazards).
+        '''
+
+        self.workers = {stage: 1 for stage in STAGES}
+        if workers:
+            self.workers.update(workers)
+        self.queue_size = queue_size
+        self.ring_slots = ring_slots or sum(self.workers.values()) + 2
+        self.writer_options = writer_options or {}
+        self.context = multiprocessing.get_context(start_method)
+        self.frame_workers = frame_workers
+        self.sample_stride = sample_stride
+        self.worker_stats = []  # The peak memory of every worker of the last run
+
+    def run(self, image_folder, grayscale_folder, potential_hazards_folder, grid_coords_folder, drone_paths_folder, row_and_column_grids, drone_capacity=DRONE_CAPACITY, filenames=None):
+        '''
+        Processes the images of the image folder through the pipeline. The parameters are the same as main.process_image_files.
+
+        Parameters:
+            filenames (list): The images to process, in order. Defaults to every readable .png image in the image folder, largest 
+                first.
+
+        Returns:
+            list: One result per image, in the order they finished, with the filename, the number of red grids and drone groups, the
+                seconds spent in each stage, the traceback of the error if the image failed, and the times it was queued, taken by the
+                decode stage (started) and handed to the writer by the render stage (finished). finished - started is the latency of 
+                the image, not counting the artifacts still being saved in the background.
+        '''
+
+        check_directory_exists(grayscale_folder)
+        check_directory_exists(potential_hazards_folder)
+        check_directory_exists(grid_coords_folder)
+        check_directory_exists(drone_paths_folder)
+
+        index = InputIndex(image_folder)
+        index.scan()
+        if filenames is None:
+            filenames = [entry['filename'] for entry in index.schedule()]
+            print(f"{len(filenames)} images, estimated {index.estimate_makespan(max(self.workers.values())):.0f} seconds")
+        if not filenames:
+            return []
+
+        config = {
+            'image_folder': image_folder,
+            'grayscale_folder': grayscale_folder,
+            'potential_hazards_folder': potential_hazards_folder,
+            'grid_coords_folder': grid_coords_folder,
+            'drone_paths_folder': drone_paths_folder,
+            'row_and_column_grids': row_and_column_grids,
+            'drone_capacity': drone_capacity,
+            'writer_options': self.writer_options,
+            'frame_workers': self.frame_workers,
+            'sample_stride': self.sample_stride,
+        }
+
+        # The slots are sized from the image headers, a 16-bit frame takes 2 bytes per pixel
+        sizes = {entry['filename']: entry['width'] * entry['height'] for entry in index.entries}
+        slot_bytes = 0
+        for filename in filenames:
+            if filename not in sizes:
+                # An image that cannot be read fails in the decode stage, so it comes back with its error like any other
+                try:
+                    with Image.open(os.path.join(image_folder, filename)) as image:
+                        sizes[filename] = image.width * image.height
+                except OSError:
+                    sizes[filename] = 0
+            slot_bytes = max(slot_bytes, sizes[filename] * 2)
+        ring = SharedFrameRing(self.ring_slots, slot_bytes, self.context)
+
+        queues = [self.context.Queue(maxsize=self.queue_size) for stage in STAGES]
+        results_queue = self.context.Queue()
+        queues.append(results_queue)
+        stats_queue = self.context.Queue()
+
+        processes = {}
+        for index, stage in enumerate(STAGES):
+            processes[stage] = [
+                self.context.Process(target=stage_worker, args=(stage, queues[index], queues[index + 1], ring, config, stats_queue),
+                                     daemon=True)
+                for _ in range(self.workers[stage])
+            ]
+            for process in processes[stage]:
+                process.start()
+
+        # Feed the images and shut each stage down once the stage before it has finished
+        def feed():
+            for filename in filenames:
+                queues[0].put({'filename': filename, 'error': None, 'timings': {}, 'queued': time.time()})
+            for index, stage in enumerate(STAGES):
+                for _ in processes[stage]:
+                    queues[index].put(None)
+                for process in processes[stage]:
+                    process.join()
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        results = []
+        try:
+            while len(results) < len(filenames):
+                try:
+                    results.append(results_queue.get(timeout=1))
+                except queue.Empty:
+                    crashed = [process for stage in STAGES for process in processes[stage] if process.exitcode not in (None, 0)]
+                    if crashed:
+                        raise RuntimeError(f"A pipeline worker exited with code {crashed[0].exitcode}.")
+            feeder.join()
+
+            # Every worker has stopped once the feeder is done
+            self.worker_stats = [stats_queue.get(timeout=10) for stage in STAGES for _ in processes[stage]]
+        finally:
+            for stage in STAGES:
+                for process in processes[stage]:
+                    if process.is_alive():
+                        process.terminate()
+            ring.close(unlink=True)
+
+        return results
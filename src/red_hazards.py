@@ -1,6 +1,67 @@
-from PIL import Image, ImageDraw
+from grid_overlay import grid_overlay
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 import numpy as np
 
+# The grayscale images hold 8-bit values in 16-bit pixels, standard deviations are scaled to the full 16-bit range
+GRAYSCALE_SCALE = 65535 / 255
+
+# The fewest interior pixels sampled per cell, below which the sample's own spread is too noisy to bound the error of its estimate
+MIN_SAMPLED_PIXELS = 100
+
+def count_clusters(masks):
+    '''
+    Counts the clusters of connected (including diagonally) grids in each mask. Every grid starts with its own label and takes the 
+    largest label of its neighbors until nothing changes, which runs on all the masks at once.
+
+    Parameters:
+        masks (numpy array): Boolean masks shaped (..., rows, columns).
+
+    Returns:
+        numpy array: The number of clusters in each mask, shaped like the leading dimensions of masks.
+    '''
+
+    masks = np.asarray(masks, dtype=bool)
+    rows, cols = masks.shape[-2:]
+    own_labels = np.arange(1, rows * cols + 1).reshape(rows, cols)
+    labels = np.where(masks, own_labels, 0)
+
+    while True:
+        padded = np.pad(labels, [(0, 0)] * (labels.ndim - 2) + [(1, 1), (1, 1)])
+        neighborhood = labels.copy()
+        for dy in range(3):
+            for dx in range(3):
+                np.maximum(neighborhood, padded[..., dy:dy + rows, dx:dx + cols], out=neighborhood)
+        neighborhood = np.where(masks, neighborhood, 0)
+        if np.array_equal(neighborhood, labels):
+            break
+        labels = neighborhood
+
+    # Each cluster ends up with the label of its last grid, so it is counted once there
+    return ((labels == own_labels) & masks).sum(axis=(-2, -1))
+
+def reduce_bands(reduce_band, length, workers=1):
+    '''
+    Splits the rows 0 to length into one band per worker and reduces the bands on a thread each (NumPy releases the GIL while 
+    reducing). A single worker reduces everything on the calling thread.
+
+    Parameters:
+        reduce_band (function): Takes the slice of a band and returns its result.
+        length (int): The number of rows to split.
+        workers (int): The number of threads, at most one per row.
+
+    Returns:
+        list: The result of every band, in order.
+    '''
+
+    workers = max(1, min(workers or 1, length))
+    bounds = np.linspace(0, length, workers + 1).astype(int)
+    bands = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    if workers == 1:
+        return [reduce_band(bands[0])]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(reduce_band, bands))
+
 class IdentifyHazards:
     '''
     IdentifyHazards processes a grayscale image and identifies potential areas where a hazard may be on a construction site.
@@ -11,7 +72,7 @@ class IdentifyHazards:
         Sharon Gilman
     '''
 
-    def __init__(self, image_path, potential_hazards_path, grid_size, min_threshold=0, max_threshold=65535):
+    def __init__(self, image_path, potential_hazards_path, grid_size, min_threshold=0, max_threshold=65535, sample_stride=None, confidence_z=4.0, workers=None):
         '''
         Initialize the class with the provided image paths to the raw image and the path to the folder where the processed image will be 
         saved to. Sets the minimum and maximum thresholds for identifying potential hazards.
@@ -22,6 +83,11 @@ class IdentifyHazards:
             grid_size (tuple): The size of the grid.
             min_threshold (int): The minimum threshold to identify potential hazards.
             max_threshold (int): The maximum threshold to identify potential hazards.
+            sample_stride (int): When set, the standard deviations are estimated from every sample_stride-th pixel in both directions 
+                (see compute_approximate_cell_std) instead of every pixel.
+            confidence_z (float): The width, in standard errors, of the confidence interval of an estimated standard deviation.
+            workers (int): When set, the standard deviations of a large image are computed by this many threads, each over a band of 
+                grid rows (see compute_cell_std and compute_approximate_cell_std).
         '''
 
         """
@@ -42,74 +108,274 @@ class IdentifyHazards:
         self.red_grid_count = 0  # Counter for grids meeting the hazard criteria
         self.red_grids_coords = []  # Stores label and center coordinates of red grids
         self.red_grids = []  # Stores labels of grids meeting hazard criteria
-
-    def highlight_grids(self):
+        self.sample_stride = sample_stride
+        self.confidence_z = confidence_z
+        self.workers = workers
+        self.cell_std = None  # Standard deviation of every grid cell, shaped (rows, columns)
+        self.cell_std_interval = None  # (lower, upper) bounds of the standard deviations when they are estimated
+        self.exact_cells = None  # Which standard deviations were computed exactly when they are estimated
+        self.cell_width = None
+        self.cell_height = None
+
+    def highlight_grids(self, image=None):
         '''
         Uses the 16-bit grayscale image to determine which grids are within the minimum threshold and maximum threshold.
+
+        Parameters:
+            image (PIL.Image): An already decoded image to process instead of opening image_path (e.g. a reduced-resolution preview).
+
+        Returns:
+            PIL.Image: The annotated image.
         '''
         
         """
         Process the image, overlay a grid, and highlight potential hazard areas.
         """
-        # Open and convert the image to 16-bit grayscale
-        image = Image.open(self.image_path)
-        gray_image = image.convert('I;16')
-        grayscale_array = np.array(gray_image, dtype=np.float32) * (65535 / 255)
+        gray_image = self.identify_grids(image)
+        rgb_image = self.draw_grids(gray_image)
+
+        # Save the annotated image
+        if self.potential_hazards_path:
+            rgb_image.save(self.potential_hazards_path)
+
+        return rgb_image
+
+    def identify_grids(self, image=None):
+        '''
+        Computes the standard deviation of every grid cell and records the grids within the minimum and maximum threshold, without 
+        drawing anything.
+
+        Parameters:
+            image (PIL.Image): An already decoded image to process instead of opening image_path.
+
+        Returns:
+            PIL.Image: The 16-bit grayscale image the grids were computed on.
+        '''
+
+        # Open and convert the image to 16-bit grayscale, a 16-bit image is used as it is instead of being copied
+        if image is None:
+            image = Image.open(self.image_path)
+        gray_image = image if image.mode == 'I;16' else image.convert('I;16')
+        if self.sample_stride:
+            self.compute_approximate_cell_std(np.asarray(gray_image), self.sample_stride, self.confidence_z)
+        else:
+            self.compute_cell_std(np.asarray(gray_image))
+
+        self.record_red_grids()
+        return gray_image
+
+    def record_red_grids(self):
+        '''
+        Records the grids whose standard deviation is within the minimum and maximum threshold, with their labels and centers. 
+        cell_std, cell_width and cell_height must have been set first (see identify_grids).
+        '''
+
+        # Grids are labelled row by row starting from 1
+        rows, cols = np.nonzero(self.threshold_mask(self.min_threshold, self.max_threshold))
+        labels = rows * self.grid_size[1] + cols + 1
+
+        # Calculate center coordinates of the grids
+        centers_x = (cols * self.cell_width + (cols + 1) * self.cell_width) // 2
+        centers_y = (rows * self.cell_height + (rows + 1) * self.cell_height) // 2
+
+        # Store hazard grid information
+        self.red_grids = labels.tolist()
+        self.red_grids_coords = [
+            {"label": label, "center": (center_x, center_y)}
+            for label, center_x, center_y in zip(self.red_grids, centers_x.tolist(), centers_y.tolist())
+        ]
+        self.red_grid_count = len(self.red_grids)
+
+    def compute_cell_std(self, grayscale_array, workers=None):
+        '''
+        Computes the standard deviation of every grid cell at once by viewing the image as (rows, cell height, columns, cell width) 
+        blocks. Pixels past the last full cell are left out, the same as the grid. With several workers, the grid rows are split into 
+        bands that are reduced by a thread each (see reduce_bands), straight into their rows of the result.
+
+        Parameters:
+            grayscale_array (numpy array): The 16-bit grayscale pixels.
+            workers (int): The number of threads. Defaults to the workers the class was created with, or a single thread.
+
+        Returns:
+            numpy array: The (rows, columns) standard deviations, scaled to the 0-65535 range the thresholds use.
+        '''
 
         height, width = grayscale_array.shape
-        cell_height = height // self.grid_size[0]
-        cell_width = width // self.grid_size[1]
+        rows, cols = self.grid_size
+        self.cell_height = height // rows
+        self.cell_width = width // cols
 
-        # Convert to RGB for drawing highlights
-        rgb_image = gray_image.convert('RGB')
-        draw = ImageDraw.Draw(rgb_image, 'RGBA')
+        cells = grayscale_array[:rows * self.cell_height, :cols * self.cell_width].reshape(rows, self.cell_height, cols, self.cell_width)
+        cell_std = np.empty((rows, cols), dtype=np.float64)
 
-        label = 1  # Grid label counter
+        def reduce_band(band):
+            # Each band writes its own rows of the result, the bands are views of the image so nothing is copied
+            cells[band].std(axis=(1, 3), dtype=np.float64, out=cell_std[band])
+            cell_std[band] *= GRAYSCALE_SCALE
 
-        for row in range(self.grid_size[0]):
-            for col in range(self.grid_size[1]):
-                top = row * cell_height
-                left = col * cell_width
-                bottom = (row + 1) * cell_height
-                right = (col + 1) * cell_width
+        reduce_bands(reduce_band, rows, workers or self.workers)
+        self.cell_std = cell_std
+        return self.cell_std
 
-                # Extract the current grid cell
-                grid_cell = grayscale_array[top:bottom, left:right]
-                std_value = np.std(grid_cell)
+    def compute_approximate_cell_std(self, grayscale_array, sample_stride=4, confidence_z=4.0, workers=None):
+        '''
+        Estimates the standard deviation of every grid cell from a sample of its pixels. The first row and column of each cell, where 
+        DefineGrayScale draws the grid lines, are always read in full, and the interior is sampled every sample_stride-th row and column 
+        (starting half a stride in, so the same pixels are used for every image). Each estimate gets a confidence interval from the 
+        sampling error of the interior's mean and variance, and only the cells whose interval contains the minimum or maximum threshold, 
+        where the sample could change the decision, are computed again from every pixel. The stride is lowered for cells too small to 
+        sample MIN_SAMPLED_PIXELS pixels from. The interval treats the sample as a random one, so texture narrower than the stride that 
+        the lattice never reads (e.g. a sliver of a hazard cut off by the cell's edge) is not covered by it.
 
-                if self.min_threshold <= std_value <= self.max_threshold:
-                    # Highlight the grid cell with a red overlay
-                    draw.rectangle([left, top, right, bottom], fill=(255, 0, 0, 30))
-                    self.red_grid_count += 1
+        Parameters:
+            grayscale_array (numpy array): The 16-bit grayscale pixels.
+            sample_stride (int): The distance between sampled pixels, a stride of 4 reads about one interior pixel in 16.
+            confidence_z (float): The width of the confidence interval in standard errors.
+            workers (int): The number of threads the grid rows are split across (see compute_cell_std). Defaults to the workers the 
+                class was created with, or a single thread.
 
-                    # Divide the grid into 8 smaller sub-grids (2 rows x 4 columns)
-                    small_cell_height = (bottom - top) // 4
-                    small_cell_width = (right - left) // 4
+        Returns:
+            numpy array: The (rows, columns) standard deviations, scaled to the 0-65535 range the thresholds use.
+        '''
 
-                    for i in range(4):
-                        for j in range(4):
-                            small_top = top + i * small_cell_height
-                            small_left = left + j * small_cell_width
-                            small_bottom = small_top + small_cell_height
-                            small_right = small_left + small_cell_width
+        height, width = grayscale_array.shape
+        rows, cols = self.grid_size
+        cell_height = height // rows
+        cell_width = width // cols
+        while True:
+            offset = 1 + sample_stride // 2
+            sampled = len(range(offset, cell_height, sample_stride)) * len(range(offset, cell_width, sample_stride))
+            if sample_stride <= 1 or sampled >= MIN_SAMPLED_PIXELS:
+                break
+            sample_stride -= 1
+        if sample_stride <= 1:
+            return self.compute_cell_std(grayscale_array, workers)
+        self.cell_height = cell_height
+        self.cell_width = cell_width
+
+        cells = grayscale_array[:rows * cell_height, :cols * cell_width].reshape(rows, cell_height, cols, cell_width)
+        interior = (cell_height - 1) * (cell_width - 1)
+        total = cell_height * cell_width
+        variance = np.empty((rows, cols), dtype=np.float64)
+        variance_error = np.empty((rows, cols), dtype=np.float64)
+
+        def reduce_row(row):
+            # One grid row at a time, so the float64 deviations are the size of a sampled row of cells and not of the whole image
+            band = slice(row, row + 1)
+            top = cells[band, 0, :, :]
+            left = cells[band, 1:, :, 0]
+            sample = cells[band, offset::sample_stride, :, offset::sample_stride]
+
+            # Moments about the sample mean, the borders count every pixel and the sample is scaled up to the interior
+            center = sample.mean(axis=(1, 3), dtype=np.float64)
+            top_deviations = top - center[:, :, None]
+            left_deviations = left - center[:, None, :]
+            deviations = sample - center[:, None, :, None]
+            squares = np.square(deviations)
+            sample_second = squares.sum(axis=(1, 3)) / sampled
+            first = top_deviations.sum(axis=-1) + left_deviations.sum(axis=1)  # The sample's deviations sum to 0
+            second = np.square(top_deviations).sum(axis=-1) + np.square(left_deviations).sum(axis=1) + interior * sample_second
+            mean = first / total
+            variance[band] = np.maximum(second / total - mean ** 2, 0)
+
+            # Sampling error of the variance, with the finite population correction. Each sampled pixel moves the variance by 
+            # (d^2 - 2 * mean * d) * interior / total, which covers the error of the interior's mean as well as of its spread
+            sample_third = np.einsum('ijkl,ijkl->ik', squares, deviations) / sampled
+            sample_fourth = np.einsum('ijkl,ijkl->ik', squares, squares) / sampled
+            influence = sample_fourth - 4 * mean * sample_third + 4 * mean ** 2 * sample_second - sample_second ** 2
+            variance_error[band] = ((interior / total) ** 2 * np.maximum(influence, 0) / sampled * max(1 - sampled / interior, 0))
+
+        def reduce_band(band):
+            for row in range(band.start, band.stop):
+                reduce_row(row)
+
+        reduce_bands(reduce_band, rows, workers or self.workers)
+
+        estimate = np.sqrt(variance)
+        error = np.divide(np.sqrt(variance_error), 2 * estimate, out=np.sqrt(np.sqrt(variance_error)), where=estimate > 0)
+
+        estimate *= GRAYSCALE_SCALE
+        error *= GRAYSCALE_SCALE
+        lower = estimate - confidence_z * error
+        upper = estimate + confidence_z * error
+
+        # Fall back to every pixel where the interval straddles a threshold, gathering those cells at once
+        uncertain = (((lower <= self.min_threshold) & (self.min_threshold <= upper))
+                     | ((lower <= self.max_threshold) & (self.max_threshold <= upper)))
+        uncertain_rows, uncertain_cols = np.nonzero(uncertain)
+        if uncertain_rows.size:
+            exact = cells[uncertain_rows, :, uncertain_cols, :].std(axis=(1, 2), dtype=np.float64) * GRAYSCALE_SCALE
+            estimate[uncertain] = lower[uncertain] = upper[uncertain] = exact
+
+        self.cell_std = estimate
+        self.cell_std_interval = (lower, upper)
+        self.exact_cells = uncertain
+        return self.cell_std
+
+    def threshold_mask(self, min_threshold, max_threshold):
+        '''
+        Returns which grid cells are within the given thresholds. The thresholds can be arrays, in which case they are broadcast against 
+        the (rows, columns) standard deviations.
 
-                            # Outline the smaller grids
-                            draw.rectangle([small_left, small_top, small_right, small_bottom], outline="black")
+        Parameters:
+            min_threshold (int or numpy array): The minimum threshold.
+            max_threshold (int or numpy array): The maximum threshold.
 
-                    # Calculate center coordinates of the grid
-                    center_x = (left + right) // 2
-                    center_y = (top + bottom) // 2
+        Returns:
+            numpy array: The boolean mask of the grids within the thresholds.
+        '''
 
-                    # Store hazard grid information
-                    self.red_grids_coords.append({"label": label, "center": (center_x, center_y)})
-                    self.red_grids.append(label)
+        return (min_threshold <= self.cell_std) & (self.cell_std <= max_threshold)
 
-                # Label the grid in the top-left corner
-                draw.text((left + 5, top + 5), str(label), fill="white")
-                label += 1
+    def sweep_thresholds(self, min_thresholds, max_thresholds):
+        '''
+        Evaluates every pair of minimum and maximum thresholds at once on the cached standard deviations of the grid cells, without 
+        decoding or drawing the image again. identify_grids (or compute_cell_std) must have been called first.
 
-        # Save the annotated image
-        rgb_image.save(self.potential_hazards_path)
+        Parameters:
+            min_thresholds (list): The minimum thresholds to try.
+            max_thresholds (list): The maximum thresholds to try.
+
+        Returns:
+            dict: Arrays indexed by (minimum threshold, maximum threshold):
+                min_threshold: The minimum threshold of each pair.
+                max_threshold: The maximum threshold of each pair.
+                masks: The (rows, columns) mask of the grids within each pair.
+                hazard_counts: The number of red grids of each pair.
+                cluster_counts: The number of connected clusters of red grids of each pair.
+        '''
+
+        if self.cell_std is None:
+            raise ValueError("Grid statistics are not available. Call identify_grids() first.")
+
+        min_grid, max_grid = np.meshgrid(np.asarray(min_thresholds), np.asarray(max_thresholds), indexing='ij')
+        masks = self.threshold_mask(min_grid[..., None, None], max_grid[..., None, None])
+
+        return {
+            'min_threshold': min_grid,
+            'max_threshold': max_grid,
+            'masks': masks,
+            'hazard_counts': masks.sum(axis=(-2, -1)),
+            'cluster_counts': count_clusters(masks),
+        }
+
+    def draw_grids(self, gray_image):
+        '''
+        Draws the grid labels and highlights the grids found by identify_grids on the image. The grid lines, labels and sub-grid outlines 
+        come from the cached overlay of the image's size, so only the red tint and the outlines to show depend on the image.
+
+        Parameters:
+            gray_image (PIL.Image): The 16-bit grayscale image the grids were computed on.
+
+        Returns:
+            PIL.Image: The annotated RGB image.
+        '''
+
+        red_mask = np.zeros(self.grid_size[0] * self.grid_size[1], dtype=bool)
+        red_mask[np.asarray(self.red_grids, dtype=np.intp) - 1] = True
+
+        overlay = grid_overlay(gray_image.size, self.grid_size)
+        return overlay.annotate(gray_image, red_mask.reshape(self.grid_size))
 
     def count_red_grids(self):
         '''
@@ -0,0 +1,262 @@
+from main import decode_image, detect_hazards, plan_drone_paths, DRONE_CAPACITY
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+def analyze_image(image, row_and_column_grids, drone_capacity=DRONE_CAPACITY, workers=None, sample_stride=None):
+    '''
+    Identifies the hazards of an image and plans the drone paths without saving anything, and returns the results as plain data.
+
+    Parameters:
+        image (string or file): The path to the raw drone image, or a file object holding its bytes.
+        row_and_column_grids (int): The size of the grid (an x by x grid).
+        drone_capacity (float): The number of red grids a single drone can cover.
+        workers (int): The number of threads the hazards of the image are detected with (see main.detect_hazards).
+        sample_stride (int): When set, the hazards of the image are estimated from a sample of its pixels (see main.detect_hazards).
+
+    Returns:
+        dict: The thresholds, red grids, clusters and routes of the image, ready to be encoded as JSON.
+    '''
+
+    grayscale_image = decode_image(image, row_and_column_grids)
+    potential_hazards = detect_hazards(grayscale_image, row_and_column_grids, sample_stride, workers)
+    path_planner = plan_drone_paths(potential_hazards, row_and_column_grids, drone_capacity)
+
+    clusters = []
+    routes = {}
+    if path_planner is not None:
+        statistics = path_planner.cluster_statistics
+        for index, label in enumerate(statistics['label'].tolist()):
+            clusters.append({
+                'label': label,
+                'area': int(statistics['area'][index]),
+                'centroid': statistics['centroid'][index].tolist(),
+                'bbox': statistics['bbox'][index].tolist(),
+                'intensity': float(statistics['intensity'][index]),
+                'orientation': float(statistics['orientation'][index]),
+            })
+        routes = {str(group_id): [int(node) for node in path] for group_id, path in path_planner.paths.items()}
+
+    return {
+        'image_size': list(grayscale_image.size),
+        'thresholds': [potential_hazards.min_threshold, potential_hazards.max_threshold],
+        'red_grids': [{'label': item['label'], 'center': list(item['center'])} for item in potential_hazards.grid_info()],
+        'clusters': clusters,
+        'routes': routes,
+    }
+
+class DetectionService:
+    '''
+    DetectionService keeps the program loaded in a long-lived local process and answers detection requests over HTTP, on localhost or
+    on a Unix socket, so a client such as the ground-station UI does not pay the start-up and import cost on every image.
+
+    Requests:
+        GET /health: Returns the service status.
+        POST /detect: Takes a JSON body with "image_path" (a path the service can read) or "image_base64" (the image bytes), or the
+            raw image bytes with an image/* content type, and an optional "grids" size. Returns the result of analyze_image as JSON.
+    '''
+
+    def __init__(self, row_and_column_grids=30, drone_capacity=DRONE_CAPACITY, max_concurrent=2, max_pending=16, max_body_bytes=64 * 1024 * 1024, workers=None, sample_stride=None):
+        '''
+        Initialize the service with its settings.
+
+        Parameters:
+            row_and_column_grids (int): The default size of the grid (an x by x grid).
+            drone_capacity (float): The number of red grids a single drone can cover.
+            max_concurrent (int): The number of images processed at the same time.
+            max_pending (int): The number of requests that can wait for a free slot before new ones are turned away with a 503.
+            max_body_bytes (int): The largest request body accepted.
+            workers (int): The number of threads the hazards of each image are detected with, on top of the images processed at the 
+                same time.
+            sample_stride (int): When set, the hazards of each image are estimated from a sample of its pixels, for a faster triage.
+        '''
+
+        self.row_and_column_grids = row_and_column_grids
+        self.drone_capacity = drone_capacity
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.max_body_bytes = max_body_bytes
+        self.workers = workers
+        self.sample_stride = sample_stride
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='detection')
+        self.slots = None
+        self.pending = 0
+        self.processing = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+        '''
+        Starts listening on a localhost port, or on a Unix socket when unix_path is given.
+
+        Parameters:
+            host (string): The address to listen on.
+            port (int): The port to listen on.
+            unix_path (string): The path of the Unix socket.
+        '''
+
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve_forever(self):
+        '''Serves requests until the service is stopped.'''
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self):
+        '''Stops listening and waits for the images being processed.'''
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    async def handle_connection(self, reader, writer):
+        '''Answers the requests of one connection until the client closes it.'''
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, target, version = request_line.decode('latin-1').split(maxsplit=2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body_bytes:
+                    await self.respond(writer, 413, {'error': 'Request body is too large.'}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                status, payload = await self.route(method, target, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version.strip() == 'HTTP/1.1'
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, headers, body):
+        '''
+        Dispatches a request.
+
+        Returns:
+            int: The HTTP status.
+            dict: The JSON payload.
+        '''
+
+        path = target.split('?', 1)[0]
+        if path == '/health':
+            return 200, {'status': 'ok', 'processing': self.processing, 'pending': self.pending}
+        if path != '/detect':
+            return 404, {'error': f'Unknown path {path}.'}
+        if method != 'POST':
+            return 405, {'error': 'Use POST.'}
+
+        grids = self.row_and_column_grids
+        if headers.get('content-type', '').startswith('image/'):
+            image = io.BytesIO(body)
+        else:
+            try:
+                request = json.loads(body or b'{}')
+                grids = request.get('grids', grids)
+                if isinstance(grids, bool) or not isinstance(grids, int) or grids < 1:
+                    return 400, {'error': f'grids must be a positive integer, not {grids!r}.'}
+                if 'image_path' in request:
+                    image = request['image_path']
+                    if not os.path.isfile(image):
+                        return 404, {'error': f'No image at {image}.'}
+                elif 'image_base64' in request:
+                    image = io.BytesIO(base64.b64decode(request['image_base64']))
+                else:
+                    return 400, {'error': 'Give image_path, image_base64 or the raw image bytes.'}
+            except (ValueError, TypeError) as error:
+                return 400, {'error': str(error)}
+
+        if self.pending >= self.max_pending:
+            return 503, {'error': 'Too many pending requests.'}
+
+        # Wait for a free slot, the image is then processed off the event loop
+        self.pending += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.pending -= 1
+
+        self.processing += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.executor, analyze_image, image, grids, self.drone_capacity, self.workers,
+                                                self.sample_stride)
+        except Exception as error:
+            return 500, {'error': f'{type(error).__name__}: {error}'}
+        finally:
+            self.processing -= 1
+            self.slots.release()
+
+        return 200, result
+
+    async def respond(self, writer, status, payload, keep_alive=True):
+        '''Writes a JSON response.'''
+
+        body = json.dumps(payload).encode()
+        head = (
+            f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "")}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve hazard detection requests from a warm local process.')
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='The port to listen on.')
+    parser.add_argument('--unix', help='Listen on this Unix socket instead of a port.')
+    parser.add_argument('--grids', type=int, default=30, help='The default size of the grid (an x by x grid).')
+    parser.add_argument('--max-concurrent', type=int, default=2, help='The number of images processed at the same time.')
+    parser.add_argument('--max-pending', type=int, default=16, help='The number of requests that can wait for a free slot.')
+    parser.add_argument('--workers', type=int, help='The number of threads the hazards of each image are detected with.')
+    parser.add_argument('--sample-stride', type=int, help='Estimate the hazards of each image from every Nth pixel for a faster triage.')
+    args = parser.parse_args()
+
+    service = DetectionService(args.grids, max_concurrent=args.max_concurrent, max_pending=args.max_pending, workers=args.workers,
+                               sample_stride=args.sample_stride)
+
+    async def run():
+        await service.start(args.host, args.port, args.unix)
+        print(f"Listening on {args.unix or f'{args.host}:{args.port}'}")
+        try:
+            await service.serve_forever()
+        finally:
+            await service.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
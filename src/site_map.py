@@ -0,0 +1,306 @@
+from path_planning import ClusterPathPlanner
+from exif import gps_position, read_exif
+from PIL import Image
+import math
+import os
+import re
+
+EARTH_RADIUS = 6378137.0  # Meters, WGS 84
+
+# DJI drones write the height above the take-off point to their XMP data, as an attribute or an element
+RELATIVE_ALTITUDE = re.compile(rb'RelativeAltitude(?:\s*=\s*"|>)\s*([+-]?[0-9]*\.?[0-9]+)')
+
+def read_relative_altitude(image):
+    '''
+    Reads the height above the take-off point (drone-dji:RelativeAltitude) from the XMP data of an open image, without decoding its 
+    pixels. Unlike the GPS altitude, which is above sea level, it is the height above the ground when the drone took off from the site.
+
+    Parameters:
+        image (PIL.Image): The open image.
+
+    Returns:
+        float: The relative altitude in meters, or None if the image has none.
+    '''
+
+    xmp = image.info.get('xmp') or image.info.get('XML:com.adobe.xmp')
+    if not xmp:
+        return None
+    if isinstance(xmp, str):
+        xmp = xmp.encode()
+
+    match = RELATIVE_ALTITUDE.search(xmp)
+    return float(match.group(1)) if match else None
+
+def read_offsets(offset_path):
+    '''
+    Reads a file of frame offsets, one frame per line: "filename x y meters_per_pixel", separated by spaces or commas. x and y are the
+    position of the frame's top-left pixel in meters. Empty lines and lines starting with # are skipped.
+
+    Parameters:
+        offset_path (string): The path to the offset file.
+
+    Returns:
+        dict: Maps each filename to its (x, y, meters_per_pixel).
+    '''
+
+    offsets = {}
+    with open(offset_path) as offset_file:
+        for line in offset_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            filename, x, y, meters_per_pixel = line.replace(',', ' ').split()
+            offsets[filename] = (float(x), float(y), float(meters_per_pixel))
+
+    return offsets
+
+class SiteHazardMap:
+    '''
+    SiteHazardMap merges the red grids of every frame of a site into one map in site coordinates (meters, x to the east and y to the
+    south, the same directions as the image axes). Only the map cells with hazard evidence are stored, in a spatial hash, so the memory
+    grows with the number of hazards instead of the area of the site. A map cell seen by several overlapping frames is counted once per
+    frame, and its evidence accumulates over them.
+    '''
+
+    def __init__(self, cell_size=1.0, bucket_size=32, origin=None, horizontal_fov=84.0, offsets=None, ground_elevation=None):
+        '''
+        Initialize an empty map.
+
+        Parameters:
+            cell_size (float): The side of a map cell in meters.
+            bucket_size (int): The side of a spatial hash bucket in map cells.
+            origin (tuple): The (latitude, longitude) of the site origin. Defaults to the position of the first GPS frame.
+            horizontal_fov (float): The horizontal field of view of the camera in degrees, used to get the ground size of a pixel from
+                the altitude of a GPS frame.
+            offsets (dict): Frame offsets read by read_offsets. They are used instead of the GPS position of a frame.
+            ground_elevation (float): The elevation of the site above sea level in meters. The height of a GPS frame above the ground is 
+                its GPS altitude minus this elevation when the frame has no relative altitude (see read_relative_altitude).
+        '''
+
+        self.cell_size = cell_size
+        self.bucket_size = bucket_size
+        self.origin = origin
+        self.horizontal_fov = horizontal_fov
+        self.offsets = offsets or {}
+        self.ground_elevation = ground_elevation
+        self.cells = {}  # (column, row) of a map cell -> its evidence
+        self.buckets = {}  # (column, row) of a bucket -> the map cells with evidence inside it
+        self.frames = set()
+
+    def frame_pose(self, image_path, image_size):
+        '''
+        Places a frame on the site, assuming the camera points straight down with the top of the image to the north. The ground size of
+        a pixel follows from the height above the ground: the relative altitude of the frame, or else its GPS altitude minus the 
+        ground elevation of the site. A GPS frame with neither needs an offset.
+
+        Parameters:
+            image_path (string): The path to the frame.
+            image_size (tuple): (width, height) of the frame in pixels.
+
+        Returns:
+            tuple: (x, y, meters_per_pixel) of the frame's top-left pixel.
+        '''
+
+        filename = os.path.basename(image_path)
+        if filename in self.offsets:
+            return self.offsets[filename]
+
+        with Image.open(image_path) as image:
+            position = gps_position(read_exif(image))
+            relative_altitude = read_relative_altitude(image)
+        if position is None:
+            raise ValueError(f"{filename} has no GPS position and no offset.")
+        latitude, longitude, altitude = position
+
+        # The GPS altitude is above sea level, not above the site
+        if relative_altitude is not None:
+            height_above_ground = relative_altitude
+        elif self.ground_elevation is not None:
+            height_above_ground = altitude - self.ground_elevation
+        else:
+            raise ValueError(f"{filename} has no relative altitude. Give the ground elevation of the site or an offset for the frame.")
+        if height_above_ground <= 0:
+            raise ValueError(f"{filename} is {height_above_ground:.1f} meters above the ground.")
+
+        if self.origin is None:
+            self.origin = (latitude, longitude)
+        origin_latitude, origin_longitude = self.origin
+
+        # Equirectangular projection, accurate over the size of a construction site
+        center_x = math.radians(longitude - origin_longitude) * EARTH_RADIUS * math.cos(math.radians(origin_latitude))
+        center_y = -math.radians(latitude - origin_latitude) * EARTH_RADIUS
+
+        width, height = image_size
+        meters_per_pixel = 2 * height_above_ground * math.tan(math.radians(self.horizontal_fov) / 2) / width
+        return center_x - width / 2 * meters_per_pixel, center_y - height / 2 * meters_per_pixel, meters_per_pixel
+
+    def add_frame(self, image_path, potential_hazards, image_size, pose=None):
+        '''
+        Adds the red grids of a frame to the map. Every map cell a red grid covers gets one observation from this frame, with the grid's
+        standard deviation as its intensity. A frame that is already on the map is skipped.
+
+        Parameters:
+            image_path (string): The path to the frame, it identifies the frame.
+            potential_hazards (IdentifyHazards): The identified potential hazards of the frame.
+            image_size (tuple): (width, height) of the frame in pixels.
+            pose (tuple): (x, y, meters_per_pixel) of the frame's top-left pixel. Defaults to frame_pose.
+
+        Returns:
+            int: The number of map cells the frame added evidence to.
+        '''
+
+        if image_path in self.frames:
+            return 0
+
+        x0, y0, meters_per_pixel = pose or self.frame_pose(image_path, image_size)
+        cols = potential_hazards.grid_size[1]
+        cell_width = potential_hazards.cell_width * meters_per_pixel
+        cell_height = potential_hazards.cell_height * meters_per_pixel
+
+        # The strongest grid over a map cell wins within a frame, so overlapping grids count once
+        observed = {}
+        for label in potential_hazards.red_grids_list():
+            row, col = divmod(label - 1, cols)
+            intensity = float(potential_hazards.cell_std[row, col])
+            left = x0 + col * cell_width
+            top = y0 + row * cell_height
+            # A grid smaller than a map cell may not cover any cell center, it then goes to the cell under its own center
+            keys = self.cells_in_region(left, top, left + cell_width, top + cell_height)
+            keys = keys or [self.cell_at(left + cell_width / 2, top + cell_height / 2)]
+            for key in keys:
+                observed[key] = max(observed.get(key, 0.0), intensity)
+
+        for key, intensity in observed.items():
+            evidence = self.cells.get(key)
+            if evidence is None:
+                evidence = self.cells[key] = {'observations': 0, 'intensity': 0.0, 'max_intensity': 0.0, 'frames': set()}
+                self.buckets.setdefault(self.bucket_of(key), set()).add(key)
+            evidence['observations'] += 1
+            evidence['intensity'] += intensity
+            evidence['max_intensity'] = max(evidence['max_intensity'], intensity)
+            evidence['frames'].add(image_path)
+
+        self.frames.add(image_path)
+        return len(observed)
+
+    def cells_in_region(self, left, top, right, bottom):
+        '''
+        Returns the keys of the map cells whose centers are inside a region, whether or not they hold evidence.
+
+        Parameters:
+            left, top, right, bottom (float): The region in site meters.
+
+        Returns:
+            list: The (column, row) keys of the map cells.
+        '''
+
+        first_col = math.ceil(left / self.cell_size - 0.5)
+        last_col = math.floor(right / self.cell_size - 0.5)
+        first_row = math.ceil(top / self.cell_size - 0.5)
+        last_row = math.floor(bottom / self.cell_size - 0.5)
+        return [(col, row) for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+
+    def cell_at(self, x, y):
+        '''Returns the key of the map cell containing a point in site meters.'''
+
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def bucket_of(self, key):
+        '''Returns the spatial hash bucket a map cell belongs to.'''
+
+        return key[0] // self.bucket_size, key[1] // self.bucket_size
+
+    def query(self, left, top, right, bottom, min_observations=1):
+        '''
+        Returns the map cells with evidence inside a region. Only the buckets overlapping the region are visited, or only the occupied
+        buckets when there are fewer of those.
+
+        Parameters:
+            left, top, right, bottom (float): The region in site meters.
+            min_observations (int): The number of frames that must have seen a hazard in a map cell.
+
+        Returns:
+            dict: Maps the (column, row) of each map cell to its evidence.
+        '''
+
+        span = self.cell_size * self.bucket_size
+        first_bucket = (math.floor(left / span), math.floor(top / span))
+        last_bucket = (math.floor(right / span), math.floor(bottom / span))
+        region_buckets = (last_bucket[0] - first_bucket[0] + 1) * (last_bucket[1] - first_bucket[1] + 1)
+
+        if region_buckets <= len(self.buckets):
+            buckets = [(col, row) for row in range(first_bucket[1], last_bucket[1] + 1)
+                       for col in range(first_bucket[0], last_bucket[0] + 1)]
+        else:
+            buckets = [bucket for bucket in self.buckets
+                       if first_bucket[0] <= bucket[0] <= last_bucket[0] and first_bucket[1] <= bucket[1] <= last_bucket[1]]
+
+        found = {}
+        for bucket in buckets:
+            for key in self.buckets.get(bucket, ()):
+                evidence = self.cells[key]
+                x, y = self.cell_center(key)
+                if left <= x <= right and top <= y <= bottom and evidence['observations'] >= min_observations:
+                    found[key] = evidence
+
+        return found
+
+    def cell_center(self, key):
+        '''Returns the center of a map cell in site meters.'''
+
+        return (key[0] + 0.5) * self.cell_size, (key[1] + 0.5) * self.cell_size
+
+    def clusters(self, min_observations=1):
+        '''
+        Groups the map cells with enough evidence into clusters of connected (including diagonally) cells.
+
+        Parameters:
+            min_observations (int): The number of frames that must have seen a hazard in a map cell.
+
+        Returns:
+            list: The sets of map cell keys of each cluster.
+        '''
+
+        remaining = {key for key, evidence in self.cells.items() if evidence['observations'] >= min_observations}
+        clusters = []
+        while remaining:
+            to_visit = [remaining.pop()]
+            cluster = set(to_visit)
+            while to_visit:
+                col, row = to_visit.pop()
+                for neighbor in ((col + dx, row + dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)):
+                    if neighbor in remaining:
+                        remaining.remove(neighbor)
+                        cluster.add(neighbor)
+                        to_visit.append(neighbor)
+            clusters.append(cluster)
+
+        return clusters
+
+    def plan_paths(self, capacity, min_observations=1):
+        '''
+        Plans drone paths over the merged hazards of the whole site, through the centroid of each cluster of map cells.
+
+        Parameters:
+            capacity (float): The number of map cells a single drone can cover.
+            min_observations (int): The number of frames that must have seen a hazard in a map cell.
+
+        Returns:
+            ClusterPathPlanner: The planned paths, with centroids in site meters, or None if the map is empty.
+        '''
+
+        clusters = self.clusters(min_observations)
+        if not clusters:
+            return None
+
+        centroids = {}
+        workloads = {}
+        for label, cluster in enumerate(clusters, start=1):
+            centers = [self.cell_center(key) for key in cluster]
+            centroids[label] = (sum(x for x, y in centers) / len(centers), sum(y for x, y in centers) / len(centers))
+            workloads[label] = len(cluster)
+
+        path_planner = ClusterPathPlanner(centroids, 0)
+        path_planner.split_clusters_balanced(capacity, workloads)
+        path_planner.plan_paths()
+        return path_planner
@@ -1,6 +1,10 @@
 from grid_and_grayscale import DefineGrayScale
-from red_hazards import IdentifyHazards
+from red_hazards import IdentifyHazards, GRAYSCALE_SCALE
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import numpy as np
 import os
+import threading
 import tkinter as tk
 from tkinter import filedialog
 
@@ -18,7 +22,8 @@ class ImageProcessor:
         Sharon Gilman
     '''
 
-    def __init__(self, image_folder='drone-images', grayscale_folder='grayscale_drone_images', potential_hazards_folder='potential_hazards'):
+    def __init__(self, image_folder='drone-images', grayscale_folder='grayscale_drone_images', potential_hazards_folder='potential_hazards',
+                 grid_size=(20, 20), min_threshold=10000, max_threshold=20000, preview_max_side=2048, max_cached_pyramids=8, sample_stride=None):
         '''
         Initialize the class with the providied image folder, grayscale folder, and potential hazards folder.
 
@@ -27,11 +32,30 @@ class ImageProcessor:
             grayscale_folder (string): The path to save the processed grayscale images to.
             potential_hazards_folder (string): The path to save the processed images to. Images in this folder have highlighted red grids 
                 where potential hazards may reside.
+            grid_size (tuple): Number of grid cells (rows, columns).
+            min_threshold (int): The minimum threshold to identify potential hazards.
+            max_threshold (int): The maximum threshold to identify potential hazards.
+            preview_max_side (int): The largest side (in pixels) of the image used for a preview. The preview is most accurate when it is
+                half the resolution of the image (see preview_moments).
+            max_cached_pyramids (int): The number of image pyramids kept for later previews, the oldest one is dropped when there are 
+                more.
+            sample_stride (int): When set, process_image (and so the confirmation of a preview) estimates the standard deviation of 
+                each grid from a sample of its pixels (see IdentifyHazards.compute_approximate_cell_std).
         '''
 
         self.image_folder = image_folder
         self.grayscale_folder = grayscale_folder
         self.potential_hazards_folder = potential_hazards_folder
+        self.grid_size = grid_size
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.preview_max_side = preview_max_side
+        self.max_cached_pyramids = max_cached_pyramids
+        self.sample_stride = sample_stride
+        self.pyramids = {}  # Cached image pyramids keyed by (image path, modification time)
+        self.preview_calibration = {}  # Reduction of a preview level -> mismatched decisions of every candidate coefficient so far
+        self.calibration_lock = threading.Lock()  # The background pass calibrates while later previews read the calibration
+        self.background = ThreadPoolExecutor(max_workers=1)  # Runs the full-resolution pass behind a preview
         ensure_directory_exists(self.grayscale_folder)
         ensure_directory_exists(self.potential_hazards_folder)
 
@@ -70,32 +94,260 @@ class ImageProcessor:
         '''
 
         image_path = os.path.join(self.image_folder, filename)
-        grayscale_path = os.path.join(self.grayscale_folder, filename)
+        basename, extension = os.path.splitext(filename)
+        # The grayscale image is 16-bit, which JPEG cannot hold, so it is always saved as PNG
+        grayscale_path = os.path.join(self.grayscale_folder, f'{basename}.png')
         potential_hazards_path = os.path.join(self.potential_hazards_folder, filename)
 
         # Process grayscale
-        grayscale = DefineGrayScale(image_path, grayscale_path, grid_size=(20, 20))
+        grayscale = DefineGrayScale(image_path, grayscale_path, grid_size=self.grid_size)
         grayscale.process_image()
 
         # Identify hazards
         potential_hazards = IdentifyHazards(
             grayscale_path, potential_hazards_path, 
-            grid_size=(20, 20), min_threshold=10000, max_threshold=20000
+            grid_size=self.grid_size, min_threshold=self.min_threshold, max_threshold=self.max_threshold, sample_stride=self.sample_stride
         )
         potential_hazards.highlight_grids()
 
+        return potential_hazards
+
+    def image_pyramid(self, image_path):
+        '''
+        Returns the image pyramid of the provided image, building and caching it on first use. The first level is decoded with Pillow's 
+        draft mode, so JPEGs are decoded directly at the largest reduced scale that still fits preview_max_side instead of at full 
+        resolution. Every following level halves the previous one until a grid cell would be smaller than 4 pixels.
+
+        Parameters:
+            image_path (string): The path to the raw image.
+
+        Returns:
+            list: The 8-bit grayscale levels of the pyramid, largest first.
+        '''
+
+        key = (image_path, os.path.getmtime(image_path))
+        if key in self.pyramids:
+            return self.pyramids[key]
+
+        image = Image.open(image_path)
+        # Draft mode only changes how JPEGs are decoded, other formats are decoded at full resolution
+        scale = 1
+        while max(image.size) > self.preview_max_side * scale:
+            scale *= 2
+        image.draft('L', (-(-image.width // scale), -(-image.height // scale)))
+        level = image.convert('L')
+        levels = [level]
+
+        min_side = 8 * max(self.grid_size)
+        while min(level.size) // 2 >= min_side:
+            level = level.reduce(2)
+            levels.append(level)
+
+        # An image that changed since it was cached is dropped, and so is the oldest pyramid when the cache is full
+        for cached in [cached for cached in self.pyramids if cached[0] == image_path]:
+            del self.pyramids[cached]
+        if len(self.pyramids) >= self.max_cached_pyramids:
+            self.pyramids.pop(next(iter(self.pyramids)))
+        self.pyramids[key] = levels
+        return levels
+
+    def preview_moments(self, preview, coarser, full_size):
+        '''
+        Computes what a preview level tells about the standard deviation of every grid cell at full resolution:
+            - variance: The variance of the cell on the preview level.
+            - lost_variance: The variance lost by halving the preview level again. Averaging a block of pixels removes the detail finer 
+                than the block, and the detail lost over the next halving predicts the detail already lost by the preview (for pixel 
+                noise, 4 / 3 * (scale ** 2 - 1) times as much).
+            - mean: The mean of the cell, which is kept by the reduction.
+            - line_fraction: The fraction of the full-resolution cell that DefineGrayScale blacks out with the grid lines.
+
+        Parameters:
+            preview (PIL.Image): The 8-bit preview level.
+            coarser (PIL.Image): The preview level halved.
+            full_size (tuple): (width, height) of the full-resolution image.
+
+        Returns:
+            dict: The (rows, columns) arrays above in 8-bit units, and the scale of the preview level.
+        '''
+
+        rows, cols = self.grid_size
+
+        def cell_moments(level):
+            pixels = np.asarray(level, dtype=np.float64)
+            cell_height, cell_width = pixels.shape[0] // rows, pixels.shape[1] // cols
+            cells = pixels[:rows * cell_height, :cols * cell_width].reshape(rows, cell_height, cols, cell_width)
+            return cells.var(axis=(1, 3)), cells.mean(axis=(1, 3))
+
+        variance, mean = cell_moments(preview)
+        coarser_variance, _ = cell_moments(coarser)
+
+        # The grid lines are the first row of every cell below the first and the first column of every cell right of the first
+        cell_width, cell_height = full_size[0] // cols, full_size[1] // rows
+        line_rows = (np.arange(rows) > 0)[:, None]
+        line_cols = (np.arange(cols) > 0)[None, :]
+        line_pixels = line_rows * cell_width + line_cols * cell_height - (line_rows & line_cols)
+
+        return {
+            'variance': variance,
+            'lost_variance': np.maximum(variance - coarser_variance, 0),
+            'mean': mean,
+            'line_fraction': line_pixels / (cell_width * cell_height),
+            'scale': full_size[0] / preview.width,
+        }
+
+    def predict_cell_std(self, moments, coefficient):
+        '''
+        Predicts the full-resolution standard deviation of every grid cell, grid lines included, from the moments of a preview level.
+
+        Parameters:
+            moments (dict): The moments of the preview level (see preview_moments).
+            coefficient (float): How many times the variance lost over the next halving was lost by the preview.
+
+        Returns:
+            numpy array: The (rows, columns) standard deviations, scaled to the 0-65535 range the thresholds use.
+        '''
+
+        variance = moments['variance'] + coefficient * moments['lost_variance']
+
+        # A fraction f of the cell is black: the variance of the mix of the cell's pixels and zeros
+        f = moments['line_fraction']
+        return np.sqrt((1 - f) * variance + f * (1 - f) * moments['mean'] ** 2) * GRAYSCALE_SCALE
+
+    def preview_coefficients(self, scale):
+        '''
+        Returns the candidate coefficients of a preview scale, from none to twice the pixel noise coefficient, and the coefficient the 
+        previews of that scale use: the candidate with the fewest mismatched decisions over the confirmed previews so far, or the pixel 
+        noise coefficient before any preview was confirmed.
+
+        Parameters:
+            scale (float): The reduction of the preview level.
+
+        Returns:
+            numpy array: The candidate coefficients.
+            float: The coefficient used.
+        '''
+
+        default = 4 / 3 * (scale ** 2 - 1)
+        candidates = default * np.linspace(0, 2, 41)
+        with self.calibration_lock:
+            mismatches = self.preview_calibration.get(round(scale, 2))
+        if mismatches is None:
+            return candidates, default
+
+        # Ties go to the candidate closest to the pixel noise coefficient
+        best = np.lexsort((np.abs(candidates - default), mismatches))[0]
+        return candidates, candidates[best]
+
+    def calibrate_preview(self, moments, potential_hazards):
+        '''
+        Counts the decisions of every candidate coefficient that the full-resolution pass of the same image contradicts, so later 
+        previews of the same scale use the coefficient that agrees best.
+
+        Parameters:
+            moments (dict): The moments of the preview level (see preview_moments).
+            potential_hazards (IdentifyHazards): The full-resolution result of the image.
+        '''
+
+        candidates, _ = self.preview_coefficients(moments['scale'])
+        flagged = potential_hazards.threshold_mask(self.min_threshold, self.max_threshold)
+
+        mismatches = np.zeros(len(candidates), dtype=np.int64)
+        for index, coefficient in enumerate(candidates):
+            std = self.predict_cell_std(moments, coefficient)
+            mismatches[index] = np.count_nonzero(((std >= self.min_threshold) & (std <= self.max_threshold)) != flagged)
+        key = round(moments['scale'], 2)
+        with self.calibration_lock:
+            self.preview_calibration[key] = self.preview_calibration.get(key, 0) + mismatches
+
+    def confirm_preview(self, filename, moments):
+        '''
+        Runs the full-resolution pass of a previewed image and calibrates the previews with it.
+
+        Parameters:
+            filename (string): The name of the image.
+            moments (dict): The moments of the preview level.
+
+        Returns:
+            IdentifyHazards: The full-resolution result.
+        '''
+
+        potential_hazards = self.process_image(filename)
+        self.calibrate_preview(moments, potential_hazards)
+        return potential_hazards
+
+    def preview_image(self, filename, confirm=True):
+        '''
+        Quickly identifies potential hazards from a reduced-resolution level of the image's pyramid and saves the preview, annotated on 
+        the level below, as <name>_preview.png. The standard deviation each grid would have at full resolution, with the grid lines of DefineGrayScale, is 
+        predicted from the level (see preview_moments), so the full-resolution thresholds apply to the preview. When confirm is True, 
+        the full-resolution process_image pass is started in the background to confirm the preview, and it calibrates later previews.
+
+        Parameters:
+            filename (string): The name of the image to preview.
+            confirm (bool): Whether to run the full-resolution pass in the background.
+
+        Returns:
+            IdentifyHazards: The potential hazards identified on the preview. Grid labels and centers match the full-resolution grid.
+            Future: The background full-resolution pass, resolving to its IdentifyHazards (None if confirm is False).
+        '''
+
+        image_path = os.path.join(self.image_folder, filename)
+        basename, extension = os.path.splitext(filename)
+        preview_path = os.path.join(self.potential_hazards_folder, f'{basename}_preview.png')
+
+        # Use the largest level that fits in the preview size, or the smallest level available, and the level below it
+        levels = self.image_pyramid(image_path)
+        index = next((index for index, level in enumerate(levels) if max(level.size) <= self.preview_max_side), len(levels) - 1)
+        preview = levels[index]
+        coarser = levels[index + 1] if index + 1 < len(levels) else preview.reduce(2)
+
+        with Image.open(image_path) as image:
+            full_size = image.size
+        moments = self.preview_moments(preview, coarser, full_size)
+        candidates, coefficient = self.preview_coefficients(moments['scale'])
+
+        potential_hazards = IdentifyHazards(
+            image_path, preview_path,
+            grid_size=self.grid_size, min_threshold=self.min_threshold, max_threshold=self.max_threshold
+        )
+        potential_hazards.cell_std = self.predict_cell_std(moments, coefficient)
+        potential_hazards.cell_width = full_size[0] // self.grid_size[1]
+        potential_hazards.cell_height = full_size[1] // self.grid_size[0]
+        potential_hazards.record_red_grids()
+        # The annotated preview is only for a quick look, so it is drawn on the smaller level and saved with light compression
+        potential_hazards.draw_grids(coarser).save(preview_path, compress_level=1)
+
+        confirmation = self.background.submit(self.confirm_preview, filename, moments) if confirm else None
+        return potential_hazards, confirmation
+
+    def close(self):
+        '''
+        Waits for the full-resolution passes still running in the background, stops the background thread and drops the cached 
+        pyramids. Closing twice has no effect.
+        '''
+
+        self.background.shutdown(wait=True)
+        self.pyramids.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 def main():
-    processor = ImageProcessor()
-    
-    # Prompt user to select an image file
-    selected_image = processor.select_image()
-    if selected_image:
-        # If an image was selected, process it individually
-        filename = os.path.basename(selected_image)
-        processor.process_image(filename)
-    else:
-        # Otherwise, process all images in the directory
-        processor.process_image_files()
+    with ImageProcessor() as processor:
+        # Prompt user to select an image file
+        selected_image = processor.select_image()
+        if selected_image:
+            # If an image was selected, preview it first and confirm it at full resolution in the background
+            filename = os.path.basename(selected_image)
+            preview, confirmation = processor.preview_image(filename)
+            print(f"{filename}: Preview number of red grids: {preview.count_red_grids()}")
+            print(f"{filename}: Number of red grids: {confirmation.result().count_red_grids()}")
+        else:
+            # Otherwise, process all images in the directory
+            processor.process_image_files()
 
 if __name__ == "__main__":
     main()
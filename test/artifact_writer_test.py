@@ -0,0 +1,100 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from artifact_writer import ArtifactWriter
+from PIL import Image
+import numpy as np
+import pytest
+import threading
+
+class BlockedImage:
+    '''An RGB image whose save waits until it is released.'''
+
+    mode = 'RGB'
+
+    def __init__(self, release, saved):
+        self.release = release
+        self.saved = saved
+
+    def save(self, path, **options):
+        self.release.wait(30)
+        self.saved.append(path)
+
+def gray_image():
+    return Image.fromarray(np.arange(64 * 48, dtype=np.uint16).reshape(48, 64) % 256)
+
+def test_disabled_kinds_are_not_saved(tmp_path):
+    with ArtifactWriter(enabled={'route': False, 'animation': False}) as writer:
+        assert writer.submit('route', str(tmp_path / 'route.png'), gray_image()) is None
+        assert writer.submit_animation(str(tmp_path / 'paths.gif'), [gray_image().convert('RGB')]) is None
+        assert writer.submit('grayscale', str(tmp_path / 'gray.png'), gray_image()) is not None
+        assert writer.is_enabled('hazards') and not writer.is_enabled('unknown')
+
+    assert os.listdir(tmp_path) == ['gray.png']
+
+def test_png_compress_level(tmp_path):
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 4, (300, 400, 3), dtype=np.uint8))
+    for level in (0, 9):
+        with ArtifactWriter(png_compress_level=level) as writer:
+            writer.submit('hazards', str(tmp_path / f'{level}.png'), image)
+
+    assert os.path.getsize(tmp_path / '0.png') > 2 * os.path.getsize(tmp_path / '9.png')
+    for level in (0, 9):
+        with Image.open(tmp_path / f'{level}.png') as saved:
+            assert np.array_equal(np.asarray(saved), np.asarray(image))
+
+def test_image_formats(tmp_path):
+    rgba = Image.new('RGBA', (40, 30), (255, 0, 0, 255))
+    with ArtifactWriter(image_format='jpg') as writer:
+        writer.submit('grayscale', str(tmp_path / 'gray.png'), gray_image())
+        writer.submit('route', str(tmp_path / 'route.png'), rgba, dpi=(300, 300))
+
+    with Image.open(tmp_path / 'gray.jpg') as saved:
+        assert (saved.format, saved.mode) == ('JPEG', 'L')
+    with Image.open(tmp_path / 'route.jpg') as saved:
+        assert (saved.format, saved.mode) == ('JPEG', 'RGB')
+
+    with ArtifactWriter(image_format='TIFF') as writer:
+        writer.submit('grayscale', str(tmp_path / 'gray.png'), gray_image())
+    with Image.open(tmp_path / 'gray.tiff') as saved:
+        assert saved.mode == 'I;16' and np.array_equal(np.asarray(saved), np.asarray(gray_image()))
+
+    with pytest.raises(ValueError, match='Cannot save images as xyz'):
+        ArtifactWriter(image_format='xyz')
+
+def test_submit_blocks_while_max_pending_are_waiting(tmp_path):
+    release = threading.Event()
+    saved = []
+    writer = ArtifactWriter(max_workers=1, max_pending=2)
+    writer.submit('hazards', str(tmp_path / '1.png'), BlockedImage(release, saved))
+    writer.submit('hazards', str(tmp_path / '2.png'), BlockedImage(release, saved))
+
+    third = threading.Thread(target=writer.submit, args=('hazards', str(tmp_path / '3.png'), BlockedImage(release, saved)))
+    third.start()
+    third.join(timeout=0.5)
+    assert third.is_alive()
+
+    release.set()
+    third.join(timeout=30)
+    assert not third.is_alive()
+    writer.close()
+    assert sorted(os.path.basename(path) for path in saved) == ['1.png', '2.png', '3.png']
+
+def test_errors_are_raised_by_flush_and_close(tmp_path):
+    writer = ArtifactWriter()
+    writer.submit('grayscale', str(tmp_path / 'missing' / 'gray.png'), gray_image())
+    writer.submit('grayscale', str(tmp_path / 'gray.png'), gray_image())
+    with pytest.raises(FileNotFoundError):
+        writer.flush()
+
+    # An error is raised once, the other artifacts are still saved
+    writer.flush()
+    assert os.path.exists(tmp_path / 'gray.png')
+
+    writer.submit('grayscale', str(tmp_path / 'missing' / 'gray.png'), gray_image())
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+    with pytest.raises(ValueError, match='closed'):
+        writer.submit('grayscale', str(tmp_path / 'gray.png'), gray_image())
+    writer.close()
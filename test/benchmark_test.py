@@ -0,0 +1,24 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from benchmark import benchmark
+import json
+
+def test_benchmark_report(tmp_path):
+    report = benchmark([1], [(320, 240)], [10], [1], work_folder=str(tmp_path))
+
+    assert report['environment']['cpu_count'] == (os.cpu_count() or 1)
+    assert {'python', 'numpy', 'platform', 'start_method', 'seed', 'repeats', 'artifacts'} <= set(report['environment'])
+    assert len(report['configurations']) == 1
+    configuration = report['configurations'][0]
+    assert {key: configuration[key] for key in ('count', 'resolution', 'grids', 'workers', 'errors')} == {
+        'count': 1, 'resolution': [320, 240], 'grids': 10, 'workers': 1, 'errors': 0}
+
+    assert configuration['images_per_second'] > 0 and len(configuration['seconds']) == 1
+    assert 0 < configuration['p50_latency'] <= configuration['p95_latency']
+    assert configuration['peak_rss_bytes'] >= configuration['peak_parent_rss_bytes'] + configuration['peak_worker_rss_bytes'] > 0
+    assert configuration['speedup'] == configuration['scaling_efficiency'] == 1.0
+
+    # The report is written as JSON by the command line
+    assert json.loads(json.dumps(report)) == report
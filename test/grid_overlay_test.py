@@ -0,0 +1,54 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from grid_overlay import GridOverlay, grid_overlay
+from PIL import Image, ImageDraw
+import numpy as np
+import pytest
+
+def draw_grids(gray_image, grid_size, red_mask):
+    '''The drawing loop GridOverlay replaced, one rectangle at a time in grid order.'''
+
+    width, height = gray_image.size
+    cell_height = height // grid_size[0]
+    cell_width = width // grid_size[1]
+    rgb_image = gray_image.convert('RGB')
+    draw = ImageDraw.Draw(rgb_image, 'RGBA')
+    label = 1
+    for row in range(grid_size[0]):
+        for col in range(grid_size[1]):
+            top = row * cell_height
+            left = col * cell_width
+            bottom = (row + 1) * cell_height
+            right = (col + 1) * cell_width
+            if red_mask[row, col]:
+                draw.rectangle([left, top, right, bottom], fill=(255, 0, 0, 30))
+                small_cell_height = (bottom - top) // 4
+                small_cell_width = (right - left) // 4
+                for i in range(4):
+                    for j in range(4):
+                        small_top = top + i * small_cell_height
+                        small_left = left + j * small_cell_width
+                        draw.rectangle([small_left, small_top, small_left + small_cell_width, small_top + small_cell_height],
+                                       outline="black")
+            draw.text((left + 5, top + 5), str(label), fill="white")
+            label += 1
+    return rgb_image
+
+@pytest.mark.parametrize('image_size, grid_size', [((1200, 900), (30, 30)), ((1203, 905), (30, 30)), ((400, 300), (3, 5)),
+                                                   ((640, 480), (40, 40))])
+def test_annotation_matches_drawing(image_size, grid_size):
+    rng = np.random.default_rng(0)
+    gray_image = Image.fromarray(rng.integers(0, 256, (image_size[1], image_size[0]), dtype=np.uint8))
+    red_mask = rng.random(grid_size) < 0.4
+    overlay = GridOverlay(image_size, grid_size)
+
+    expected = np.asarray(draw_grids(gray_image, grid_size, red_mask))
+    assert np.array_equal(np.asarray(overlay.annotate(gray_image, red_mask)), expected)
+    # Drawn again from the cached layers
+    assert np.array_equal(np.asarray(overlay.annotate(gray_image, red_mask)), expected)
+
+def test_overlays_are_cached():
+    assert grid_overlay((400, 300), (3, 5)) is grid_overlay((400, 300), (3, 5))
+    assert grid_overlay((400, 300), (3, 5)) is not grid_overlay((400, 300), (5, 3))
@@ -0,0 +1,118 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from hazard_masks import (SurveyArchive, pack_hazard_mask, unpack_hazard_mask, save_hazard_mask, load_hazard_mask,
+                          hazards_from_mask)
+from red_hazards import IdentifyHazards
+import numpy as np
+import pytest
+
+def identified_hazards(mask, cell_size=(50, 40)):
+    '''Builds an IdentifyHazards whose red grids are the flagged cells of a mask, the way identify_grids records them.'''
+
+    hazards = IdentifyHazards(None, None, mask.shape, 0.5, 1.5)
+    hazards.cell_width, hazards.cell_height = cell_size
+    hazards.cell_std = mask.astype(np.float64)
+    hazards.record_red_grids()
+    return hazards
+
+def test_pack_round_trip():
+    rng = np.random.default_rng(0)
+    for grid_size in ((1, 1), (3, 5), (8, 8), (30, 30), (7, 13)):
+        masks = rng.random((4,) + grid_size) < 0.3
+        packed = np.stack([pack_hazard_mask(mask) for mask in masks])
+
+        assert packed.dtype == np.uint8 and packed.shape == (4, -(-grid_size[0] * grid_size[1] // 8))
+        assert np.array_equal(unpack_hazard_mask(packed[0], grid_size), masks[0])
+        assert np.array_equal(unpack_hazard_mask(packed, grid_size), masks)
+
+def test_save_load_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    mask = rng.random((30, 30)) < 0.3
+    hazards = identified_hazards(mask)
+    save_hazard_mask(str(tmp_path / 'frame.hzm'), hazards, (1500, 1200))
+
+    assert os.path.getsize(tmp_path / 'frame.hzm') == 137
+    loaded = load_hazard_mask(str(tmp_path / 'frame.hzm'))
+    assert loaded['grid_size'] == (30, 30)
+    assert loaded['cell_size'] == (50, 40)
+    assert loaded['image_size'] == (1500, 1200)
+    assert np.array_equal(unpack_hazard_mask(loaded['packed'], loaded['grid_size']), mask)
+
+    # The loaded mask gives back the red grids and centers identify_grids recorded
+    restored = hazards_from_mask(unpack_hazard_mask(loaded['packed'], (30, 30)), loaded['grid_size'], loaded['cell_size'])
+    assert restored.red_grids_list() == hazards.red_grids_list()
+    assert restored.grid_info() == hazards.grid_info()
+    assert restored.count_red_grids() == hazards.count_red_grids()
+
+def test_load_rejects_other_files(tmp_path):
+    (tmp_path / 'frame.hzm').write_bytes(b'\x89PNG' + bytes(40))
+    with pytest.raises(ValueError, match='not a hazard mask'):
+        load_hazard_mask(str(tmp_path / 'frame.hzm'))
+
+def test_archive_matches_boolean_masks(tmp_path):
+    rng = np.random.default_rng(2)
+    surveys = ['2024-05', '2024-06', '2024-07', '2024-08']
+    masks = rng.random((len(surveys), 30, 30)) < 0.3
+    for survey, mask in zip(surveys, masks):
+        os.mkdir(tmp_path / survey)
+        save_hazard_mask(str(tmp_path / survey / 'frame.hzm'), identified_hazards(mask), (1500, 1200))
+
+    # The second frame is missing from the second survey
+    other = rng.random((30, 30)) < 0.3
+    for survey in surveys[::2] + surveys[3:]:
+        save_hazard_mask(str(tmp_path / survey / 'other.hzm'), identified_hazards(other), (1500, 1200))
+
+    archive = SurveyArchive()
+    for survey in surveys:
+        archive.add_survey(survey, str(tmp_path / survey))
+
+    changes = archive.changes('frame', '2024-05', '2024-07')
+    assert np.array_equal(changes['new'], masks[2] & ~masks[0])
+    assert np.array_equal(changes['resolved'], masks[0] & ~masks[2])
+    assert np.array_equal(changes['persistent'], masks[0] & masks[2])
+
+    counts = archive.change_counts('frame')
+    assert counts['new'].tolist() == (masks[1:] & ~masks[:-1]).sum(axis=(1, 2)).tolist()
+    assert counts['resolved'].tolist() == (masks[:-1] & ~masks[1:]).sum(axis=(1, 2)).tolist()
+    assert counts['persistent'].tolist() == (masks[:-1] & masks[1:]).sum(axis=(1, 2)).tolist()
+    assert np.array_equal(archive.persistence('frame'), masks.sum(axis=0))
+
+    assert np.array_equal(archive.persistence('other'), other * 3)
+    assert archive.change_counts('other')['new'].tolist() == [0, other.sum(), 0]
+
+def loaded_mask(mask, cell_size=(50, 40)):
+    return {'grid_size': mask.shape, 'cell_size': cell_size, 'image_size': (1500, 1200), 'packed': pack_hazard_mask(mask)}
+
+def test_archive_rejects_mismatched_masks():
+    archive = SurveyArchive()
+    archive.add_masks('2024-05', {'frame': loaded_mask(np.eye(30, dtype=bool))})
+
+    with pytest.raises(ValueError, match=r'\(20, 20\) grid'):
+        archive.add_masks('2024-06', {'frame': loaded_mask(np.eye(20, dtype=bool))})
+    with pytest.raises(ValueError, match=r'\(60, 40\) cells'):
+        archive.add_masks('2024-06', {'frame': loaded_mask(np.eye(30, dtype=bool), (60, 40))})
+    truncated = dict(loaded_mask(np.eye(30, dtype=bool)), packed=pack_hazard_mask(np.eye(30, dtype=bool))[:-1])
+    with pytest.raises(ValueError, match='112 bytes of mask'):
+        archive.add_masks('2024-06', {'other': loaded_mask(np.eye(30, dtype=bool)), 'frame': truncated})
+
+    # A rejected survey leaves the archive unchanged
+    assert archive.surveys == ['2024-05'] and list(archive.frames) == ['frame']
+    assert archive.frames['frame']['packed'].shape == (1, 113)
+
+def test_replan_new_red_grids():
+    before = np.zeros((30, 30), dtype=bool)
+    before[2:5, 2:5] = True
+    after = before.copy()
+    after[20:23, 10:12] = True
+    archive = SurveyArchive()
+    archive.add_masks('2024-05', {'frame': loaded_mask(before), 'wide': loaded_mask(before[:20])})
+    archive.add_masks('2024-06', {'frame': loaded_mask(after), 'wide': loaded_mask(after[:20])})
+
+    path_planner = archive.replan('frame', '2024-05', '2024-06')
+    assert path_planner.centroids == {1: (11 * 50, 21.5 * 40)}
+    assert archive.replan('frame', '2024-06', '2024-05') is None
+
+    with pytest.raises(ValueError, match='20 x 30 grid'):
+        archive.replan('wide', '2024-05', '2024-06')
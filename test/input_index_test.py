@@ -0,0 +1,62 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from input_index import InputIndex
+from PIL import Image, ImageFile
+import numpy as np
+import subprocess
+
+GPS = {1: 'N', 2: (40.0, 26.0, 46.0), 3: 'W', 4: (79.0, 58.0, 56.0), 6: 60.0}
+
+def save_image(path, size, image_format, gps=None):
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+    if gps is None:
+        image.save(path, image_format)
+        return
+    exif = Image.Exif()
+    exif[0x8825] = gps
+    image.save(path, image_format, exif=exif.tobytes())
+
+def test_scan_never_decodes(tmp_path, monkeypatch):
+    save_image(tmp_path / 'small.png', (64, 48), 'PNG', GPS)
+    save_image(tmp_path / 'large.png', (320, 240), 'PNG')
+    save_image(tmp_path / 'photo.jpg', (128, 96), 'JPEG', GPS)
+    (tmp_path / 'notes.png').write_text('not an image')
+
+    loads = []
+    original_load = ImageFile.ImageFile.load
+    def counting_load(self):
+        loads.append(self)
+        return original_load(self)
+    monkeypatch.setattr(ImageFile.ImageFile, 'load', counting_load)
+
+    index = InputIndex(str(tmp_path), extensions=('.png', '.jpg'))
+    entries = {entry['filename']: entry for entry in index.scan()}
+
+    assert loads == [], f"scan decoded {len(loads)} images."
+    assert set(entries) == {'small.png', 'large.png', 'photo.jpg'}
+    assert 'notes.png' in index.skipped
+    assert (entries['large.png']['width'], entries['large.png']['height']) == (320, 240)
+    assert entries['small.png']['gps'] is not None and abs(entries['small.png']['gps'][0] - 40.446) < 1e-3
+    assert entries['photo.jpg']['gps'] is not None and entries['photo.jpg']['gps'][1] < 0
+    assert entries['large.png']['gps'] is None
+
+def test_schedule_and_makespan(tmp_path):
+    for index, size in enumerate(((64, 48), (320, 240), (128, 96))):
+        save_image(tmp_path / f'{index}.png', size, 'PNG')
+
+    index = InputIndex(str(tmp_path), seconds_per_image=0.0, seconds_per_megapixel=1e6 / (64 * 48))
+    index.scan()
+
+    # The images cost 1, 25 and 4 seconds
+    assert [entry['filename'] for entry in index.schedule()] == ['1.png', '2.png', '0.png']
+    assert abs(index.estimate_makespan(1) - 30) < 1e-9
+    assert abs(index.estimate_makespan(2) - 25) < 1e-9
+
+def test_index_does_not_import_the_planner():
+    # The index only reads headers, so it must not pull in the path planner's scikit-learn and matplotlib
+    code = ('import sys; sys.path.insert(0, sys.argv[1]); import input_index; '
+            'print(sorted({name.split(".")[0] for name in sys.modules} & {"site_map", "path_planning", "sklearn", "matplotlib"}))')
+    source = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+    assert subprocess.run([sys.executable, '-c', code, source], capture_output=True, text=True, check=True).stdout.strip() == '[]'
@@ -0,0 +1,179 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from neighbors import IdentifyNeighbors, adjacency_table, flag_mask
+import numpy as np
+
+def reference_adjacent_grids(n, b):
+    '''The original per-grid neighbor rules of a b x b grid.'''
+
+    adjacent = set()
+    if n > b:
+        adjacent.add(n - b)
+    if n <= b * (b - 1):
+        adjacent.add(n + b)
+    if (n - 1) % b != 0:
+        adjacent.add(n - 1)
+    if n % b != 0:
+        adjacent.add(n + 1)
+    if n > b and (n - 1) % b != 0:
+        adjacent.add(n - b - 1)
+    if n > b and n % b != 0:
+        adjacent.add(n - b + 1)
+    if n <= b * (b - 1) and (n - 1) % b != 0:
+        adjacent.add(n + b - 1)
+    if n <= b * (b - 1) and n % b != 0:
+        adjacent.add(n + b + 1)
+    return adjacent
+
+def reference_connected_set(start, b, valid_numbers):
+    '''The original set-based search.'''
+
+    visited = set()
+    to_visit = {start}
+    while to_visit:
+        current = to_visit.pop()
+        if current not in visited:
+            visited.add(current)
+            to_visit.update(reference_adjacent_grids(current, b) & valid_numbers - visited)
+    return visited
+
+def test_adjacent_grids_match_reference():
+    neighbors = IdentifyNeighbors((100, 100), 0)
+    for b in (1, 2, 5, 30):
+        for n in range(1, b * b + 1):
+            assert neighbors.get_adjacent_grids(n, b) == reference_adjacent_grids(n, b), (b, n)
+
+def test_adjacency_table_matches_reference():
+    for b in (1, 2, 5, 30):
+        offsets, indices = adjacency_table(b)
+        for n in range(1, b * b + 1):
+            neighbors = indices[offsets[n - 1]:offsets[n]] + 1
+            assert len(neighbors) == len(set(neighbors.tolist()))
+            assert set(neighbors.tolist()) == reference_adjacent_grids(n, b), (b, n)
+
+def test_adjacency_table_four_connectivity():
+    rows, cols = 4, 7
+    offsets, indices = adjacency_table((rows, cols), connectivity=4)
+    for index in range(rows * cols):
+        row, col = divmod(index, cols)
+        expected = {r * cols + c for r, c in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1))
+                    if 0 <= r < rows and 0 <= c < cols}
+        assert set(indices[offsets[index]:offsets[index + 1]].tolist()) == expected
+
+def test_connected_set_matches_reference():
+    rng = np.random.default_rng(0)
+    neighbors = IdentifyNeighbors((100, 100), 0)
+    for b in (1, 3, 10, 30):
+        for density in (0.2, 0.5, 0.8):
+            valid_numbers = set((np.flatnonzero(rng.random(b * b) < density) + 1).tolist())
+            valid_mask = flag_mask(valid_numbers, b * b)
+            for start in valid_numbers:
+                expected = reference_connected_set(start, b, valid_numbers)
+                assert neighbors.compute_connected_set(start, b, valid_numbers) == expected
+                assert neighbors.compute_connected_set(start, b, valid_mask) == expected
+
+def test_connected_set_follows_changed_valid_numbers():
+    neighbors = IdentifyNeighbors((100, 100), 0)
+    valid_numbers = {1, 2, 3}
+    assert neighbors.compute_connected_set(1, 5, valid_numbers) == {1, 2, 3}
+
+    # Same set object and size, different members
+    valid_numbers.discard(3)
+    valid_numbers.add(25)
+    assert neighbors.compute_connected_set(1, 5, valid_numbers) == {1, 2}
+
+def test_flagged_neighbors_and_border_match_brute_force():
+    rng = np.random.default_rng(1)
+    neighbors = IdentifyNeighbors((100, 100), 0)
+    b = 12
+    flagged = set((np.flatnonzero(rng.random(b * b) < 0.4) + 1).tolist())
+    grids = set((np.flatnonzero(rng.random(b * b) < 0.1) + 1).tolist())
+
+    expected = set().union(*(reference_adjacent_grids(n, b) for n in grids)) & flagged - grids
+    assert neighbors.flagged_neighbors(grids, flagged, b).tolist() == sorted(expected)
+
+    border = [n for n in sorted(flagged) if not reference_adjacent_grids(n, b) <= flagged]
+    assert neighbors.hazard_border(flagged, b).tolist() == border
+
+def reference_cluster_statistics(labels, cell_size, cell_values):
+    '''Computes the statistics of each cluster in turn from its cells.'''
+
+    cell_width, cell_height = cell_size
+    statistics = []
+    for label in range(1, int(labels.max(initial=0)) + 1):
+        rows, cols = np.nonzero(labels == label)
+        if not len(rows):
+            statistics.append((0, (0.0, 0.0), None, 0.0, 0.0))
+            continue
+        x = (cols + 0.5) * cell_width
+        y = (rows + 0.5) * cell_height
+        mu_xx = ((x - x.mean()) ** 2).mean()
+        mu_yy = ((y - y.mean()) ** 2).mean()
+        mu_xy = ((x - x.mean()) * (y - y.mean())).mean()
+        statistics.append((
+            len(rows),
+            (x.mean(), y.mean()),
+            (cols.min() * cell_width, rows.min() * cell_height, (cols.max() + 1) * cell_width, (rows.max() + 1) * cell_height),
+            cell_values[rows, cols].mean(),
+            0.5 * np.arctan2(2 * mu_xy, mu_xx - mu_yy),
+        ))
+    return statistics
+
+def same_axis(angle, other):
+    '''Whether two angles give the same axis, which is the same at +pi/2 and -pi/2.'''
+
+    difference = np.mod(angle - other, np.pi)
+    return min(difference, np.pi - difference) < 1e-9
+
+def test_cluster_statistics_match_brute_force():
+    # A horizontal bar, a vertical bar, a diagonal and an L shape, with label 5 left without cells
+    labels = np.zeros((8, 10), dtype=int)
+    labels[0, 1:5] = 1
+    labels[2:7, 8] = 2
+    labels[[2, 3, 4, 5], [1, 2, 3, 4]] = 3
+    labels[6:8, 0] = 4
+    labels[7, 1:3] = 4
+    labels[0, 9] = 6
+    cell_values = np.random.default_rng(0).uniform(0, 65535, labels.shape)
+    neighbors = IdentifyNeighbors((1000, 800), 0)
+    statistics = neighbors.cluster_statistics(labels, (100, 100), cell_values)
+
+    assert statistics['label'].tolist() == [1, 2, 3, 4, 5, 6]
+    for index, (area, centroid, bbox, intensity, orientation) in enumerate(reference_cluster_statistics(labels, (100, 100), cell_values)):
+        assert statistics['area'][index] == area
+        assert np.allclose(statistics['centroid'][index], centroid)
+        if area:
+            assert statistics['bbox'][index].tolist() == list(bbox)
+        assert np.isclose(statistics['intensity'][index], intensity)
+        assert same_axis(statistics['orientation'][index], orientation), index
+
+    # Horizontal, vertical and diagonal (down and to the right in pixel coordinates) major axes
+    assert same_axis(statistics['orientation'][0], 0)
+    assert same_axis(statistics['orientation'][1], np.pi / 2)
+    assert same_axis(statistics['orientation'][2], np.pi / 4)
+
+    # Without cell values every cell counts as 1
+    assert neighbors.cluster_statistics(labels, (100, 100))['intensity'].tolist() == [1, 1, 1, 1, 0, 1]
+
+def test_cluster_statistics_without_clusters():
+    statistics = IdentifyNeighbors((1000, 800), 0).cluster_statistics(np.zeros((5, 5), dtype=int), (10, 10))
+
+    assert statistics['label'].size == statistics['area'].size == statistics['intensity'].size == 0
+    assert statistics['centroid'].shape == (0, 2)
+    assert statistics['bbox'].shape == (0, 4)
+
+def test_cluster_centers_match_reference():
+    rng = np.random.default_rng(3)
+    neighbors = IdentifyNeighbors((1200, 900), 0)
+    b = 12
+    cells = rng.permutation(np.arange(1, b * b + 1))
+    clusters = [set(cells[start:start + size].tolist()) for start, size in ((0, 1), (1, 5), (6, 12), (18, 3))]
+    centers = neighbors.compute_cluster_centers(clusters, b)
+
+    assert list(centers) == [1, 2, 3, 4]
+    for label, cluster in enumerate(clusters, start=1):
+        expected_x = sum(((grid - 1) % b + 0.5) * 1200 / b for grid in cluster) / len(cluster)
+        expected_y = sum(((grid - 1) // b + 0.5) * 900 / b for grid in cluster) / len(cluster)
+        assert np.allclose(centers[label], (expected_x, expected_y))
@@ -0,0 +1,55 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from path_planning import ClusterPathPlanner
+import numpy as np
+import time
+
+def group_workloads(groups, workloads):
+    return [sum(workloads[node] for node in group) for group in groups.values()]
+
+def test_balanced_groups_fit_capacity():
+    planner = ClusterPathPlanner({1: (0.0, 0.0), 2: (10.0, 0.0), 3: (20.0, 0.0)}, 0)
+    workloads = {1: 29, 2: 29, 3: 2}
+    groups = planner.split_clusters_balanced(30, workloads)
+
+    assert planner.num_groups == 3
+    assert max(group_workloads(groups, workloads)) <= 30
+    assert sorted(node for group in groups.values() for node in group) == [1, 2, 3]
+
+def test_balanced_groups_fit_capacity_random():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        count = int(rng.integers(1, 40))
+        centroids = {node: tuple(rng.uniform(0, 1000, 2)) for node in range(1, count + 1)}
+        workloads = {node: int(rng.integers(1, 30)) for node in centroids}
+        planner = ClusterPathPlanner(centroids, 0)
+        groups = planner.split_clusters_balanced(30, workloads)
+
+        assert len(groups) == planner.num_groups >= np.ceil(sum(workloads.values()) / 30)
+        assert max(group_workloads(groups, workloads)) <= 30
+        assert sorted(node for group in groups.values() for node in group) == sorted(centroids)
+
+def test_oversized_cluster_gets_its_own_drone():
+    planner = ClusterPathPlanner({1: (0.0, 0.0), 2: (1.0, 0.0), 3: (2.0, 0.0)}, 0)
+    workloads = {1: 45, 2: 10, 3: 10}
+    groups = planner.split_clusters_balanced(30, workloads)
+
+    assert [1] in groups.values()
+    assert all(sum(workloads[node] for node in group) <= 30 for group in groups.values() if group != [1])
+
+def test_balanced_groups_scale_to_thousands_of_centroids():
+    rng = np.random.default_rng(1)
+    centroids = {node: tuple(rng.uniform(0, 4000, 2)) for node in range(1, 5001)}
+    workloads = {node: int(rng.integers(1, 30)) for node in centroids}
+    planner = ClusterPathPlanner(centroids, 0)
+
+    start = time.perf_counter()
+    groups = planner.split_clusters_balanced(30, workloads)
+    assert time.perf_counter() - start < 5
+
+    lower_bound = np.ceil(sum(workloads.values()) / 30)
+    assert lower_bound <= len(groups) <= 2 * lower_bound
+    assert max(group_workloads(groups, workloads)) <= 30
+    assert sorted(node for group in groups.values() for node in group) == sorted(centroids)
@@ -0,0 +1,129 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from pipeline import PipelinedExecutor, SharedFrameRing
+from main import process_image_files
+import main
+import pipeline
+from artifact_writer import ArtifactWriter
+from benchmark import generate_corpus
+from PIL import Image
+import numpy as np
+import threading
+
+# The animations are slow to save and are covered by the artifact writer's own options
+ENABLED = {'animation': False}
+FOLDERS = ('grayscale', 'hazards', 'grid_coords', 'drone_paths')
+
+def output_folders(root):
+    return [str(root / folder) for folder in FOLDERS]
+
+def count_free_slots(monkeypatch):
+    '''Records how many slots are free when the parent frees the ring at the end of a run.'''
+
+    free_slots = []
+    close = SharedFrameRing.close
+
+    def counting_close(ring, unlink=False):
+        if unlink:
+            count = 0
+            while count < ring.slots:
+                try:
+                    ring.free_slots.get(timeout=1)
+                except Exception:
+                    break
+                count += 1
+            free_slots.append((count, ring.slots))
+        close(ring, unlink)
+
+    monkeypatch.setattr(SharedFrameRing, 'close', counting_close)
+    return free_slots
+
+def assert_same_files(expected_folder, actual_folder, same_pixels=True):
+    filenames = sorted(os.listdir(expected_folder))
+    assert filenames == sorted(os.listdir(actual_folder))
+    for filename in filenames:
+        expected = os.path.join(expected_folder, filename)
+        actual = os.path.join(actual_folder, filename)
+        if filename.endswith('.png'):
+            with Image.open(expected) as expected_image, Image.open(actual) as actual_image:
+                assert expected_image.size == actual_image.size, filename
+                if same_pixels:
+                    assert np.array_equal(np.asarray(expected_image), np.asarray(actual_image)), filename
+        else:
+            with open(expected, 'rb') as expected_file, open(actual, 'rb') as actual_file:
+                assert expected_file.read() == actual_file.read(), filename
+
+def test_pipeline_matches_sequential(tmp_path, monkeypatch):
+    filenames = generate_corpus(str(tmp_path / 'images'), 3, (320, 240))
+    free_slots = count_free_slots(monkeypatch)
+
+    writer = ArtifactWriter(enabled=ENABLED)
+    process_image_files(str(tmp_path / 'images'), *output_folders(tmp_path / 'sequential'), 10, writer=writer)
+    writer.close()
+
+    executor = PipelinedExecutor(workers={'detect': 2}, writer_options={'enabled': ENABLED})
+    results = executor.run(str(tmp_path / 'images'), *output_folders(tmp_path / 'pipelined'), 10)
+
+    assert sorted(result['filename'] for result in results) == filenames
+    assert all(result['error'] is None for result in results)
+    assert all(result['queued'] <= result['started'] <= result['finished'] for result in results)
+    # The paths are drawn in random colors, so only the route images' sizes are compared
+    for folder in FOLDERS:
+        assert_same_files(str(tmp_path / 'sequential' / folder), str(tmp_path / 'pipelined' / folder), folder != 'drone_paths')
+
+    # Every slot is back in the ring, and every worker reported its memory
+    assert free_slots == [(executor.ring_slots, executor.ring_slots)]
+    assert len(executor.worker_stats) == 5
+
+def test_failing_images_come_back_with_their_error(tmp_path, monkeypatch):
+    generate_corpus(str(tmp_path / 'images'), 2, (320, 240))
+    (tmp_path / 'images' / 'broken.png').write_bytes(b'not an image')
+    # A header that reads fine in front of data that cannot be decoded
+    with open(tmp_path / 'images' / '00000.png', 'rb') as image_file:
+        data = image_file.read()
+    (tmp_path / 'images' / 'truncated.png').write_bytes(data[:len(data) // 2])
+    free_slots = count_free_slots(monkeypatch)
+
+    executor = PipelinedExecutor(writer_options={'enabled': ENABLED}, ring_slots=2)
+    filenames = ['broken.png', '00000.png', 'truncated.png', '00001.png']
+    results = []
+    run = threading.Thread(target=lambda: results.extend(
+        executor.run(str(tmp_path / 'images'), *output_folders(tmp_path / 'pipelined'), 10, filenames=filenames)))
+    run.start()
+    run.join(timeout=120)
+
+    assert not run.is_alive()
+    errors = {result['filename']: result['error'] for result in results}
+    assert sorted(errors) == sorted(filenames)
+    assert errors['00000.png'] is None and errors['00001.png'] is None
+    assert 'Traceback' in errors['broken.png'] and 'Traceback' in errors['truncated.png']
+    assert free_slots == [(2, 2)]
+    assert sorted(os.listdir(tmp_path / 'pipelined' / 'grayscale')) == ['00000.png', '00001.png']
+
+def record_sample_strides(module, path, monkeypatch):
+    '''Appends the sample_stride of every detect_hazards call of a module to a file, which forked workers share.'''
+
+    detect_hazards = module.detect_hazards
+
+    def recording_detect_hazards(grayscale_image, row_and_column_grids, sample_stride=None, workers=None):
+        with open(path, 'a') as record:
+            record.write(f'{sample_stride}\n')
+        return detect_hazards(grayscale_image, row_and_column_grids, sample_stride, workers)
+
+    monkeypatch.setattr(module, 'detect_hazards', recording_detect_hazards)
+
+def test_sample_stride_reaches_detection(tmp_path, monkeypatch):
+    generate_corpus(str(tmp_path / 'images'), 2, (640, 480))
+    record_sample_strides(main, tmp_path / 'sequential.txt', monkeypatch)
+    record_sample_strides(pipeline, tmp_path / 'pipelined.txt', monkeypatch)
+
+    with ArtifactWriter(enabled=ENABLED) as writer:
+        process_image_files(str(tmp_path / 'images'), *output_folders(tmp_path / 'sequential'), 10, writer=writer, sample_stride=4)
+    executor = PipelinedExecutor(writer_options={'enabled': ENABLED}, start_method='fork', sample_stride=4)
+    results = executor.run(str(tmp_path / 'images'), *output_folders(tmp_path / 'pipelined'), 10)
+
+    assert all(result['error'] is None for result in results)
+    assert (tmp_path / 'sequential.txt').read_text() == (tmp_path / 'pipelined.txt').read_text() == '4\n4\n'
+    assert_same_files(str(tmp_path / 'sequential' / 'grid_coords'), str(tmp_path / 'pipelined' / 'grid_coords'))
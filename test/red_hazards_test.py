@@ -0,0 +1,167 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from red_hazards import IdentifyHazards, GRAYSCALE_SCALE, count_clusters
+from main import decode_image, detect_hazards, calculate_adjustment_factor
+from benchmark import generate_corpus
+from PIL import Image
+import numpy as np
+
+def make_cells(rows=30, cols=30, cell_height=40, cell_width=50, seed=0):
+    '''Builds a grayscale image whose cells have standard deviations spread across both thresholds, with grid lines on their borders.'''
+
+    rng = np.random.default_rng(seed)
+    spreads = rng.uniform(20, 90, size=(rows, cols))
+    pixels = 128 + rng.standard_normal((rows, cell_height, cols, cell_width)) * spreads[:, None, :, None]
+    pixels[:, 0, :, :] = 0
+    pixels[:, :, :, 0] = 0
+    return np.clip(pixels, 0, 255).astype(np.uint16).reshape(rows * cell_height, cols * cell_width)
+
+def test_sampled_decisions_match_exact():
+    pixels = make_cells()
+    exact = IdentifyHazards(None, None, (30, 30), 10000, 20000)
+    exact.compute_cell_std(pixels)
+    exact_mask = exact.threshold_mask(10000, 20000)
+
+    for stride in (2, 3, 4, 8):
+        sampled = IdentifyHazards(None, None, (30, 30), 10000, 20000, sample_stride=stride)
+        sampled.compute_approximate_cell_std(pixels, stride)
+
+        assert (sampled.threshold_mask(10000, 20000) == exact_mask).all(), stride
+        assert sampled.exact_cells.any()
+        assert np.allclose(sampled.cell_std[sampled.exact_cells], exact.cell_std[sampled.exact_cells])
+        lower, upper = sampled.cell_std_interval
+        assert (lower <= sampled.cell_std).all() and (sampled.cell_std <= upper).all()
+
+def test_sampled_cells_too_small_fall_back_to_exact():
+    pixels = make_cells(cell_height=4, cell_width=4)
+    sampled = IdentifyHazards(None, None, (30, 30), 10000, 20000)
+    exact = IdentifyHazards(None, None, (30, 30), 10000, 20000)
+
+    assert np.array_equal(sampled.compute_approximate_cell_std(pixels, 8), exact.compute_cell_std(pixels))
+
+def test_sampled_detection_matches_exact(tmp_path):
+    # The generated hazards have sharp edges, where a sliver narrower than the stride can be missed by the lattice, so at most one
+    # grid in a thousand may differ
+    filenames = generate_corpus(str(tmp_path), 2, (1200, 900), seed=3)
+    differences = decisions = 0
+    for filename in filenames:
+        grayscale_image = decode_image(str(tmp_path / filename), 30)
+        exact = detect_hazards(grayscale_image, 30)
+
+        for stride in (2, 4, 8):
+            sampled = detect_hazards(grayscale_image, 30, sample_stride=stride)
+            differences += len(set(sampled.red_grids) ^ set(exact.red_grids))
+            decisions += 30 * 30
+
+    assert differences <= decisions / 1000
+
+def test_sampled_brightness():
+    image = Image.fromarray(make_cells())
+    exact = calculate_adjustment_factor(image)
+
+    assert abs(exact - np.asarray(image).mean() / 65535) < 1e-12
+    for stride in (2, 4, 8):
+        assert abs(calculate_adjustment_factor(image, stride) - exact) < 0.05 * exact
+
+def test_workers_match_single_thread():
+    pixels = make_cells()
+    single = IdentifyHazards(None, None, (30, 30), 10000, 20000)
+    threaded = IdentifyHazards(None, None, (30, 30), 10000, 20000, workers=4)
+
+    assert np.array_equal(threaded.compute_cell_std(pixels), single.compute_cell_std(pixels))
+    assert np.array_equal(threaded.compute_approximate_cell_std(pixels, 4), single.compute_approximate_cell_std(pixels, 4))
+    assert np.array_equal(threaded.exact_cells, single.exact_cells)
+
+    image = Image.fromarray(pixels)
+    assert abs(calculate_adjustment_factor(image, workers=4) - calculate_adjustment_factor(image)) < 1e-12
+    assert detect_hazards(image, 30, sample_stride=2, workers=3).red_grids == detect_hazards(image, 30, sample_stride=2).red_grids
+
+def reference_cell_std(grayscale_array, grid_size):
+    '''The original per-cell loop.'''
+
+    grayscale_array = np.array(grayscale_array, dtype=np.float32) * GRAYSCALE_SCALE
+    height, width = grayscale_array.shape
+    cell_height = height // grid_size[0]
+    cell_width = width // grid_size[1]
+    cell_std = np.zeros(grid_size, dtype=np.float64)
+    for row in range(grid_size[0]):
+        for col in range(grid_size[1]):
+            cell_std[row, col] = np.std(grayscale_array[row * cell_height:(row + 1) * cell_height, col * cell_width:(col + 1) * cell_width])
+    return cell_std
+
+def reference_cluster_count(mask):
+    '''Counts the 8-connected clusters of a mask by searching from every flagged cell not visited yet.'''
+
+    rows, cols = mask.shape
+    visited = np.zeros_like(mask, dtype=bool)
+    clusters = 0
+    for row in range(rows):
+        for col in range(cols):
+            if not mask[row, col] or visited[row, col]:
+                continue
+            clusters += 1
+            to_visit = [(row, col)]
+            visited[row, col] = True
+            while to_visit:
+                r, c = to_visit.pop()
+                for nr in range(max(r - 1, 0), min(r + 2, rows)):
+                    for nc in range(max(c - 1, 0), min(c + 2, cols)):
+                        if mask[nr, nc] and not visited[nr, nc]:
+                            visited[nr, nc] = True
+                            to_visit.append((nr, nc))
+    return clusters
+
+def test_cell_std_matches_loop():
+    # Sizes that are not a multiple of the grid leave the last rows and columns out
+    for shape, grid_size in (((1200, 1500), (30, 30)), ((907, 1213), (30, 30)), ((300, 400), (7, 3))):
+        pixels = make_cells()[:shape[0], :shape[1]]
+        hazards = IdentifyHazards(None, None, grid_size, 10000, 20000)
+
+        assert np.allclose(hazards.compute_cell_std(pixels), reference_cell_std(pixels, grid_size), rtol=1e-5)
+
+def test_identify_grids_matches_loop():
+    image = Image.fromarray(make_cells())
+    hazards = IdentifyHazards(None, None, (30, 30), 10000, 20000)
+    hazards.identify_grids(image)
+
+    cell_std = reference_cell_std(np.asarray(image), (30, 30))
+    rows, cols = np.nonzero((10000 <= cell_std) & (cell_std <= 20000))
+    assert hazards.red_grids == (rows * 30 + cols + 1).tolist()
+    assert hazards.red_grids_coords == [{"label": row * 30 + col + 1, "center": (col * 50 + 25, row * 40 + 20)}
+                                        for row, col in zip(rows.tolist(), cols.tolist())]
+
+def test_count_clusters_matches_loop():
+    rng = np.random.default_rng(1)
+    masks = rng.random((4, 25, 13, 17)) < np.linspace(0.05, 0.9, 25)[None, :, None, None]
+
+    counts = count_clusters(masks)
+    assert counts.shape == (4, 25)
+    for index in np.ndindex(counts.shape):
+        assert counts[index] == reference_cluster_count(masks[index]), index
+
+    # A single mask, and a snake that only connects through its far end
+    snake = np.zeros((7, 7), dtype=bool)
+    snake[::2, :6] = True
+    snake[1::4, 5] = True
+    snake[3::4, 0] = True
+    assert count_clusters(snake) == reference_cluster_count(snake) == 1
+
+def test_sweep_matches_threshold_loop():
+    hazards = IdentifyHazards(None, None, (30, 30), 10000, 20000)
+    hazards.compute_cell_std(make_cells())
+    min_thresholds = [5000, 9000, 12000, 15000]
+    max_thresholds = [14000, 18000, 25000]
+    sweep = hazards.sweep_thresholds(min_thresholds, max_thresholds)
+
+    for i, min_threshold in enumerate(min_thresholds):
+        for j, max_threshold in enumerate(max_thresholds):
+            hazards.min_threshold, hazards.max_threshold = min_threshold, max_threshold
+            hazards.record_red_grids()
+            mask = hazards.threshold_mask(min_threshold, max_threshold)
+
+            assert (sweep['min_threshold'][i, j], sweep['max_threshold'][i, j]) == (min_threshold, max_threshold)
+            assert np.array_equal(sweep['masks'][i, j], mask)
+            assert sweep['hazard_counts'][i, j] == hazards.count_red_grids()
+            assert sweep['cluster_counts'][i, j] == reference_cluster_count(mask)
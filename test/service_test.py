@@ -0,0 +1,128 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import service
+from service import DetectionService, analyze_image
+from benchmark import generate_corpus
+import asyncio
+import base64
+import json
+import threading
+
+async def request(socket_path, method, path, body=b'', headers=None, send_body=True):
+    '''Sends one HTTP request over the Unix socket and returns the status and the JSON payload of the response.'''
+
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    headers = dict({'Content-Length': str(len(body)), 'Connection': 'close'}, **(headers or {}))
+    head = f'{method} {path} HTTP/1.1\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in headers.items()) + '\r\n'
+    writer.write(head.encode('latin-1') + (body if send_body else b''))
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload)
+
+def serve(socket_path, run_requests, **options):
+    '''Starts a service on the socket, runs the requests against it and stops it.'''
+
+    async def run():
+        detection_service = DetectionService(**options)
+        await detection_service.start(unix_path=socket_path)
+        try:
+            return await run_requests(detection_service)
+        finally:
+            await detection_service.stop()
+
+    return asyncio.run(run())
+
+def test_detect_requests(tmp_path):
+    image_path = generate_corpus(str(tmp_path), 1, (320, 240))[0]
+    image_path = str(tmp_path / image_path)
+    with open(image_path, 'rb') as image_file:
+        image_bytes = image_file.read()
+    socket_path = str(tmp_path / 'service.sock')
+
+    async def run_requests(detection_service):
+        health = await request(socket_path, 'GET', '/health')
+        by_path = await request(socket_path, 'POST', '/detect', json.dumps({'image_path': image_path, 'grids': 10}).encode())
+        by_base64 = await request(socket_path, 'POST', '/detect',
+                                  json.dumps({'image_base64': base64.b64encode(image_bytes).decode(), 'grids': 10}).encode())
+        raw = await request(socket_path, 'POST', '/detect', image_bytes, {'Content-Type': 'image/png'})
+        return health, by_path, by_base64, raw
+
+    health, by_path, by_base64, raw = serve(socket_path, run_requests, row_and_column_grids=10)
+
+    assert health == (200, {'status': 'ok', 'processing': 0, 'pending': 0})
+    expected = json.loads(json.dumps(analyze_image(image_path, 10)))
+    assert expected['red_grids']
+    assert by_path == (200, expected)
+    assert by_base64 == (200, expected)
+    assert raw == (200, expected)
+
+def test_bad_requests(tmp_path):
+    socket_path = str(tmp_path / 'service.sock')
+
+    async def run_requests(detection_service):
+        return [
+            await request(socket_path, 'POST', '/detect', b'{"image_path": '),
+            await request(socket_path, 'POST', '/detect', b'{}'),
+            await request(socket_path, 'POST', '/detect', json.dumps({'image_path': str(tmp_path / 'missing.png')}).encode()),
+            await request(socket_path, 'GET', '/detect'),
+            await request(socket_path, 'GET', '/other'),
+            await request(socket_path, 'POST', '/detect', b'', {'Content-Length': str(2 * 1024 * 1024)}, send_body=False),
+        ] + [
+            await request(socket_path, 'POST', '/detect', json.dumps({'image_path': __file__, 'grids': grids}).encode())
+            for grids in (0, -3, 2.5, '30', True, None)
+        ]
+
+    responses = serve(socket_path, run_requests, max_body_bytes=1024 * 1024)
+
+    assert [status for status, payload in responses] == [400, 400, 404, 405, 404, 413] + [400] * 6
+    assert 'positive integer' in responses[6][1]['error']
+
+def test_too_many_pending_requests(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / 'service.sock')
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocked_analyze(*args):
+        started.set()
+        release.wait(30)
+        return {'red_grids': []}
+
+    monkeypatch.setattr(service, 'analyze_image', blocked_analyze)
+    body = json.dumps({'image_path': __file__}).encode()
+
+    async def run_requests(detection_service):
+        loop = asyncio.get_running_loop()
+        processing = asyncio.ensure_future(request(socket_path, 'POST', '/detect', body))
+        await loop.run_in_executor(None, started.wait, 30)
+        waiting = asyncio.ensure_future(request(socket_path, 'POST', '/detect', body))
+        while detection_service.pending < 1:
+            await asyncio.sleep(0.01)
+
+        turned_away = await request(socket_path, 'POST', '/detect', body)
+        health = await request(socket_path, 'GET', '/health')
+        release.set()
+        return turned_away, health, await processing, await waiting
+
+    turned_away, health, processing, waiting = serve(socket_path, run_requests, max_concurrent=1, max_pending=1)
+
+    assert turned_away[0] == 503
+    assert health == (200, {'status': 'ok', 'processing': 1, 'pending': 1})
+    assert processing == waiting == (200, {'red_grids': []})
+
+def test_sample_stride(tmp_path):
+    image_path = str(tmp_path / generate_corpus(str(tmp_path), 1, (640, 480))[0])
+    socket_path = str(tmp_path / 'service.sock')
+
+    async def run_requests(detection_service):
+        return await request(socket_path, 'POST', '/detect', json.dumps({'image_path': image_path}).encode())
+
+    # The brightness the thresholds follow is sampled too, so the thresholds tell the two passes apart
+    status, sampled = serve(socket_path, run_requests, row_and_column_grids=10, sample_stride=4)
+    assert status == 200
+    assert sampled == json.loads(json.dumps(analyze_image(image_path, 10, sample_stride=4)))
+    assert sampled['thresholds'] != analyze_image(image_path, 10)['thresholds']
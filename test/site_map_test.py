@@ -0,0 +1,143 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from site_map import SiteHazardMap, read_offsets
+from red_hazards import IdentifyHazards
+from PIL import Image
+import numpy as np
+import math
+import pytest
+import time
+
+# 160 meters above sea level
+GPS = {1: 'N', 2: (40.0, 26.0, 46.0), 3: 'W', 4: (79.0, 58.0, 56.0), 5: 0, 6: 160.0}
+XMP = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+       b'<rdf:Description xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/" drone-dji:AbsoluteAltitude="+160.00" '
+       b'drone-dji:RelativeAltitude="+50.00"/></rdf:RDF></x:xmpmeta>')
+
+def save_frame(path, xmp=None):
+    exif = Image.Exif()
+    exif[0x8825] = GPS
+    options = {'xmp': xmp} if xmp else {}
+    Image.new('RGB', (400, 300)).save(path, 'JPEG', exif=exif.tobytes(), **options)
+
+def expected_meters_per_pixel(height, site_map):
+    return 2 * height * math.tan(math.radians(site_map.horizontal_fov) / 2) / 400
+
+def test_pose_uses_relative_altitude(tmp_path):
+    save_frame(tmp_path / 'dji.jpg', XMP)
+    site_map = SiteHazardMap()
+    x, y, meters_per_pixel = site_map.frame_pose(str(tmp_path / 'dji.jpg'), (400, 300))
+
+    assert meters_per_pixel == pytest.approx(expected_meters_per_pixel(50.0, site_map))
+    assert (x, y) == pytest.approx((-200 * meters_per_pixel, -150 * meters_per_pixel))
+
+def test_pose_uses_ground_elevation(tmp_path):
+    save_frame(tmp_path / 'plain.jpg')
+    site_map = SiteHazardMap(ground_elevation=110.0)
+    meters_per_pixel = site_map.frame_pose(str(tmp_path / 'plain.jpg'), (400, 300))[2]
+
+    assert meters_per_pixel == pytest.approx(expected_meters_per_pixel(50.0, site_map))
+
+def test_pose_without_height_above_ground(tmp_path):
+    save_frame(tmp_path / 'plain.jpg')
+    with pytest.raises(ValueError, match='relative altitude'):
+        SiteHazardMap().frame_pose(str(tmp_path / 'plain.jpg'), (400, 300))
+
+    # An offset does not need the altitude
+    site_map = SiteHazardMap(offsets={'plain.jpg': (5.0, 6.0, 0.02)})
+    assert site_map.frame_pose(str(tmp_path / 'plain.jpg'), (400, 300)) == (5.0, 6.0, 0.02)
+
+def frame_hazards(cell_std, cell_size=(10, 10)):
+    '''Builds the potential hazards of a frame whose red grids are the cells with a standard deviation of at least 1.'''
+
+    potential_hazards = IdentifyHazards(None, None, cell_std.shape, 1, np.inf)
+    potential_hazards.cell_width, potential_hazards.cell_height = cell_size
+    potential_hazards.cell_std = np.asarray(cell_std, dtype=np.float64)
+    potential_hazards.record_red_grids()
+    return potential_hazards
+
+def test_add_frame_observes_each_cell_once_per_frame():
+    # Two red grids side by side, 10 meters each. The map cell centered on their shared edge is covered by both
+    cell_std = np.zeros((3, 3))
+    cell_std[0, 0] = 100.0
+    cell_std[0, 1] = 300.0
+    site_map = SiteHazardMap(cell_size=4.0)
+
+    added = site_map.add_frame('a.jpg', frame_hazards(cell_std), (30, 30), pose=(0.0, 0.0, 1.0))
+    assert added == len(site_map.cells) == 5 * 3  # Centers at 2, 6, 10, 14 and 18 meters across, 2, 6 and 10 down
+    assert all(evidence['observations'] == 1 and evidence['frames'] == {'a.jpg'} for evidence in site_map.cells.values())
+    assert site_map.cells[(2, 0)]['intensity'] == 300.0  # The stronger grid wins on the shared edge
+    assert site_map.cells[(0, 0)]['intensity'] == 100.0
+
+    # The same frame again changes nothing
+    cells = {key: dict(evidence) for key, evidence in site_map.cells.items()}
+    assert site_map.add_frame('a.jpg', frame_hazards(cell_std), (30, 30), pose=(0.0, 0.0, 1.0)) == 0
+    assert site_map.cells == cells
+
+def test_overlapping_frames_accumulate_evidence():
+    cell_std = np.zeros((3, 3))
+    cell_std[1, 1] = 200.0
+    site_map = SiteHazardMap(cell_size=1.0)
+    site_map.add_frame('a.jpg', frame_hazards(cell_std), (30, 30), pose=(0.0, 0.0, 1.0))
+    site_map.add_frame('b.jpg', frame_hazards(cell_std * 2), (30, 30), pose=(5.0, 0.0, 1.0))
+
+    # The grids cover x from 10 to 20 and from 15 to 25 meters, and overlap from 15 to 20
+    shared = [key for key, evidence in site_map.cells.items() if evidence['observations'] == 2]
+    assert len(site_map.cells) == 15 * 10 and len(shared) == 5 * 10
+    assert {key[0] for key in shared} == {15, 16, 17, 18, 19}
+    assert site_map.cells[shared[0]]['intensity'] == 600.0
+    assert site_map.cells[shared[0]]['max_intensity'] == 400.0
+    assert site_map.cells[shared[0]]['frames'] == {'a.jpg', 'b.jpg'}
+
+def test_query_matches_every_cell():
+    rng = np.random.default_rng(0)
+    site_map = SiteHazardMap(cell_size=1.0, bucket_size=4)
+    for index in range(6):
+        cell_std = np.where(rng.random((10, 10)) < 0.2, rng.uniform(1, 500, (10, 10)), 0.0)
+        site_map.add_frame(f'{index}.jpg', frame_hazards(cell_std, (2, 2)), (20, 20), pose=tuple(rng.uniform(-30, 30, 2)) + (1.0,))
+
+    def expected(left, top, right, bottom, min_observations):
+        return {key for key, evidence in site_map.cells.items() if evidence['observations'] >= min_observations
+                and left <= key[0] + 0.5 <= right and top <= key[1] + 0.5 <= bottom}
+
+    # A small region visits the buckets it overlaps, a large one the occupied buckets
+    for region in ((-5.0, -5.0, 5.0, 5.0), (-1000.0, -1000.0, 1000.0, 1000.0), (3.2, -12.7, 17.9, 0.4)):
+        for min_observations in (1, 2):
+            assert set(site_map.query(*region, min_observations)) == expected(*region, min_observations)
+    assert site_map.query(100.0, 100.0, 200.0, 200.0) == {}
+
+def test_read_offsets(tmp_path):
+    (tmp_path / 'offsets.txt').write_text('# filename x y meters_per_pixel\n\na.jpg 1.5 -2 0.02\nb.jpg, 30, 40.25, 0.03\n')
+
+    assert read_offsets(str(tmp_path / 'offsets.txt')) == {'a.jpg': (1.5, -2.0, 0.02), 'b.jpg': (30.0, 40.25, 0.03)}
+
+def test_plan_paths():
+    assert SiteHazardMap().plan_paths(30) is None
+
+    site_map = SiteHazardMap(cell_size=1.0)
+    cell_std = np.zeros((6, 6))
+    cell_std[0, 0] = cell_std[0, 1] = cell_std[5, 5] = cell_std[3, 0] = 50.0
+    site_map.add_frame('a.jpg', frame_hazards(cell_std, (2, 2)), (12, 12), pose=(0.0, 0.0, 1.0))
+    path_planner = site_map.plan_paths(6)
+
+    # Three clusters of 8, 4 and 4 map cells, and no two of them fit 6 cells per drone
+    assert sorted(path_planner.centroids.values()) == [(1.0, 7.0), (2.0, 1.0), (11.0, 11.0)]
+    assert sorted(len(cluster) for cluster in site_map.clusters()) == [4, 4, 8]
+    assert sorted(path_planner.groups.values()) == [[1], [2], [3]]
+    assert sorted(path_planner.paths.values()) == [[1], [2], [3]]
+    assert site_map.plan_paths(6, min_observations=2) is None
+
+def test_plan_paths_scales_to_a_whole_site():
+    # 2,000 separate hazards of a single map cell
+    site_map = SiteHazardMap(cell_size=1.0)
+    cell_std = np.zeros((80, 100))
+    cell_std[::2, ::2] = 10.0
+    site_map.add_frame('a.jpg', frame_hazards(cell_std, (1, 1)), (100, 80), pose=(0.0, 0.0, 1.0))
+
+    start = time.perf_counter()
+    path_planner = site_map.plan_paths(30)
+    assert time.perf_counter() - start < 10
+    assert len(path_planner.centroids) == 2000
+    assert len(path_planner.groups) <= 2 * np.ceil(2000 / 30)
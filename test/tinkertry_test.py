@@ -0,0 +1,93 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from benchmark import generate_corpus
+from tinkertry import ImageProcessor
+from PIL import Image
+import numpy as np
+import pytest
+
+def make_jpegs(folder, count, resolution):
+    filenames = []
+    for filename in generate_corpus(str(folder / 'png'), count, resolution):
+        jpeg = os.path.splitext(filename)[0] + '.jpg'
+        Image.open(folder / 'png' / filename).save(folder / jpeg, quality=90)
+        filenames.append(jpeg)
+    return filenames
+
+def test_preview_predicts_full_pass(tmp_path):
+    filenames = make_jpegs(tmp_path, 2, (4000, 3000))
+    processor = ImageProcessor(str(tmp_path), str(tmp_path / 'grayscale'), str(tmp_path / 'hazards'))
+
+    for filename in filenames:
+        preview, confirmation = processor.preview_image(filename)
+        full = confirmation.result()
+        basename = os.path.splitext(filename)[0]
+
+        # The 16-bit grayscale image of a JPEG is saved as PNG
+        assert os.path.exists(tmp_path / 'grayscale' / f'{basename}.png')
+        assert os.path.exists(tmp_path / 'hazards' / f'{basename}_preview.png')
+
+        assert full.red_grid_count > 0
+        disagreements = len(set(preview.red_grids) ^ set(full.red_grids))
+        assert disagreements <= 0.03 * 20 * 20, f"{filename}: preview {preview.red_grids}, full {full.red_grids}."
+        assert len(set(preview.red_grids) & set(full.red_grids)) >= 0.75 * full.red_grid_count
+
+    # Every confirmation calibrates the previews of the same scale
+    assert list(processor.preview_calibration) == [2.0]
+
+def test_preview_moments_lines_match_full_pass(tmp_path):
+    processor = ImageProcessor(str(tmp_path), str(tmp_path / 'grayscale'), str(tmp_path / 'hazards'))
+    rng = np.random.default_rng(1)
+    image = Image.fromarray(rng.integers(0, 256, (300, 400), dtype=np.uint8).repeat(2, axis=0).repeat(2, axis=1))
+    image.save(tmp_path / 'blocks.png')
+
+    # A level without any detail finer than 2 pixels predicts the full pass, grid lines included
+    full = processor.process_image('blocks.png')
+    level = image.reduce(2)
+    moments = processor.preview_moments(level, level.reduce(2), image.size)
+    expected = full.cell_std
+    predicted = processor.predict_cell_std(moments, 0)
+    error = np.abs(predicted / expected - 1)
+    assert np.median(error) < 0.005 and error.max() < 0.03, f"median {np.median(error)}, max {error.max()}"
+
+
+def test_pyramid_cache_is_bounded(tmp_path):
+    rng = np.random.default_rng(2)
+    for index in range(4):
+        Image.fromarray(rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)).save(tmp_path / f'{index}.png')
+    processor = ImageProcessor(str(tmp_path), str(tmp_path / 'grayscale'), str(tmp_path / 'hazards'), max_cached_pyramids=2)
+
+    levels = processor.image_pyramid(str(tmp_path / '0.png'))
+    assert processor.image_pyramid(str(tmp_path / '0.png')) is levels
+    for index in range(1, 4):
+        processor.image_pyramid(str(tmp_path / f'{index}.png'))
+    assert [os.path.basename(path) for path, mtime in processor.pyramids] == ['2.png', '3.png']
+
+    # A changed image replaces its cached pyramid
+    os.utime(tmp_path / '3.png', (0, 0))
+    processor.image_pyramid(str(tmp_path / '3.png'))
+    assert [os.path.basename(path) for path, mtime in processor.pyramids] == ['2.png', '3.png']
+    assert list(processor.pyramids)[1][1] == 0
+
+def test_close_waits_for_confirmation(tmp_path):
+    filenames = make_jpegs(tmp_path, 1, (640, 480))
+    with ImageProcessor(str(tmp_path), str(tmp_path / 'grayscale'), str(tmp_path / 'hazards')) as processor:
+        preview, confirmation = processor.preview_image(filenames[0])
+
+    assert confirmation.done() and not processor.pyramids
+    assert len(processor.preview_calibration) == 1
+    with pytest.raises(RuntimeError):
+        processor.preview_image(filenames[0])
+    processor.close()
+
+def test_sample_stride_estimates_grids(tmp_path):
+    filename = generate_corpus(str(tmp_path), 1, (640, 480))[0]
+    exact = ImageProcessor(str(tmp_path), str(tmp_path / 'grayscale'), str(tmp_path / 'hazards')).process_image(filename)
+    with ImageProcessor(str(tmp_path), str(tmp_path / 'grayscale'), str(tmp_path / 'hazards'), sample_stride=4) as processor:
+        sampled = processor.process_image(filename)
+
+    assert sampled.sample_stride == 4 and sampled.cell_std_interval is not None
+    assert exact.cell_std_interval is None
+    assert np.allclose(sampled.cell_std, exact.cell_std, rtol=0.2)